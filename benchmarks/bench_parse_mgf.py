@@ -0,0 +1,162 @@
+"""
+Benchmark MGF spectrum extraction
+
+Compare the throughput (MB of MGF input per second) of the original line-based
+`parse_mgf` implementation with the streaming and index-based extraction
+engines. Synthetic MGF files are generated unless a directory with MGF files
+and a PSM table are given.
+
+Usage:
+```
+python3 benchmarks/bench_parse_mgf.py --runs 4 --spectra 50000 --psms 2000
+```
+"""
+
+# Standard library
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+
+# Third party
+import pandas as pd
+
+# Project
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+from parse_mgf import parse_mgf, title_parser  # noqa: E402
+from mgf_index import get_index_path  # noqa: E402
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from synthetic_data import write_mgf  # noqa: E402
+
+
+def argument_parser():
+    parser = argparse.ArgumentParser(description='Benchmark MGF spectrum\
+        extraction engines.')
+    parser.add_argument('--runs', dest='runs', action='store', default=4,
+                        type=int, help='Number of synthetic runs.')
+    parser.add_argument('--spectra', dest='spectra', action='store',
+                        default=20000, type=int,
+                        help='Number of spectra per synthetic run.')
+    parser.add_argument('--psms', dest='psms', action='store', default=1000,
+                        type=int, help='Number of PSMs to extract per run.')
+    parser.add_argument('--peaks', dest='peaks', action='store', default=100,
+                        type=int, help='Number of peaks per spectrum.')
+    parser.add_argument('--seed', dest='seed', action='store', default=42,
+                        type=int, help='Random seed for synthetic data.')
+    args = parser.parse_args()
+    return args
+
+
+def legacy_parse_mgf(df_in, mgf_folder, outname, filename_col, spec_title_col,
+                     title_parsing_method, new_title_col):
+    """
+    Original line-based implementation of `parse_mgf`, kept as reference.
+    """
+    df_in = df_in.copy()
+    df_in[spec_title_col] = df_in[spec_title_col].astype(str)
+    runs = df_in[filename_col].unique()
+    with open(outname, 'w') as out:
+        count = 0
+        for run in runs:
+            found = False
+            current_mgf_file = os.path.join(mgf_folder, run + '.mgf')
+            spec_set = set(df_in[(df_in[filename_col] == run)][spec_title_col].values)
+            id_charges = df_in[(df_in[filename_col] == run)].set_index(spec_title_col)['charge'].to_dict()
+            new_titles = df_in[(df_in[filename_col] == run)].set_index(spec_title_col)[new_title_col].to_dict()
+            with open(current_mgf_file, 'r') as f:
+                for line in f:
+                    if 'TITLE=' in line:
+                        title = title_parser(line, method=title_parsing_method)
+                        if title in spec_set:
+                            found = True
+                            line = "TITLE=" + new_titles[title] + "\n"
+                            out.write("BEGIN IONS\n")
+                            out.write(line)
+                            count += 1
+                            continue
+                    if 'END IONS' in line:
+                        if found:
+                            out.write(line + '\n')
+                            found = False
+                            continue
+                    if 'CHARGE=' in line:
+                        if found:
+                            charge = id_charges[title]
+                            out.write("CHARGE=" + str(charge) + "+\n")
+                            continue
+                    if found and line[-4:] != '0.0\n':
+                        out.write(line)
+    assert count == len(df_in)
+
+
+def write_synthetic_data(mgf_folder, runs, spectra, psms, peaks, seed):
+    """
+    Write ThermoRawFileParser-like MGF files and return a PSM table with a
+    random selection of their spectra.
+    """
+    rng = random.Random(seed)
+    rows = []
+    for r in range(runs):
+        run = 'run_{}'.format(r)
+        write_mgf(os.path.join(mgf_folder, run + '.mgf'), run, spectra, peaks, rng)
+        for scan in rng.sample(range(1, spectra + 1), min(psms, spectra)):
+            rows.append((run, scan, rng.choice([2, 3]), 'mzspec:PXD000000:{}:scan:{}'.format(run, scan)))
+    return pd.DataFrame(rows, columns=['run', 'scan_number', 'charge', 'usi'])
+
+
+def time_call(func, *args, **kwargs):
+    start = time.perf_counter()
+    func(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+def main():
+    args = argument_parser()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        psms = write_synthetic_data(
+            tmp_dir, args.runs, args.spectra, args.psms, args.peaks, args.seed
+        )
+        mgf_files = [os.path.join(tmp_dir, run + '.mgf') for run in psms['run'].unique()]
+        total_mb = sum(os.path.getsize(f) for f in mgf_files) / 1024 ** 2
+        kwargs = dict(
+            filename_col='run', spec_title_col='scan_number',
+            title_parsing_method='scan=', new_title_col='usi'
+        )
+
+        results = []
+        results.append(('legacy', time_call(
+            legacy_parse_mgf, psms, tmp_dir, os.path.join(tmp_dir, 'legacy.out'), **kwargs
+        )))
+        results.append(('stream', time_call(
+            parse_mgf, psms, tmp_dir, outname=os.path.join(tmp_dir, 'stream.out'),
+            show_progress_bar=False, engine='stream', **kwargs
+        )))
+        for f in mgf_files:
+            if os.path.isfile(get_index_path(f)):
+                os.remove(get_index_path(f))
+        results.append(('index (incl. build)', time_call(
+            parse_mgf, psms, tmp_dir, outname=os.path.join(tmp_dir, 'index_cold.out'),
+            show_progress_bar=False, engine='index', **kwargs
+        )))
+        results.append(('index (prebuilt)', time_call(
+            parse_mgf, psms, tmp_dir, outname=os.path.join(tmp_dir, 'index_warm.out'),
+            show_progress_bar=False, engine='index', **kwargs
+        )))
+
+        with open(os.path.join(tmp_dir, 'legacy.out'), 'rb') as f:
+            reference = f.read()
+        print("MGF input: {} runs, {:.1f} MB, {} PSMs".format(args.runs, total_mb, len(psms)))
+        print("{:<22}{:>10}{:>12}{:>10}".format('engine', 'time (s)', 'MB/s', 'speedup'))
+        for name, seconds in results:
+            print("{:<22}{:>10.3f}{:>12.1f}{:>10.1f}".format(
+                name, seconds, total_mb / seconds, results[0][1] / seconds
+            ))
+        for name in ['stream', 'index_cold', 'index_warm']:
+            with open(os.path.join(tmp_dir, name + '.out'), 'rb') as f:
+                assert f.read() == reference, "Output of {} differs from legacy output".format(name)
+
+
+if __name__ == '__main__':
+    main()
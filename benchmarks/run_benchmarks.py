@@ -0,0 +1,395 @@
+"""
+Benchmark suite for the hot paths of the workflow
+
+Generate a synthetic PRIDE-like dataset (see `synthetic_data.py`) and time
+each processing stage on it: MGF indexing, spectrum extraction (with and
+without peak processing), pin/pout parsing, PSMId parsing, modification
+extraction, best PSM selection, spectral library writing and retention time
+calibration. Every stage runs in a fresh
+process, so that its peak memory usage (RSS) can be measured separately.
+
+Results (time, throughput and peak RSS per stage) are written to a JSON file.
+With `--baseline`, results are compared to an earlier results file, and the
+script exits with a non-zero status if any stage is slower than the baseline
+by more than the given tolerance.
+
+Usage:
+```
+python3 benchmarks/run_benchmarks.py --runs 4 --spectra 20000 --psms 5000 -o results.json
+python3 benchmarks/run_benchmarks.py -o new.json --baseline results.json
+```
+"""
+
+# Standard library
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import platform
+import tempfile
+import importlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+# Project
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARK_DIR, '..', 'scripts'))
+sys.path.insert(0, BENCHMARK_DIR)
+import instrumentation  # noqa: E402
+import synthetic_data  # noqa: E402
+
+
+PROJECT_ID = 'PXD000000'
+# Imported before a stage is timed, so that import time is not included
+PRELOAD_MODULES = ['pandas', 'percolator_tools', 'mgf_index', 'parse_mgf', 'peak_processing',
+                   'speclib_builder']
+
+
+def argument_parser():
+    parser = argparse.ArgumentParser(description='Benchmark the workflow\
+        stages on synthetic data.')
+    synthetic_data.add_dataset_arguments(parser)
+    parser.add_argument('--stages', dest='stages', action='store', nargs='+',
+                        default=None, choices=list(STAGES),
+                        help='Stages to run (default: all).')
+    parser.add_argument('--data-dir', dest='data_dir', action='store',
+                        default=None,
+                        help='Directory for the synthetic dataset. Reused if it\
+                        already holds a dataset with the same parameters\
+                        (default: temporary directory).')
+    parser.add_argument('--repeat', dest='repeat', action='store', default=3,
+                        type=int, help='Number of repetitions per stage; the\
+                        fastest is reported (default: 3).')
+    parser.add_argument('-o', dest='output_file', action='store',
+                        default='benchmark_results.json',
+                        help='JSON file to write results to\
+                        (default: benchmark_results.json).')
+    parser.add_argument('--baseline', dest='baseline_file', action='store',
+                        default=None,
+                        help='JSON results file to compare results to.')
+    parser.add_argument('--tolerance', dest='tolerance', action='store',
+                        default=0.2, type=float,
+                        help='Allowed relative slowdown compared to the\
+                        baseline (default: 0.2).')
+    args = parser.parse_args()
+    return args
+
+
+def _total_size(paths):
+    return sum(os.path.getsize(path) for path in paths)
+
+
+def _example_psms(manifest):
+    """Return PSM table of all runs, as used by the spectral library steps."""
+    import percolator_tools
+    import pandas as pd
+    return pd.concat(
+        [percolator_tools.load_psms(path, PROJECT_ID) for path in manifest['pout_files']],
+        ignore_index=True
+    )
+
+
+# Each stage is a pair of functions: `setup(manifest, work_dir)` prepares the
+# input and `run(data)` performs the timed work, returning (rows, bytes)
+# processed.
+
+def setup_mgf_index(manifest, work_dir):
+    mgf_files = []
+    for path in manifest['mgf_files']:
+        mgf_files.append(os.path.join(work_dir, os.path.basename(path)))
+        shutil.copyfile(path, mgf_files[-1])
+    return mgf_files
+
+
+def run_mgf_index(mgf_files):
+    from mgf_index import build_index
+    rows = sum(len(build_index(path)) for path in mgf_files)
+    return rows, _total_size(mgf_files)
+
+
+def setup_parse_mgf(manifest, work_dir):
+    # Indexing is timed separately, in the mgf_index stage
+    from mgf_index import load_index
+    for path in manifest['mgf_files']:
+        load_index(path)
+    psms = _example_psms(manifest)
+    return psms, os.path.dirname(manifest['mgf_files'][0]), work_dir
+
+
+def run_parse_mgf(data):
+    from parse_mgf import parse_mgf
+    psms, mgf_folder, work_dir = data
+    parse_mgf(
+        psms, mgf_folder, outname=os.path.join(work_dir, 'spectra.mgf'),
+        filename_col='run', spec_title_col='scan_number',
+        title_parsing_method='scan=', new_title_col='usi',
+        show_progress_bar=False
+    )
+    mgf_files = [os.path.join(mgf_folder, run + '.mgf') for run in psms['run'].unique()]
+    return len(psms), _total_size(mgf_files)
+
+
+setup_peak_processing = setup_parse_mgf
+
+
+def run_peak_processing(data):
+    from parse_mgf import parse_mgf
+    from peak_processing import PeakProcessing
+    psms, mgf_folder, work_dir = data
+    parse_mgf(
+        psms, mgf_folder, outname=os.path.join(work_dir, 'spectra.mgf'),
+        filename_col='run', spec_title_col='scan_number',
+        title_parsing_method='scan=', new_title_col='usi',
+        show_progress_bar=False,
+        peak_processing=PeakProcessing(
+            top_n=20, precursor_tolerance=1.5, normalize='max', mz_decimals=4,
+            intensity_decimals=4
+        )
+    )
+    mgf_files = [os.path.join(mgf_folder, run + '.mgf') for run in psms['run'].unique()]
+    return len(psms), _total_size(mgf_files)
+
+
+def setup_fix_pin_tabs(manifest, work_dir):
+    return manifest['pin_files']
+
+
+def run_fix_pin_tabs(pin_files):
+    from percolator_tools import fix_pin_tabs
+    rows = 0
+    for path in pin_files:
+        fix_pin_tabs(path)
+        with open(path + '_fixed') as f:
+            rows += sum(1 for _ in f) - 1
+        os.remove(path + '_fixed')
+    return rows, _total_size(pin_files)
+
+
+def setup_read_pout(manifest, work_dir):
+    return manifest['pout_files']
+
+
+def run_read_pout(pout_files):
+    from percolator_tools import read_pout
+    rows = sum(len(read_pout(path)) for path in pout_files)
+    return rows, _total_size(pout_files)
+
+
+def setup_psmid_rowwise(manifest, work_dir):
+    from percolator_tools import read_pout
+    return read_pout(manifest['pout_files'][0])['PSMId'].astype(str)
+
+
+def run_psmid_rowwise(psmids):
+    import percolator_tools
+    psmids.apply(percolator_tools.psmid_to_usi, project_id=PROJECT_ID)
+    psmids.apply(percolator_tools.psmid_to_run)
+    psmids.apply(percolator_tools.psmid_to_scan)
+    psmids.apply(percolator_tools.psmid_to_charge)
+    return len(psmids), 0
+
+
+setup_parse_psmids = setup_psmid_rowwise
+
+
+def run_parse_psmids(psmids):
+    from percolator_tools import parse_psmids
+    parse_psmids(psmids, PROJECT_ID)
+    return len(psmids), 0
+
+
+def setup_extract_seq_mods(manifest, work_dir):
+    with open(manifest['mods_file']) as f:
+        mods = json.load(f)['modifications']
+    return _example_psms(manifest), mods
+
+
+def run_extract_seq_mods(data):
+    from percolator_tools import extract_seq_mods
+    psms, mods = data
+    extract_seq_mods(psms, mods)
+    return len(psms), 0
+
+
+setup_best_psms = setup_read_pout
+
+
+def run_best_psms(pout_files):
+    import percolator_tools
+    rows = 0
+    for path in pout_files:
+        best = percolator_tools.reduce_best_psms(
+            percolator_tools.iter_psms(path, PROJECT_ID, fdr_threshold=0.01)
+        )
+        rows += len(best)
+    return rows, _total_size(pout_files)
+
+
+def setup_write_speclib(manifest, work_dir):
+    import percolator_tools
+    psms, mods = setup_extract_seq_mods(manifest, work_dir)
+    psms = percolator_tools.select_best_psms(psms[psms['q-value'] < 0.01])
+    return psms, mods, os.path.dirname(manifest['mgf_files'][0]), work_dir
+
+
+def run_write_speclib(data):
+    from speclib_builder import write_speclib
+    psms, mods, mgf_folder, work_dir = data
+    write_speclib(
+        psms, mods, work_dir, mgf_folder, filename_col='run',
+        spec_title_col='scan_number', title_parsing_method='scan=',
+        new_title_col='usi'
+    )
+    return len(psms), 0
+
+
+def setup_rt_calibration(manifest, work_dir):
+    import retention_time_calibration  # noqa: F401
+    with open(manifest['mods_file']) as f:
+        mods = json.load(f)['modifications']
+    mod_mapping = {'UNIMOD:{}'.format(mod['unimod_accession']): mod['name'] for mod in mods}
+    root_dir = os.path.dirname(os.path.dirname(manifest['mgf_files'][0]))
+    return manifest['runs'], root_dir, mod_mapping
+
+
+def run_rt_calibration(data):
+    from retention_time_calibration import RunCollection
+    runs, root_dir, mod_mapping = data
+    collection = RunCollection('dataset', root_dir=root_dir, mgf_subdir='mgf', pout_subdir='mzid')
+    collection.add_runs_by_list(runs, mod_mapping=mod_mapping)
+    psms_calibrated = collection.calibrate_collection(q_value_threshold=0.01)
+    return len(psms_calibrated), 0
+
+
+STAGES = {
+    'mgf_index': (setup_mgf_index, run_mgf_index),
+    'parse_mgf': (setup_parse_mgf, run_parse_mgf),
+    'peak_processing': (setup_peak_processing, run_peak_processing),
+    'fix_pin_tabs': (setup_fix_pin_tabs, run_fix_pin_tabs),
+    'read_pout': (setup_read_pout, run_read_pout),
+    'psmid_rowwise': (setup_psmid_rowwise, run_psmid_rowwise),
+    'parse_psmids': (setup_parse_psmids, run_parse_psmids),
+    'extract_seq_mods': (setup_extract_seq_mods, run_extract_seq_mods),
+    'best_psms': (setup_best_psms, run_best_psms),
+    'write_speclib': (setup_write_speclib, run_write_speclib),
+    'rt_calibration': (setup_rt_calibration, run_rt_calibration),
+}
+
+
+def run_stage(stage, manifest, work_dir):
+    """
+    Set up and time a single stage. Meant to run in a fresh process.
+    """
+    setup, run = STAGES[stage]
+    try:
+        for module in PRELOAD_MODULES:
+            importlib.import_module(module)
+        data = setup(manifest, work_dir)
+    except ImportError as e:
+        return {'skipped': 'missing dependency: {}'.format(e)}
+    start = time.perf_counter()
+    try:
+        rows, n_bytes = run(data)
+    except ImportError as e:
+        return {'skipped': 'missing dependency: {}'.format(e)}
+    seconds = time.perf_counter() - start
+    return {
+        'seconds': seconds,
+        'rows': rows,
+        'rows_per_second': rows / seconds if seconds else None,
+        'mb_per_second': n_bytes / 1024 ** 2 / seconds if n_bytes and seconds else None,
+        'peak_rss_mb': instrumentation.peak_rss_mb(),
+    }
+
+
+def run_benchmarks(stages, manifest, repeat=3):
+    """
+    Run each stage `repeat` times, each time in a fresh process, and keep the
+    fastest repetition and the highest peak RSS.
+    """
+    context = multiprocessing.get_context('spawn')
+    results = {}
+    for stage in stages:
+        best = None
+        for _ in range(repeat):
+            with tempfile.TemporaryDirectory() as work_dir:
+                with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                    result = executor.submit(run_stage, stage, manifest, work_dir).result()
+            if 'skipped' in result:
+                best = result
+                break
+            if best is None or result['seconds'] < best['seconds']:
+                result['peak_rss_mb'] = max(result['peak_rss_mb'], best['peak_rss_mb'] if best else 0)
+                best = result
+            else:
+                best['peak_rss_mb'] = max(result['peak_rss_mb'], best['peak_rss_mb'])
+        results[stage] = best
+        if 'skipped' in best:
+            logging.warning("Skipped stage %s (%s)", stage, best['skipped'])
+        else:
+            logging.info(
+                "%-18s %8.3f s %12.0f rows/s %8.1f MB peak RSS",
+                stage, best['seconds'], best['rows_per_second'] or 0, best['peak_rss_mb']
+            )
+    return results
+
+
+def compare_to_baseline(results, baseline, tolerance):
+    """
+    Compare stage timings to a baseline results dict. Return the list of stages
+    that are slower than the baseline by more than `tolerance` (relative).
+    """
+    if baseline['config'] != results['config']:
+        logging.warning("Baseline was run with a different dataset configuration")
+    regressions = []
+    for stage, result in results['stages'].items():
+        reference = baseline['stages'].get(stage)
+        if not reference or 'seconds' not in reference or 'seconds' not in result:
+            continue
+        ratio = result['seconds'] / reference['seconds']
+        logging.info("%-18s %6.2fx baseline time", stage, ratio)
+        if ratio > 1 + tolerance:
+            regressions.append(stage)
+    return regressions
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    args = argument_parser()
+    params = dict(
+        runs=args.runs, spectra=args.spectra, psms=args.psms, peaks=args.peaks,
+        peptides=args.peptides, mod_density=args.mod_density, seed=args.seed
+    )
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_dir = args.data_dir or tmp_dir
+        logging.info("Generating synthetic dataset in %s", data_dir)
+        manifest = synthetic_data.write_dataset(data_dir, **params)
+        stages = args.stages or list(STAGES)
+        results = {
+            'config': params,
+            'environment': {
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cpu_count': os.cpu_count(),
+            },
+            'stages': run_benchmarks(stages, manifest, repeat=args.repeat),
+        }
+
+    with open(args.output_file, 'w') as f:
+        json.dump(results, f, indent=4)
+
+    if args.baseline_file:
+        with open(args.baseline_file) as f:
+            baseline = json.load(f)
+        regressions = compare_to_baseline(results, baseline, args.tolerance)
+        if regressions:
+            logging.error("Slower than baseline: %s", ', '.join(regressions))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,251 @@
+"""
+Synthetic PRIDE-like data for benchmarks
+
+Deterministically generate a small reanalysis project: for each run, an MGF
+file as written by ThermoRawFileParser, and the Percolator input (pin) and
+output (pout) files as written by msgf2pin and Percolator. Peptides are drawn
+from one pool shared by all runs, so that runs can be aligned on retention
+time, and carry modifications with a configurable density.
+
+Usage:
+```
+python3 benchmarks/synthetic_data.py data/ --runs 4 --spectra 20000 --psms 5000
+```
+"""
+
+# Standard library
+import os
+import json
+import random
+import argparse
+
+
+AMINO_ACIDS = 'ACDEFGHIKLMNPQRSTVWY'
+MODIFICATIONS = [
+    # (UNIMOD label, modified residues ('^' for peptide N-term), name)
+    ('UNIMOD:4', 'C', 'Carbamidomethyl'),
+    ('UNIMOD:35', 'M', 'Oxidation'),
+    ('UNIMOD:21', 'STY', 'Phospho'),
+    ('UNIMOD:1', '^', 'Acetyl'),
+]
+PROTEINS = ['sp|P{:05d}|PROT{}_HUMAN'.format(i, i) for i in range(1000)]
+MANIFEST_FILENAME = 'manifest.json'
+# Increment when the generated files change, so that existing datasets are rewritten
+DATA_VERSION = 2
+
+
+def argument_parser():
+    parser = argparse.ArgumentParser(description='Generate synthetic MGF, pin\
+        and pout files.')
+    parser.add_argument('out_dir', action='store',
+                        help='Directory to write synthetic data to.')
+    add_dataset_arguments(parser)
+    args = parser.parse_args()
+    return args
+
+
+def add_dataset_arguments(parser):
+    """
+    Add arguments that define the scale of the synthetic dataset to an
+    argparse parser.
+    """
+    parser.add_argument('--runs', dest='runs', action='store', default=4,
+                        type=int, help='Number of runs (default: 4).')
+    parser.add_argument('--spectra', dest='spectra', action='store',
+                        default=20000, type=int,
+                        help='Number of spectra per run (default: 20000).')
+    parser.add_argument('--psms', dest='psms', action='store', default=5000,
+                        type=int, help='Number of PSMs per run (default: 5000).')
+    parser.add_argument('--peaks', dest='peaks', action='store', default=50,
+                        type=int, help='Number of peaks per spectrum (default: 50).')
+    parser.add_argument('--peptides', dest='peptides', action='store',
+                        default=2000, type=int,
+                        help='Number of unique peptides shared by all runs\
+                        (default: 2000).')
+    parser.add_argument('--mod-density', dest='mod_density', action='store',
+                        default=0.3, type=float,
+                        help='Probability that a modifiable residue is\
+                        modified (default: 0.3).')
+    parser.add_argument('--seed', dest='seed', action='store', default=42,
+                        type=int, help='Random seed (default: 42).')
+
+
+def get_mods_config():
+    """
+    Return modifications in the format of the `modifications` section of
+    `conf/snakemake_config.json`.
+    """
+    return [
+        {'name': name, 'unimod_accession': int(label.split(':')[1])}
+        for label, _, name in MODIFICATIONS
+    ]
+
+
+def make_peptide(rng, mod_density):
+    """
+    Return random Percolator-style modified peptide with flanking residues
+    (e.g. `K.PEPM[UNIMOD:35]TIDEK.A`).
+    """
+    length = rng.randint(7, 20)
+    sequence = [rng.choice(AMINO_ACIDS) for _ in range(length - 1)] + [rng.choice('KR')]
+    modified = []
+    for i, residue in enumerate(sequence):
+        modified.append(residue)
+        for label, residues, _ in MODIFICATIONS:
+            if residue in residues and rng.random() < mod_density:
+                modified.append('[{}]'.format(label))
+                break
+    if rng.random() < mod_density / 3:
+        modified.insert(0, '[UNIMOD:1]')
+    return '{}.{}.{}'.format(rng.choice('KR-'), ''.join(modified), rng.choice(AMINO_ACIDS))
+
+
+def write_mgf(path, run, spectra, peaks, rng, retention_times=None):
+    """
+    Write ThermoRawFileParser-like MGF file. Retention times (seconds) can be
+    given per scan number; other scans get a retention time based on their
+    scan number. About 20% of the peaks have zero intensity (`0.0`); other
+    intensities are written with two decimals.
+    """
+    retention_times = retention_times or {}
+    with open(path, 'w') as f:
+        for scan in range(1, spectra + 1):
+            f.write('BEGIN IONS\n')
+            f.write('TITLE=mzspec={}.raw: controllerType=0 controllerNumber=1 scan={}\n'.format(run, scan))
+            f.write('SCANS={}\n'.format(scan))
+            f.write('RTINSECONDS={:.4f}\n'.format(retention_times.get(scan, scan * 0.25)))
+            f.write('PEPMASS={:.5f} {:.2f}\n'.format(rng.uniform(350, 1500), rng.uniform(1e4, 1e7)))
+            f.write('CHARGE={}+\n'.format(rng.choice([2, 3, 4])))
+            for mz in sorted(rng.uniform(100, 2000) for _ in range(peaks)):
+                if rng.random() < 0.2:
+                    f.write('{:.5f} 0.0\n'.format(mz))
+                else:
+                    f.write('{:.5f} {:.2f}\n'.format(mz, rng.uniform(1, 1e5)))
+            f.write('END IONS\n\n')
+
+
+def make_psms(run, spectra, psms, peptides, rng):
+    """
+    Return list of PSM dicts for a run, sorted by descending score as in a
+    Percolator out file, with increasing q-values.
+    """
+    rows = []
+    scans = rng.sample(range(1, spectra + 1), min(psms, spectra))
+    for i, scan in enumerate(scans):
+        rows.append({
+            'scan': scan,
+            'charge': rng.choice([2, 3, 4]),
+            'peptide': rng.randrange(len(peptides)),
+            'score': rng.gauss(2, 1.5),
+            'proteins': rng.sample(PROTEINS, rng.randint(1, 3)),
+        })
+    rows.sort(key=lambda row: -row['score'])
+    for i, row in enumerate(rows):
+        row['psmid'] = '{}_SII_{}_1_{}_{}_1'.format(run, i + 1, row['scan'], row['charge'])
+        row['q-value'] = 0.05 * i / max(1, len(rows) - 1)
+        row['posterior_error_prob'] = min(1.0, row['q-value'] * 5)
+    return rows
+
+
+def write_pout(path, psm_rows, peptides):
+    """
+    Write Percolator out file, with tab-separated protein columns.
+    """
+    with open(path, 'w') as f:
+        f.write('PSMId\tscore\tq-value\tposterior_error_prob\tpeptide\tproteinIds\n')
+        for row in psm_rows:
+            f.write('{}\t{:.5f}\t{:.6g}\t{:.6g}\t{}\t{}\n'.format(
+                row['psmid'], row['score'], row['q-value'],
+                row['posterior_error_prob'], peptides[row['peptide']][0],
+                '\t'.join(row['proteins'])
+            ))
+
+
+def write_pin(path, psm_rows, peptides):
+    """
+    Write msgf2pin-like Percolator input file, with tab-separated protein
+    columns.
+    """
+    with open(path, 'w') as f:
+        f.write('SpecId\tLabel\tScanNr\tRawScore\tDeNovoScore\tlnEValue\tCharge\tPeptide\tProteins\n')
+        for row in psm_rows:
+            f.write('{}\t1\t{}\t{:.0f}\t{:.0f}\t{:.4f}\t{}\t{}\t{}\n'.format(
+                row['psmid'], row['scan'], row['score'] * 50, row['score'] * 60,
+                -row['score'] * 3, row['charge'], peptides[row['peptide']][0],
+                '\t'.join(row['proteins'])
+            ))
+
+
+def write_dataset(out_dir, runs=4, spectra=20000, psms=5000, peaks=50,
+                  peptides=2000, mod_density=0.3, seed=42):
+    """
+    Write synthetic dataset to `out_dir`:
+    ```
+    mgf/run_{i}.mgf
+    mzid/run_{i}.pin
+    mzid/run_{i}.pout
+    mods.json
+    manifest.json
+    ```
+    Each run has its own retention time shift and scale relative to the
+    peptides' reference retention times. If `out_dir` already holds a dataset
+    generated with the same parameters, it is reused.
+
+    Returns the manifest dict with the parameters and file lists.
+    """
+    params = dict(runs=runs, spectra=spectra, psms=psms, peaks=peaks,
+                  peptides=peptides, mod_density=mod_density, seed=seed)
+    manifest_path = os.path.join(out_dir, MANIFEST_FILENAME)
+    if os.path.isfile(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        if manifest['params'] == params and manifest.get('version') == DATA_VERSION:
+            return manifest
+
+    rng = random.Random(seed)
+    os.makedirs(os.path.join(out_dir, 'mgf'), exist_ok=True)
+    os.makedirs(os.path.join(out_dir, 'mzid'), exist_ok=True)
+    peptide_pool = [
+        (make_peptide(rng, mod_density), rng.uniform(300, 7000)) for _ in range(peptides)
+    ]
+
+    manifest = {'version': DATA_VERSION, 'params': params, 'runs': [],
+                'mgf_files': [], 'pin_files': [], 'pout_files': [],
+                'mods_file': os.path.join(out_dir, 'mods.json')}
+    for r in range(runs):
+        run = 'run_{}'.format(r)
+        shift, scale = rng.gauss(0, 60), rng.gauss(1, 0.03)
+        psm_rows = make_psms(run, spectra, psms, peptide_pool, rng)
+        retention_times = {
+            row['scan']: max(0.0, peptide_pool[row['peptide']][1] * scale + shift + rng.gauss(0, 10))
+            for row in psm_rows
+        }
+        mgf_file = os.path.join(out_dir, 'mgf', run + '.mgf')
+        pin_file = os.path.join(out_dir, 'mzid', run + '.pin')
+        pout_file = os.path.join(out_dir, 'mzid', run + '.pout')
+        write_mgf(mgf_file, run, spectra, peaks, rng, retention_times=retention_times)
+        write_pin(pin_file, psm_rows, peptide_pool)
+        write_pout(pout_file, psm_rows, peptide_pool)
+        manifest['runs'].append(run)
+        manifest['mgf_files'].append(mgf_file)
+        manifest['pin_files'].append(pin_file)
+        manifest['pout_files'].append(pout_file)
+
+    with open(manifest['mods_file'], 'w') as f:
+        json.dump({'modifications': get_mods_config()}, f, indent=4)
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=4)
+    return manifest
+
+
+def main():
+    args = argument_parser()
+    write_dataset(
+        args.out_dir, runs=args.runs, spectra=args.spectra, psms=args.psms,
+        peaks=args.peaks, peptides=args.peptides, mod_density=args.mod_density,
+        seed=args.seed
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -1,37 +1,155 @@
 configfile: "conf/snakemake_config.json"
 
 
-from scripts.download_pride_project import get_files_df
+from snakemake.logging import logger
 
-def get_runs(pxd_identifier, extensions, file_pattern):
-	runs =  list(get_files_df(pxd_identifier,
+from scripts import pride_files
+
+def get_run_files(pxd_identifier, extensions, file_pattern):
+	return pride_files.get_run_files(
+		pxd_identifier,
 		extensions,
-		file_pattern
-	)['fileName'].str.replace('.raw', '', case=False))
-	return runs
+		file_pattern,
+		ttl=config["download"]["file_list_ttl_hours"] * 3600,
+		refresh=bool(config.get("refresh_file_list", False))
+	)
+
+def get_runs(pxd_identifier, extensions, file_pattern):
+	return list(get_run_files(pxd_identifier, extensions, file_pattern))
+
+# Snakemake benchmark files (timing and memory usage per job) and job reports
+# (per stage within a job) are collected by the benchmark_summary rule
+BENCHMARK_DIR = "logs/benchmarks"
+REPORT_DIR = "logs/reports"
+
+# Compression of MGF files (null, "gzip" or "zstd"), see scripts/compression.py
+COMPRESSION_SUFFIXES = {None: "", "gzip": ".gz", "zstd": ".zst"}
+MGF_COMPRESSION = config.get("compression", {}).get("mgf")
+COMPRESSION_THREADS = config.get("compression", {}).get("threads", 1)
+MGF = "mgf/{run}.mgf" + COMPRESSION_SUFFIXES[MGF_COMPRESSION]
+if MGF_COMPRESSION:
+	CONVERT_TO_MGF = "{config[convert][exec]} --input='{input}' --stdout -f=0 -m=0 | python3 scripts/compression.py compress -t {threads} -o '{output}'"
+else:
+	CONVERT_TO_MGF = "{config[convert][exec]} --input='{input}' --output_file='{output}' -f=0 -m=0"
+
+# Run names never contain a slash (files of a run may be in subdirectories, e.g.
+# the MGF chunks of search_data.smk)
+wildcard_constraints:
+	run="[^/]+"
+
+RUN_FILES = get_run_files(config["download"]["pxd_identifier"], ['raw'], config["download"]["file_pattern"])
+RUNS = list(RUN_FILES)
+
+
+# Storage budget: with a budget set, intermediate files are removed as soon as
+# they are no longer needed, and a run is only downloaded once enough earlier
+# runs are finished for its estimated footprint to fit. A run is finished when
+# the file storage > run_done exists, which the including workflow sets before
+# including this file (default: the run's pout file).
+STORAGE_BUDGET_MB = int(config["storage"]["budget_gb"] * 1024)
+RUN_DONE = config["storage"].get("run_done", "mzid/{run}.pout")
+
+workflow.global_resources.setdefault("downloads", config["download"]["threads"])
+if STORAGE_BUDGET_MB:
+	workflow.global_resources.setdefault("disk_mb", STORAGE_BUDGET_MB)
+
+def intermediate(path):
+	return temp(path) if STORAGE_BUDGET_MB else path
+
+def raw_size_mb(run):
+	return int(RUN_FILES[run].get("fileSize") or 0) // 1024 ** 2 + 1
+
+def run_footprint_mb(run):
+	return int(raw_size_mb(run) * config["storage"]["footprint_factor"])
 
-RUNS = get_runs(config["download"]["pxd_identifier"], ['raw'], config["download"]["file_pattern"])
+def get_budget_windows(runs, budget_mb):
+	"""For each run, the earlier runs that have to be finished before it is downloaded."""
+	wait_for = {}
+	start = 0
+	in_flight = 0
+	for i, run in enumerate(runs):
+		in_flight += run_footprint_mb(run)
+		while start < i and in_flight > budget_mb:
+			in_flight -= run_footprint_mb(runs[start])
+			start += 1
+		if in_flight > budget_mb:
+			logger.warning("Estimated footprint of run {} ({} MB) exceeds storage budget".format(run, in_flight))
+		wait_for[run] = runs[:start]
+	return wait_for
+
+WAIT_FOR = get_budget_windows(RUNS, STORAGE_BUDGET_MB) if STORAGE_BUDGET_MB else {}
+
+def runs_to_finish_first(wildcards):
+	return expand(RUN_DONE, run=WAIT_FOR.get(wildcards.run, []))
 
 
 rule download_targets:
 	input:
-		expand("mgf/{run}.mgf", run=RUNS)
+		"pxd_project_metadata.json",
+		expand(MGF, run=RUNS),
+		expand(MGF + ".idx", run=RUNS)
+
+
+rule download_metadata:
+	output:
+		"pxd_project_metadata.json",
+		"pxd_project_metadata.txt"
+	shell:
+		"python3 scripts/download_pride_project.py --metadata-only '{config[download][pxd_identifier]}'"
 
 
 rule download:
 	input:
+		runs_to_finish_first
 	output:
-		expand("raw/{run}.raw", run=RUNS)
+		intermediate("raw/{run}.raw")
 	log:
-		"logs/download_pride_project/log.log"
+		"logs/download_pride_project/{run}.log"
+	benchmark:
+		BENCHMARK_DIR + "/download/{run}.tsv"
+	params:
+		filename=lambda wildcards: RUN_FILES[wildcards.run]["fileName"]
+	resources:
+		downloads=1,
+		disk_mb=lambda wildcards: raw_size_mb(wildcards.run)
 	shell:
-		"python3 scripts/download_pride_project.py -f raw -p '{config[download][file_pattern]}' '{config[download][pxd_identifier]}'"
+		"python3 scripts/download_pride_project.py -f raw -j 1 --files '{params.filename}' '{config[download][pxd_identifier]}'"
 
 
 rule convert_to_mgf:
 	input:
 		"raw/{run}.raw"
 	output:
-		"mgf/{run}.mgf"
+		intermediate(MGF)
+	benchmark:
+		BENCHMARK_DIR + "/convert_to_mgf/{run}.tsv"
+	resources:
+		disk_mb=lambda wildcards: run_footprint_mb(wildcards.run)
+	threads: COMPRESSION_THREADS if MGF_COMPRESSION else 1
+	shell:
+		CONVERT_TO_MGF
+
+
+if MGF_COMPRESSION:
+	# MS-GF+ cannot read compressed MGF files: search a temporary decompressed copy
+	rule decompress_mgf:
+		input:
+			MGF
+		output:
+			temp("mgf/{run}.mgf")
+		benchmark:
+			BENCHMARK_DIR + "/decompress_mgf/{run}.tsv"
+		threads: COMPRESSION_THREADS
+		shell:
+			"python3 scripts/compression.py decompress -t {threads} -i '{input}' -o '{output}'"
+
+
+rule index_mgf:
+	input:
+		MGF
+	output:
+		intermediate(MGF + ".idx")
+	benchmark:
+		BENCHMARK_DIR + "/index_mgf/{run}.tsv"
 	shell:
-		"{config[convert][exec]} --input='{input}' --output_file='{output}' -f=0 -m=0"
+		"python3 scripts/mgf_index.py '{input}'"
@@ -3,7 +3,6 @@ configfile: "conf/snakemake_config.json"
 
 
 #RUNS, = glob_wildcards("mzid/{run}.pout")
-RUNS = get_runs(config["download"]["pxd_identifier"], ['raw'], config["download"]["file_pattern"])
 
 
 rule speclib_targets:
@@ -14,12 +13,16 @@ rule speclib_targets:
 rule retention_time_calibration:
     input:
         expand("mzid/{run}.pout", run=RUNS),
-        expand("mgf/{run}.mgf", run=RUNS)
+        expand(MGF, run=RUNS),
+        expand(MGF + ".idx", run=RUNS)
     output:
         "speclib/calibrated_retention_times.peprec"
     conda:
         "envs/retention_time_calibration.yml"
+    benchmark:
+        BENCHMARK_DIR + "/retention_time_calibration.tsv"
+    threads: config["rt_calibration"]["threads"]
     shell:
         """
-        python scripts/retention_time_calibration.py --mgf="mgf" --mzid="mzid" --output-file="speclib/calibrated_retention_times.peprec"
+        python scripts/retention_time_calibration.py --mgf="mgf" --mzid="mzid" --output-file="speclib/calibrated_retention_times.peprec" --modifications="conf/snakemake_config.json" --threads={threads} --report="{REPORT_DIR}/retention_time_calibration.jsonl"
         """
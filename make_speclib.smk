@@ -1,28 +1,81 @@
-include: "get_data.smk"
 configfile: "conf/snakemake_config.json"
 
+# With a storage budget, a run's MGF file is only removed after its shard is built
+config["storage"].setdefault("run_done", config["speclib"]["shard_dir"] + "/{run}.psms.tsv")
+
+include: "get_data.smk"
+
 
-RUNS, = glob_wildcards("mzid/{run}.pout")
-#RUNS = get_runs(config["download"]["pxd_identifier"], ['raw'], config["download"]["file_pattern"])
+#RUNS, = glob_wildcards("mzid/{run}.pout")
+
+
+SPECLIB_BINARY = ["speclib/spectral_library.speclib"] if config["speclib"]["binary"] else []
+SPECLIB_COMPRESSION = config.get("compression", {}).get("speclib")
+SPECLIB_SUFFIX = COMPRESSION_SUFFIXES[SPECLIB_COMPRESSION]
+SPECLIB_FILES = [
+    "speclib/spectral_library.peprec" + SPECLIB_SUFFIX,
+    "speclib/spectral_library.mgf" + SPECLIB_SUFFIX,
+] + SPECLIB_BINARY
+if not SPECLIB_COMPRESSION:
+    SPECLIB_FILES.append("speclib/spectral_library.mgf.pidx")
+# One unkeyed shard per run: Snakemake's modification time tracking replaces the
+# content-hash shard cache of pout_to_speclib.py -s (see scripts/speclib_builder.py)
+SHARD_DIR = config["speclib"]["shard_dir"]
+
+# Peak processing options (see scripts/peak_processing.py), applied when shards are built
+PEAK_PROCESSING_FLAGS = {
+    "top_n": "--top-n",
+    "precursor_tolerance": "--remove-precursor",
+    "normalize": "--normalize",
+    "mz_decimals": "--mz-decimals",
+    "intensity_decimals": "--intensity-decimals",
+}
+PEAK_PROCESSING_ARGS = " ".join(
+    "{} {}".format(flag, config["speclib"]["peak_processing"][option])
+    for option, flag in PEAK_PROCESSING_FLAGS.items()
+    if config["speclib"].get("peak_processing", {}).get(option) is not None
+)
 
 
 rule speclib_targets:
     input:
-        "speclib/spectral_library.peprec",
-        "speclib/spectral_library.mgf"
+        SPECLIB_FILES
+
+
+rule speclib_shard:
+    input:
+        pout="mzid/{run}.pout",
+        mgf=MGF,
+        mgf_index=MGF + ".idx"
+    output:
+        psms=SHARD_DIR + "/{run}.psms.tsv",
+        mgf=SHARD_DIR + "/{run}.mgf"
+    log:
+        "logs/speclib_shard/{run}.log"
+    benchmark:
+        BENCHMARK_DIR + "/speclib_shard/{run}.tsv"
+    shell:
+        """
+        python3 scripts/speclib_builder.py shard -i {config[download][pxd_identifier]} -m mgf -t 0.01 -o '{SHARD_DIR}/{wildcards.run}' {PEAK_PROCESSING_ARGS} --report '{REPORT_DIR}/speclib_shard/{wildcards.run}.jsonl' '{input.pout}'
+        """
 
 
 rule run_pout_to_speclib:
     input:
-        expand("mzid/{run}.pout", run=RUNS),
-        expand("mgf/{run}.mgf", run=RUNS)
+        expand(SHARD_DIR + "/{run}.psms.tsv", run=RUNS),
+        expand(SHARD_DIR + "/{run}.mgf", run=RUNS)
     output:
-        "speclib/spectral_library.peprec",
-        "speclib/spectral_library.mgf",
-        temp(expand("mzid/{run}.pout_fixed", run=RUNS))
+        SPECLIB_FILES
     log:
         "logs/pout_to_speclib/log.log"
+    benchmark:
+        BENCHMARK_DIR + "/pout_to_speclib.tsv"
+    params:
+        binary="-b" if config["speclib"]["binary"] else "",
+        compression="-z " + SPECLIB_COMPRESSION if SPECLIB_COMPRESSION else "",
+        shards=" ".join("'{}/{}'".format(SHARD_DIR, run) for run in RUNS)
+    threads: config['speclib']['threads']
     shell:
         """
-        python3 scripts/pout_to_speclib.py -c conf/snakemake_config.json -i {config[download][pxd_identifier]} -p mzid -m mgf -o speclib -t 0.01
+        python3 scripts/speclib_builder.py merge -c conf/snakemake_config.json -o speclib -j {threads} --report '{REPORT_DIR}/pout_to_speclib.jsonl' {params.binary} {params.compression} {params.shards}
         """
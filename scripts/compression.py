@@ -0,0 +1,241 @@
+"""
+Transparent compressed file I/O
+
+Open plain, gzip (`.gz`) and Zstandard (`.zst`) compressed files through one
+function, `open_file`, with the compression inferred from the file extension.
+Compressed files are always read and written as streams.
+
+With `threads` > 1, (de)compression runs in a separate `pigz` or `zstd`
+process if available, with multiple compression threads, so that it overlaps
+with parsing in Python. Otherwise the `gzip` module or the optional
+`zstandard` package is used.
+
+Usage (e.g. to compress the standard output of another program):
+```
+ThermoRawFileParser.sh --stdout ... | python3 scripts/compression.py compress -t 4 -o mgf/run_1.mgf.gz
+python3 scripts/compression.py decompress -i mgf/run_1.mgf.gz -o mgf/run_1.mgf
+```
+"""
+
+# Standard library
+import io
+import os
+import sys
+import gzip
+import shutil
+import logging
+import argparse
+import subprocess
+
+# Third party
+try:
+    import zstandard
+except ImportError:
+    ZSTD_INSTALLED = False
+else:
+    ZSTD_INSTALLED = True
+
+
+COMPRESSION_SUFFIXES = {'gzip': '.gz', 'zstd': '.zst'}
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+CHUNK_SIZE = 8 * 1024 ** 2
+
+
+def argument_parser():
+    parser = argparse.ArgumentParser(description='Compress or decompress files\
+        (gzip or zstd, inferred from the file extension).')
+    parser.add_argument('command', action='store', choices=['compress', 'decompress'])
+    parser.add_argument('-i', dest='input_file', action='store', default=None,
+                        help='Input file (default: standard input).')
+    parser.add_argument('-o', dest='output_file', action='store', required=True,
+                        help='Output file.')
+    parser.add_argument('-t', dest='threads', action='store', default=1, type=int,
+                        help='Number of compression threads (default: 1).')
+    args = parser.parse_args()
+    return args
+
+
+def get_compression(path):
+    """
+    Return compression of a file ('gzip', 'zstd' or None), based on its
+    extension.
+    """
+    for compression, suffix in COMPRESSION_SUFFIXES.items():
+        if path.endswith(suffix):
+            return compression
+    return None
+
+
+def is_compressed(path):
+    """Return True if the file is gzip or zstd compressed (by extension)."""
+    return get_compression(path) is not None
+
+
+def get_suffix(compression):
+    """Return file suffix for compression ('gzip', 'zstd' or None)."""
+    if compression is None:
+        return ''
+    if compression not in COMPRESSION_SUFFIXES:
+        raise ValueError("compression should be one of {}, not '{}'".format(
+            list(COMPRESSION_SUFFIXES), compression
+        ))
+    return COMPRESSION_SUFFIXES[compression]
+
+
+def strip_suffix(path):
+    """Return path without compression suffix."""
+    compression = get_compression(path)
+    return path[:-len(COMPRESSION_SUFFIXES[compression])] if compression else path
+
+
+def resolve_path(path):
+    """
+    Return `path` if it exists, or else the first existing compressed variant
+    of it (`path.gz`, `path.zst`). If none exist, `path` is returned.
+    """
+    if os.path.exists(path):
+        return path
+    for suffix in COMPRESSION_SUFFIXES.values():
+        if os.path.exists(path + suffix):
+            return path + suffix
+    return path
+
+
+def _get_command(compression, reading, threads):
+    """
+    Return command line for a (de)compression process, or None if no suitable
+    program is installed.
+    """
+    if compression == 'gzip' and shutil.which('pigz'):
+        if reading:
+            return ['pigz', '-dc', '-p', str(threads)]
+        return ['pigz', '-c', '-p', str(threads), '-{}'.format(GZIP_LEVEL)]
+    if compression == 'zstd' and shutil.which('zstd'):
+        if reading:
+            return ['zstd', '-dcq', '-T{}'.format(threads)]
+        return ['zstd', '-cq', '-T{}'.format(threads), '-{}'.format(ZSTD_LEVEL)]
+    return None
+
+
+class ProcessFile(io.RawIOBase):
+    """
+    Binary file object that reads from the standard output or writes to the
+    standard input of a (de)compression process.
+    """
+    def __init__(self, command, path, mode='rb'):
+        super().__init__()
+        self.path = path
+        self._reading = 'r' in mode
+        self._eof = False
+        self._output = None
+        if self._reading:
+            self._process = subprocess.Popen(command + [path], stdout=subprocess.PIPE)
+            self._pipe = self._process.stdout
+        else:
+            self._output = open(path, 'wb')
+            self._process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=self._output)
+            self._pipe = self._process.stdin
+
+    def readable(self):
+        return self._reading
+
+    def writable(self):
+        return not self._reading
+
+    def readinto(self, b):
+        n = self._pipe.readinto(b)
+        self._eof = not n
+        return n
+
+    def write(self, b):
+        return self._pipe.write(b)
+
+    def close(self):
+        if self.closed:
+            return
+        super().close()
+        if self._reading and not self._eof and self._process.poll() is None:
+            # Closed before the end of the file
+            self._pipe.close()
+            self._process.kill()
+            self._process.wait()
+            return
+        self._pipe.close()
+        returncode = self._process.wait()
+        if self._output is not None:
+            self._output.close()
+        if returncode != 0:
+            raise OSError("{} exited with status {} for {}".format(
+                self._process.args[0], returncode, self.path
+            ))
+
+
+def open_file(path, mode='rb', threads=1):
+    """
+    Open a plain, gzip or zstd compressed file (inferred from the extension of
+    `path`) for reading or writing. Text modes ('r', 'w', 'rt', 'wt') use UTF-8.
+
+    With `threads` > 1, `pigz` or `zstd` is run in a separate process, if
+    installed. Zstd files are also read and written with `zstd` if the
+    `zstandard` package is not installed.
+    """
+    compression = get_compression(path)
+    if compression is None:
+        return open(path, mode)
+
+    binary_mode = mode.replace('t', '') + ('' if 'b' in mode else 'b')
+    text = 'b' not in mode
+
+    command = None
+    if threads > 1 or (compression == 'zstd' and not ZSTD_INSTALLED):
+        command = _get_command(compression, 'r' in mode, threads)
+    if command:
+        raw = ProcessFile(command, path, binary_mode)
+        buffered = io.BufferedReader if 'r' in mode else io.BufferedWriter
+        f = buffered(raw, CHUNK_SIZE)
+    elif compression == 'gzip':
+        f = gzip.open(path, binary_mode, compresslevel=GZIP_LEVEL)
+    elif ZSTD_INSTALLED:
+        cctx = zstandard.ZstdCompressor(level=ZSTD_LEVEL, threads=threads if threads > 1 else 0)
+        f = zstandard.open(path, binary_mode, cctx=cctx)
+    else:
+        raise ImportError(
+            "Reading and writing zstd files requires the zstandard package or the zstd program"
+        )
+    return io.TextIOWrapper(f, encoding='utf-8') if text else f
+
+
+def copy_file(input_file, output_file, threads=1):
+    """
+    Copy file, (de)compressing it according to the extensions of the input and
+    output file. With `input_file` None, standard input is read.
+    """
+    if input_file is None:
+        src = sys.stdin.buffer
+    else:
+        src = open_file(input_file, 'rb', threads=threads)
+    try:
+        with open_file(output_file, 'wb', threads=threads) as dst:
+            shutil.copyfileobj(src, dst, CHUNK_SIZE)
+    finally:
+        if input_file is not None:
+            src.close()
+
+
+def main():
+    args = argument_parser()
+    if args.command == 'compress' and not is_compressed(args.output_file):
+        raise ValueError("Output file {} should end with one of {}".format(
+            args.output_file, list(COMPRESSION_SUFFIXES.values())
+        ))
+    if args.command == 'decompress' and args.input_file and not is_compressed(args.input_file):
+        raise ValueError("Input file {} should end with one of {}".format(
+            args.input_file, list(COMPRESSION_SUFFIXES.values())
+        ))
+    copy_file(args.input_file, args.output_file, threads=args.threads)
+    logging.info("Written %s", args.output_file)
+
+
+if __name__ == '__main__':
+    main()
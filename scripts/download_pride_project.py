@@ -1,112 +1,288 @@
-"""
-## Download PRIDE Project
-Download PRIDE project files for a given PRIDE identifier. With the `-f`
-argument certain file types can be chosen for download.
-
-*Download_PRIDE_Project.py*
-**Input:** PRIDE Archive identifier
-**Output:** Downloaded files, sorted in folders by file type
-"""
-
-import os
-import json
-import requests
-import argparse
-
-import wget
-import pandas as pd
-
-
-def argument_parser():
-    parser = argparse.ArgumentParser(description='Download files from PRIDE Archive for a given project.')
-    parser.add_argument('pxd_identifier', action='store',
-                        help='PXD identifier of project from which to download files')
-    parser.add_argument('-p', dest='pattern', action='store',
-                        help='Rexex pattern matching to files to be downloaded')
-    parser.add_argument('-f', dest='filetypes', action='store', nargs='+',
-                        help='filetypes to download (msf, raw, txt, zip...)')
-    args = parser.parse_args()
-    return args
-
-
-def check_pxd_id(pxd_identifier):
-    """
-    Assert if the project data for a given PXD identifier is accessable through
-    the PRIDE Archive API.
-    """
-    url = "https://www.ebi.ac.uk:443/pride/ws/archive/project/{}".format(pxd_identifier)
-    response = json.loads(requests.get(url).content.decode('utf-8'))
-    assert "accession" in response.keys(), "Could not access data for PXD ID '{}'".format(pxd_identifier)
-
-
-def get_files_df(pxd_identifier, filetypes, pattern):
-    """
-    Get DataFrame with files to download, filtered by extension and filename
-    regex pattern.
-    """
-    check_pxd_id(pxd_identifier)
-
-    get_files_url = "https://www.ebi.ac.uk:443/pride/ws/archive/file/list/project"
-
-    # Get dataframe with file info through PRIDE Archive REST API
-    url = "{}/{}".format(get_files_url, pxd_identifier)
-    response = pd.DataFrame(json.loads(requests.get(url).content.decode('utf-8'))['list'])
-    response['fileExtension'] = response['fileName'].str.split('.').apply(lambda x: x[-1])
-
-    # Set regex pattern
-    if pattern:
-        response = response[response['fileName'].str.contains(pattern)]
-
-    # Set extensions
-    extensions = response['fileExtension'].unique()
-    #print("Found files with extensions: \t\t{}".format(extensions))
-    if filetypes:
-        extensions = filetypes
-        response = response[response['fileExtension'].str.lower().isin([x.lower() for x in filetypes])]
-
-    #print("Downloading files with extensions: \t{}".format(extensions))
-
-    return response
-
-
-def run():
-    args = argument_parser()
-    get_meta_url = "https://www.ebi.ac.uk:443/pride/ws/archive/project"
-
-    # Make folder for project and download meta data
-    print("Downloading meta data...")
-    url = "{}/{}".format(get_meta_url, args.pxd_identifier)
-    response = json.loads(requests.get(url).content.decode('utf-8'))
-    with open("pxd_project_metadata.json", "w") as f:
-        f.write(json.dumps(response))
-    with open("pxd_project_metadata.txt", "w") as f:
-        f.write('{}\n'.format(response['accession']))
-        f.write('{}\n'.format(response['publicationDate']))
-        f.write('{}\n'.format(response['title']))
-        try:
-            f.write('{}\n'.format(response['references'][0]['desc']))
-            for _, item in enumerate(response['references'][0]['ids']):
-                f.write(item + '\n')
-        except IndexError:
-            pass
-
-    # Download files
-    print("Downloading files...")
-    response = get_files_df(args.pxd_identifier, args.filetypes, args.pattern)
-    for ext in args.filetypes:
-        if not os.path.exists(ext):
-            os.mkdir(ext)
-        count = 0
-        total = len(response[response['fileExtension'] == ext])
-        for _, row in response[response['fileExtension'] == ext].iterrows():
-            count += 1
-            #if count % 10 == 0 or count == 1:
-            print(" | {} {}/{}".format(ext, count, total), end=' ')
-            target_path = os.path.join(ext, row['fileName'])
-            if not os.path.isfile(target_path):
-                wget.download(row['downloadLink'], out=ext)
-                #os.system("wget -O '{}' '{}' -q --show-progress".format(target_path, row['downloadLink']))
-
-
-if __name__ == '__main__':
-    run()
+"""
+## Download PRIDE Project
+Download PRIDE project files for a given PRIDE identifier. With the `-f`
+argument certain file types can be chosen for download.
+
+*Download_PRIDE_Project.py*
+**Input:** PRIDE Archive identifier
+**Output:** Downloaded files, sorted in folders by file type
+"""
+
+import os
+import time
+import json
+import ftplib
+import hashlib
+import logging
+import requests
+import argparse
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+from pride_files import get_file_list
+
+
+CHUNK_SIZE = 1024 * 1024
+CHECKSUM_ALGORITHMS = {32: 'md5', 40: 'sha1', 64: 'sha256'}
+
+
+def argument_parser():
+    parser = argparse.ArgumentParser(description='Download files from PRIDE Archive for a given project.')
+    parser.add_argument('pxd_identifier', action='store',
+                        help='PXD identifier of project from which to download files')
+    parser.add_argument('-p', dest='pattern', action='store',
+                        help='Rexex pattern matching to files to be downloaded')
+    parser.add_argument('-f', dest='filetypes', action='store', nargs='+',
+                        help='filetypes to download (msf, raw, txt, zip...)')
+    parser.add_argument('-j', dest='workers', action='store', default=4, type=int,
+                        help='Number of files to download concurrently (default: 4)')
+    parser.add_argument('-r', dest='retries', action='store', default=5, type=int,
+                        help='Number of retries per file (default: 5)')
+    parser.add_argument('--refresh', dest='refresh', action='store_true',
+                        help='Refresh cached PRIDE file listing')
+    parser.add_argument('--files', dest='files', action='store', nargs='+',
+                        help='Only download files with these filenames. Project\
+                        meta data is not downloaded.')
+    parser.add_argument('--metadata-only', dest='metadata_only', action='store_true',
+                        help='Only download project meta data')
+    args = parser.parse_args()
+    return args
+
+
+def get_files_df(pxd_identifier, filetypes, pattern, refresh=False):
+    """
+    Get DataFrame with files to download, filtered by extension and filename
+    regex pattern. The PRIDE file listing is cached on disk (see
+    `pride_files.get_file_list`); use `refresh` to fetch it again.
+    """
+    # Get dataframe with file info through PRIDE Archive REST API (cached)
+    response = pd.DataFrame(get_file_list(pxd_identifier, refresh=refresh))
+    response['fileExtension'] = response['fileName'].str.split('.').apply(lambda x: x[-1])
+
+    # Set regex pattern
+    if pattern:
+        response = response[response['fileName'].str.contains(pattern)]
+
+    # Set extensions
+    extensions = response['fileExtension'].unique()
+    #print("Found files with extensions: \t\t{}".format(extensions))
+    if filetypes:
+        extensions = filetypes
+        response = response[response['fileExtension'].str.lower().isin([x.lower() for x in filetypes])]
+
+    #print("Downloading files with extensions: \t{}".format(extensions))
+
+    return response
+
+
+class DownloadError(Exception):
+    pass
+
+
+class IncompleteDownloadError(DownloadError):
+    """Downloaded file is smaller than expected; the download can be resumed."""
+    pass
+
+
+def _fetch_http(url, part_path, offset, timeout=60):
+    """
+    Download `url` into `part_path`, resuming from byte `offset` with an HTTP
+    Range request.
+    """
+    headers = {'Range': 'bytes={}-'.format(offset)} if offset else {}
+    with requests.get(url, headers=headers, stream=True, timeout=timeout) as response:
+        if response.status_code == 416:
+            # Requested range not satisfiable: file is already complete
+            return
+        response.raise_for_status()
+        if offset and response.status_code != 206:
+            # Server does not support ranges: start over
+            offset = 0
+        with open(part_path, 'ab' if offset else 'wb') as f:
+            for block in response.iter_content(chunk_size=CHUNK_SIZE):
+                f.write(block)
+
+
+def _fetch_ftp(url, part_path, offset, timeout=60):
+    """
+    Download `url` into `part_path`, resuming from byte `offset` with the FTP
+    REST command.
+    """
+    parsed = urlparse(url)
+    with ftplib.FTP(parsed.hostname, timeout=timeout) as ftp:
+        ftp.login()
+        with open(part_path, 'ab' if offset else 'wb') as f:
+            ftp.retrbinary('RETR ' + parsed.path, f.write, blocksize=CHUNK_SIZE, rest=offset or None)
+
+
+def _verify(path, expected_size=None, checksum=None):
+    """
+    Check size and checksum of a downloaded file. The checksum algorithm (MD5,
+    SHA-1 or SHA-256) is derived from the length of the hex digest.
+    """
+    size = os.path.getsize(path)
+    if expected_size is not None and size < expected_size:
+        raise IncompleteDownloadError("Size of {} is {}, expected {}".format(path, size, expected_size))
+    if expected_size is not None and size != expected_size:
+        raise DownloadError("Size of {} is {}, expected {}".format(path, size, expected_size))
+    if checksum:
+        algorithm = CHECKSUM_ALGORITHMS.get(len(checksum))
+        if not algorithm:
+            logging.warning("Unknown checksum format for %s: %s", path, checksum)
+            return
+        digest = hashlib.new(algorithm)
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(CHUNK_SIZE), b''):
+                digest.update(block)
+        if digest.hexdigest().lower() != checksum.lower():
+            raise DownloadError("{} checksum of {} does not match".format(algorithm, path))
+
+
+def download_file(url, target_path, expected_size=None, checksum=None,
+                  retries=5, backoff=2.0):
+    """
+    Download a file with resume and retries, and verify it before moving it
+    into place.
+
+    Data is written to `<target_path>.part`. After a failed transfer, the
+    download is resumed from the end of the partial file (HTTP Range or FTP
+    REST), waiting `backoff ** attempt` seconds between attempts. A partial or
+    corrupt file never ends up at `target_path`.
+
+    Returns a dict with download statistics.
+    """
+    stats = {'file': target_path, 'bytes': 0, 'seconds': 0.0, 'attempts': 0, 'skipped': False}
+
+    if os.path.isfile(target_path):
+        if expected_size is None or os.path.getsize(target_path) == expected_size:
+            stats['skipped'] = True
+            return stats
+        # Incomplete file from an earlier download: resume it
+        os.replace(target_path, target_path + '.part')
+
+    part_path = target_path + '.part'
+    fetch = _fetch_ftp if urlparse(url).scheme == 'ftp' else _fetch_http
+    start_time = time.time()
+    start_size = os.path.getsize(part_path) if os.path.isfile(part_path) else 0
+
+    for attempt in range(retries + 1):
+        stats['attempts'] += 1
+        offset = os.path.getsize(part_path) if os.path.isfile(part_path) else 0
+        try:
+            if expected_size is None or offset < expected_size:
+                fetch(url, part_path, offset)
+            _verify(part_path, expected_size=expected_size, checksum=checksum)
+            break
+        except IncompleteDownloadError as e:
+            # Transfer ended early: resume from the end of the partial file
+            logging.warning("%s (attempt %i)", e, attempt + 1)
+            error = e
+        except DownloadError as e:
+            # Corrupt or oversized file: restart from scratch
+            logging.warning("%s (attempt %i)", e, attempt + 1)
+            os.remove(part_path)
+            start_size = 0
+            error = e
+        except (requests.RequestException, ftplib.Error, OSError, EOFError) as e:
+            logging.warning("Download of %s failed: %s (attempt %i)", url, e, attempt + 1)
+            error = e
+        if attempt < retries:
+            time.sleep(backoff ** attempt)
+    else:
+        raise DownloadError("Could not download {}: {}".format(url, error))
+
+    os.replace(part_path, target_path)
+    stats['bytes'] = os.path.getsize(target_path) - start_size
+    stats['seconds'] = time.time() - start_time
+    return stats
+
+
+def download_files(files_df, out_dir, workers=4, retries=5):
+    """
+    Download all files in a PRIDE file listing DataFrame into `out_dir`, with
+    `workers` concurrent downloads. Expected sizes and checksums are taken from
+    the `fileSize` and `checksum` columns, if present.
+
+    Returns a list of download statistics dicts, one per file.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    jobs = []
+    for _, row in files_df.iterrows():
+        expected_size = row.get('fileSize')
+        jobs.append(dict(
+            url=row['downloadLink'],
+            target_path=os.path.join(out_dir, row['fileName']),
+            expected_size=int(expected_size) if pd.notna(expected_size) else None,
+            checksum=row.get('checksum') if pd.notna(row.get('checksum')) else None,
+            retries=retries,
+        ))
+
+    all_stats = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(download_file, **job) for job in jobs]
+        for count, future in enumerate(futures, 1):
+            stats = future.result()
+            all_stats.append(stats)
+            if stats['skipped']:
+                print(" | {}/{} {}: already downloaded".format(count, len(jobs), stats['file']))
+            else:
+                mb = stats['bytes'] / 1024 ** 2
+                print(" | {}/{} {}: {:.1f} MB in {:.1f} s ({:.1f} MB/s, {} attempt(s))".format(
+                    count, len(jobs), stats['file'], mb, stats['seconds'],
+                    mb / stats['seconds'] if stats['seconds'] else 0, stats['attempts']
+                ))
+    return all_stats
+
+
+def download_metadata(pxd_identifier):
+    """
+    Download project meta data to `pxd_project_metadata.json` and a summary to
+    `pxd_project_metadata.txt`.
+    """
+    get_meta_url = "https://www.ebi.ac.uk:443/pride/ws/archive/project"
+    url = "{}/{}".format(get_meta_url, pxd_identifier)
+    response = json.loads(requests.get(url).content.decode('utf-8'))
+    with open("pxd_project_metadata.json", "w") as f:
+        f.write(json.dumps(response))
+    with open("pxd_project_metadata.txt", "w") as f:
+        f.write('{}\n'.format(response['accession']))
+        f.write('{}\n'.format(response['publicationDate']))
+        f.write('{}\n'.format(response['title']))
+        try:
+            f.write('{}\n'.format(response['references'][0]['desc']))
+            for _, item in enumerate(response['references'][0]['ids']):
+                f.write(item + '\n')
+        except IndexError:
+            pass
+
+
+def run():
+    args = argument_parser()
+
+    # Make folder for project and download meta data
+    if not args.files:
+        print("Downloading meta data...")
+        download_metadata(args.pxd_identifier)
+    if args.metadata_only:
+        return
+
+    # Download files
+    print("Downloading files...")
+    response = get_files_df(args.pxd_identifier, args.filetypes, args.pattern, refresh=args.refresh)
+    if args.files:
+        missing = set(args.files) - set(response['fileName'])
+        if missing:
+            raise ValueError("Files not found in {}: {}".format(args.pxd_identifier, ', '.join(sorted(missing))))
+        response = response[response['fileName'].isin(args.files)]
+    for ext in args.filetypes:
+        print(" | {}: {} files".format(ext, len(response[response['fileExtension'] == ext])))
+        download_files(
+            response[response['fileExtension'] == ext], ext,
+            workers=args.workers, retries=args.retries
+        )
+
+
+if __name__ == '__main__':
+    run()
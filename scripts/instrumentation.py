@@ -0,0 +1,262 @@
+"""
+Stage timing and memory instrumentation
+
+Time the stages of a job (e.g. reading pout files, parsing PSMIds, extracting
+spectra) with a context manager that also counts the rows processed and
+records the peak resident set size (RSS) of the process:
+```
+with instrumentation.stage('load_pout') as s:
+    df = read_pout(path)
+    s.rows += len(df)
+```
+A stage can be entered multiple times (e.g. once per chunk); its time and rows
+are summed. All stages of a process are collected in one report, that can be
+written as JSON lines (one line per stage) with `write_report`. Stages run in
+worker processes are not included in the report of the parent process.
+
+Snakemake benchmark files and job reports can be collected into one summary
+table:
+```
+python3 scripts/instrumentation.py -o logs/benchmark_summary.tsv logs/benchmarks logs/reports
+```
+"""
+
+# Standard library
+import os
+import sys
+import csv
+import json
+import time
+import socket
+import logging
+import argparse
+from collections import OrderedDict
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+LOG_FORMAT = '%(asctime)s %(levelname)s [%(module)s] %(message)s'
+SUMMARY_COLUMNS = ['source', 'job', 'stage', 'calls', 'rows', 'seconds',
+                   'rows_per_second', 'peak_rss_mb']
+
+
+def argument_parser():
+    parser = argparse.ArgumentParser(description='Collect Snakemake benchmark\
+        files and job reports into one summary table.')
+    parser.add_argument('paths', action='store', nargs='+',
+                        help='Directories (searched recursively) or files with\
+                        Snakemake benchmarks (.tsv) and job reports (.jsonl).')
+    parser.add_argument('-o', dest='output_file', action='store',
+                        required=True, help='Path to summary table (TSV).')
+    args = parser.parse_args()
+    return args
+
+
+def configure_logging(level='INFO'):
+    """
+    Configure logging to stderr with timestamps, for use in scripts.
+    """
+    logging.basicConfig(level=getattr(logging, str(level).upper()), format=LOG_FORMAT)
+
+
+def peak_rss_mb():
+    """
+    Return peak RSS (MB) of this process and its terminated child processes,
+    or None if it cannot be determined on this platform.
+    """
+    if resource is None:
+        return None
+    peak = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+
+
+class Stage:
+    """
+    Totals of a named stage: number of calls, rows processed, time spent and
+    peak RSS at the end of the last call.
+    """
+    __slots__ = ['name', 'calls', 'rows', 'seconds', 'peak_rss_mb']
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.rows = 0
+        self.seconds = 0.0
+        self.peak_rss_mb = None
+
+    def to_dict(self):
+        return OrderedDict([
+            ('stage', self.name),
+            ('calls', self.calls),
+            ('rows', self.rows),
+            ('seconds', round(self.seconds, 6)),
+            ('rows_per_second', round(self.rows / self.seconds, 1) if self.seconds else None),
+            ('peak_rss_mb', round(self.peak_rss_mb, 1) if self.peak_rss_mb is not None else None),
+        ])
+
+
+class StageReport:
+    """
+    Ordered collection of the stages timed in a job.
+    """
+    def __init__(self, job=None):
+        self.job = job
+        self.stages = OrderedDict()
+
+    @contextmanager
+    def stage(self, name, rows=0):
+        """
+        Time a stage. Yields the Stage object, on which `rows` can be
+        incremented.
+        """
+        if name not in self.stages:
+            self.stages[name] = Stage(name)
+        record = self.stages[name]
+        record.rows += rows
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record.seconds += time.perf_counter() - start
+            record.calls += 1
+            record.peak_rss_mb = peak_rss_mb()
+
+    def records(self):
+        """Return list of dicts, one per stage, in order of first use."""
+        records = []
+        for record in self.stages.values():
+            record = record.to_dict()
+            record['job'] = self.job
+            records.append(record)
+        return records
+
+    def log_summary(self, level=logging.INFO):
+        for record in self.stages.values():
+            logging.log(
+                level, "Stage %s: %.3f s, %i rows, peak RSS %s MB",
+                record.name, record.seconds, record.rows,
+                '{:.1f}'.format(record.peak_rss_mb) if record.peak_rss_mb is not None else '?'
+            )
+
+    def write(self, path):
+        """
+        Write report as JSON lines, one per stage, to `path`.
+        """
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        meta = {'host': socket.gethostname(), 'pid': os.getpid(), 'time': time.time()}
+        with open(path, 'w') as f:
+            for record in self.records():
+                record.update(meta)
+                f.write(json.dumps(record) + '\n')
+
+
+_REPORT = StageReport()
+
+
+def get_report():
+    """Return the stage report of this process."""
+    return _REPORT
+
+
+def stage(name, rows=0):
+    """Time a stage in the report of this process. See `StageReport.stage`."""
+    return _REPORT.stage(name, rows=rows)
+
+
+def write_report(path, job=None):
+    """
+    Log a summary of all stages of this process and, if `path` is given,
+    write them as JSON lines to `path`.
+    """
+    if job is not None:
+        _REPORT.job = job
+    _REPORT.log_summary()
+    if path:
+        _REPORT.write(path)
+
+
+def _iter_files(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, filenames in sorted(os.walk(path)):
+                for filename in sorted(filenames):
+                    yield os.path.join(root, filename)
+        else:
+            yield path
+
+
+def read_snakemake_benchmark(path):
+    """
+    Read Snakemake benchmark file (TSV with `s`, `max_rss` etc. columns, one row
+    per repetition) into summary rows. The job name is the path of the file
+    relative to the benchmark directory, without extension.
+    """
+    rows = []
+    with open(path) as f:
+        for record in csv.DictReader(f, delimiter='\t'):
+            max_rss = record.get('max_rss', 'NA')
+            rows.append({
+                'source': 'snakemake',
+                'job': path[:-len('.tsv')],
+                'stage': 'total',
+                'calls': 1,
+                'rows': '',
+                'seconds': record['s'],
+                'rows_per_second': '',
+                'peak_rss_mb': '' if max_rss in ('NA', '-') else max_rss,
+            })
+    return rows
+
+
+def read_job_report(path):
+    """Read JSON lines job report into summary rows."""
+    rows = []
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            record['source'] = 'report'
+            record['job'] = record.get('job') or path[:-len('.jsonl')]
+            rows.append(record)
+    return rows
+
+
+def summarize(paths, output_file):
+    """
+    Collect Snakemake benchmark files (.tsv) and job reports (.jsonl) into one
+    summary table. Return the number of rows written.
+    """
+    rows = []
+    for path in _iter_files(paths):
+        if path.endswith('.tsv'):
+            rows.extend(read_snakemake_benchmark(path))
+        elif path.endswith('.jsonl'):
+            rows.extend(read_job_report(path))
+    with open(output_file, 'w', newline='') as f:
+        writer = csv.DictWriter(f, SUMMARY_COLUMNS, delimiter='\t', extrasaction='ignore')
+        writer.writeheader()
+        for row in rows:
+            writer.writerow({k: '' if row.get(k) is None else row.get(k) for k in SUMMARY_COLUMNS})
+    return len(rows)
+
+
+def main():
+    configure_logging()
+    args = argument_parser()
+    num_rows = summarize(args.paths, args.output_file)
+    logging.info("%i rows written to %s", num_rows, args.output_file)
+
+
+if __name__ == '__main__':
+    main()
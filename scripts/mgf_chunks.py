@@ -0,0 +1,234 @@
+"""
+MGF chunking for parallel searches
+
+Split the MGF file of a run into chunks with (about) the same number of
+spectra, so that the chunks can be searched as independent MS-GF+ jobs, and
+merge the Percolator input (pin) files of the chunks back into one pin file
+per run.
+
+Spectra are copied to the chunks unchanged, in file order, so the scan numbers
+in the PSMIds are preserved. The chunks of a run are listed in a manifest
+(`chunks.tsv` in the chunk directory) with the index of the first spectrum of
+each chunk. When the pin files are merged, the run part of each PSMId (taken
+from the chunk's mzid filename by msgf2pin) is replaced by the run name, and
+the MS-GF+ spectrum index is offset by the first spectrum index of the chunk,
+so that PSMIds are unique across chunks and can be parsed with
+`percolator_tools.parse_psmids` as usual.
+
+Usage:
+```
+python3 scripts/mgf_chunks.py split -n 8 -o mgf/chunks/run_1 mgf/run_1.mgf
+python3 scripts/mgf_chunks.py merge -m mgf/chunks/run_1/chunks.tsv -o mzid/run_1.pin mzid/chunks/run_1/*.pin
+```
+"""
+
+# Standard library
+import os
+import csv
+import logging
+import argparse
+
+# Project
+import instrumentation
+from compression import strip_suffix
+from mgf_index import load_index, iter_spectrum_buffers
+
+
+MANIFEST_FILENAME = 'chunks.tsv'
+MANIFEST_COLUMNS = ['chunk', 'run', 'first_spectrum', 'n_spectra']
+CHUNK_NAME = 'chunk_{:03d}'
+
+
+def argument_parser():
+    parser = argparse.ArgumentParser(description='Split MGF files into chunks\
+        for parallel searches and merge the pin files of the chunks.')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    common_parser = argparse.ArgumentParser(add_help=False)
+    common_parser.add_argument('--report', dest='report_file', action='store',
+                               default=None,
+                               help='Write timing and memory usage per stage\
+                               to this JSON lines file.')
+    common_parser.add_argument('--log-level', dest='log_level', action='store',
+                               default='INFO',
+                               choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                               help='Logging level (default: INFO).')
+
+    split_parser = subparsers.add_parser('split', help='Split MGF file into chunks.',
+                                         parents=[common_parser])
+    split_parser.add_argument('mgf_file', action='store',
+                              help='MGF file to split (optionally compressed).')
+    split_parser.add_argument('-o', dest='output_dir', action='store',
+                              required=True,
+                              help='Directory to write chunks and manifest to.')
+    split_parser.add_argument('-n', dest='n_chunks', action='store',
+                              default=1, type=int,
+                              help='Maximum number of chunks (default: 1).')
+    split_parser.add_argument('-s', dest='min_chunk_spectra', action='store',
+                              default=0, type=int,
+                              help='Minimum number of spectra per chunk; fewer\
+                              chunks are written for small runs (default: 0).')
+
+    merge_parser = subparsers.add_parser('merge', help='Merge pin files of chunks.',
+                                         parents=[common_parser])
+    merge_parser.add_argument('pin_files', action='store', nargs='+',
+                              help='Pin files of all chunks (`<chunk>.pin`).')
+    merge_parser.add_argument('-m', dest='manifest_file', action='store',
+                              required=True,
+                              help='Chunk manifest written by `split`.')
+    merge_parser.add_argument('-o', dest='output_file', action='store',
+                              required=True, help='Merged pin file.')
+    args = parser.parse_args()
+    return args
+
+
+def get_run_name(mgf_file):
+    """Return run name for a (compressed) MGF file."""
+    return os.path.basename(strip_suffix(mgf_file))[:-len('.mgf')]
+
+
+def get_chunk_sizes(n_spectra, n_chunks, min_chunk_spectra=0):
+    """
+    Return the number of spectra per chunk: at most `n_chunks` chunks of
+    (about) equal size, with at least `min_chunk_spectra` spectra each (unless
+    there is only one chunk).
+    """
+    if min_chunk_spectra > 0:
+        n_chunks = min(n_chunks, n_spectra // min_chunk_spectra)
+    n_chunks = max(1, min(n_chunks, n_spectra))
+    return [
+        (i + 1) * n_spectra // n_chunks - i * n_spectra // n_chunks
+        for i in range(n_chunks)
+    ]
+
+
+def write_manifest(path, rows):
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, MANIFEST_COLUMNS, delimiter='\t')
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def read_manifest(path):
+    """Read chunk manifest into a list of dicts, in chunk order."""
+    with open(path, newline='') as f:
+        rows = list(csv.DictReader(f, delimiter='\t'))
+    for row in rows:
+        row['first_spectrum'] = int(row['first_spectrum'])
+        row['n_spectra'] = int(row['n_spectra'])
+    return rows
+
+
+def split_mgf(mgf_file, output_dir, n_chunks, min_chunk_spectra=0):
+    """
+    Split MGF file into chunks with (about) the same number of spectra, written
+    uncompressed to `<output_dir>/chunk_<i>.mgf`, and write the chunk
+    manifest. Return the manifest rows.
+    """
+    run = get_run_name(mgf_file)
+    n_spectra = len(load_index(mgf_file))
+    chunk_sizes = get_chunk_sizes(n_spectra, n_chunks, min_chunk_spectra)
+    os.makedirs(output_dir, exist_ok=True)
+
+    manifest = []
+    first_spectrum = 0
+    for i, chunk_size in enumerate(chunk_sizes):
+        manifest.append({
+            'chunk': CHUNK_NAME.format(i),
+            'run': run,
+            'first_spectrum': first_spectrum,
+            'n_spectra': chunk_size,
+        })
+        first_spectrum += chunk_size
+
+    blocks = iter_spectrum_buffers(mgf_file)
+    try:
+        for row in manifest:
+            with open(os.path.join(output_dir, row['chunk'] + '.mgf'), 'wb') as out:
+                for _ in range(row['n_spectra']):
+                    buf, offset, length, _ = next(blocks)
+                    out.write(buf[offset:offset + length])
+    finally:
+        blocks.close()
+
+    write_manifest(os.path.join(output_dir, MANIFEST_FILENAME), manifest)
+    return manifest
+
+
+def rename_psmid(psmid, run, spectrum_offset):
+    """
+    Replace the run in a PSMId
+    (`run` _ `SII` _ `MSGFPlus spectrum index` _ `PSM rank` _ `scan number` _
+    `MSGFPlus-assigned charge` _ `rank`) and offset its spectrum index.
+    """
+    parts = psmid.rsplit('_', 6)
+    if len(parts) != 7 or parts[1] != 'SII':
+        raise ValueError("Unexpected PSMId format: {}".format(psmid))
+    parts[0] = run
+    parts[2] = str(int(parts[2]) + spectrum_offset)
+    return '_'.join(parts)
+
+
+def merge_pins(pin_files, manifest_file, output_file):
+    """
+    Merge the pin files of all chunks of a run into one pin file, in chunk
+    order, renaming the PSMIds (see `rename_psmid`). Return the number of PSMs
+    written.
+    """
+    manifest = read_manifest(manifest_file)
+    pin_by_chunk = {os.path.basename(pin_file)[:-len('.pin')]: pin_file for pin_file in pin_files}
+    chunks = [row['chunk'] for row in manifest]
+    if sorted(pin_by_chunk) != sorted(chunks):
+        raise ValueError("Pin files {} do not match chunks {} in {}".format(
+            sorted(pin_by_chunk), chunks, manifest_file
+        ))
+
+    header = None
+    n_psms = 0
+    with open(output_file + '.tmp', 'w') as out:
+        for row in manifest:
+            with open(pin_by_chunk[row['chunk']]) as f:
+                chunk_header = [f.readline()]
+                line = f.readline()
+                if line.startswith('DefaultDirection'):
+                    chunk_header.append(line)
+                    line = f.readline()
+                if header is None:
+                    header = chunk_header
+                    out.writelines(header)
+                elif chunk_header != header:
+                    raise ValueError("Pin file {} has a different header".format(
+                        pin_by_chunk[row['chunk']]
+                    ))
+                while line:
+                    psmid, rest = line.split('\t', 1)
+                    out.write(rename_psmid(psmid, row['run'], row['first_spectrum']) + '\t' + rest)
+                    n_psms += 1
+                    line = f.readline()
+    os.replace(output_file + '.tmp', output_file)
+    return n_psms
+
+
+def main():
+    args = argument_parser()
+    instrumentation.configure_logging(args.log_level)
+    if args.command == 'split':
+        with instrumentation.stage('split_mgf') as stage:
+            manifest = split_mgf(
+                args.mgf_file, args.output_dir, args.n_chunks,
+                min_chunk_spectra=args.min_chunk_spectra
+            )
+            stage.rows += sum(row['n_spectra'] for row in manifest)
+        logging.info("%s: %i chunks written to %s", args.mgf_file, len(manifest), args.output_dir)
+        job = 'split ' + args.mgf_file
+    elif args.command == 'merge':
+        with instrumentation.stage('merge_pins') as stage:
+            stage.rows += merge_pins(args.pin_files, args.manifest_file, args.output_file)
+        logging.info("%i PSMs written to %s", stage.rows, args.output_file)
+        job = 'merge ' + args.output_file
+    instrumentation.write_report(args.report_file, job=job)
+
+
+if __name__ == '__main__':
+    main()
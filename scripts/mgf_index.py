@@ -0,0 +1,356 @@
+"""
+MGF byte-offset index
+
+Build and load a sidecar index for an MGF file that maps each spectrum title to
+its byte offset and length in the file, together with a few header values
+(scan number, retention time, precursor m/z and charge). With the index,
+individual spectra can be read with a single seek instead of scanning the full
+MGF file.
+
+The index is written next to the MGF file as `<mgf_file>.idx` and is rebuilt
+automatically when the size or modification time of the MGF file changes.
+
+`read_retention_times` reads only scan numbers and retention times, from the
+index if available or else by scanning byte ranges of the MGF file in parallel.
+
+Gzip and zstd compressed MGF files (see `compression`) are scanned as a
+decompressed stream. Their index holds offsets in the decompressed stream, so
+it can be used for the header values but not for seeking.
+
+Usage:
+```
+python3 scripts/mgf_index.py mgf/run_1.mgf mgf/run_2.mgf
+```
+"""
+
+# Standard library
+import os
+import mmap
+import logging
+import argparse
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+# Third party
+import numpy as np
+
+# Project
+from compression import is_compressed, open_file, CHUNK_SIZE
+
+
+INDEX_SUFFIX = '.idx'
+INDEX_VERSION = 'v1'
+MIN_RANGE_SIZE = 64 * 1024 ** 2
+INDEX_COLUMNS = ['title', 'scan', 'offset', 'length', 'rtinseconds', 'pepmass', 'charge']
+
+IndexEntry = namedtuple('IndexEntry', INDEX_COLUMNS)
+
+
+def argument_parser():
+    parser = argparse.ArgumentParser(description='Build byte-offset index for\
+        MGF files.')
+    parser.add_argument('mgf_files', action='store', nargs='+',
+                        help='MGF files to index.')
+    parser.add_argument('-f', dest='force', action='store_true',
+                        help='Rebuild index, even if an up-to-date index exists.')
+    args = parser.parse_args()
+    return args
+
+
+def get_index_path(mgf_path):
+    """
+    Return path of sidecar index file for a given MGF file.
+    """
+    return mgf_path + INDEX_SUFFIX
+
+
+def _file_signature(mgf_path):
+    """
+    Return (size, mtime_ns) of file, used to detect outdated indices.
+    """
+    stat = os.stat(mgf_path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def _parse_scan_from_title(title):
+    """
+    Extract scan number from a ThermoRawFileParser-style title
+    (`... scan=1234`), or return an empty string.
+    """
+    if 'scan=' in title:
+        return title.split('scan=')[1].split(' ')[0].strip()
+    return ''
+
+
+def iter_spectrum_blocks(buf, start=0, end=None):
+    """
+    Yield (offset, length) of each spectrum in a bytes-like MGF buffer (e.g. a
+    memory-mapped MGF file), from `BEGIN IONS` up to and including the line
+    ending of `END IONS`.
+
+    Only spectra that start in `buf[start:end]` are yielded; the last spectrum
+    may extend beyond `end`.
+    """
+    if end is None:
+        end = len(buf)
+    pos = buf.find(b'BEGIN IONS', start, end)
+    while pos != -1:
+        stop = buf.find(b'END IONS', pos)
+        if stop == -1:
+            break
+        line_end = buf.find(b'\n', stop)
+        next_pos = line_end + 1 if line_end != -1 else len(buf)
+        yield pos, next_pos - pos
+        pos = buf.find(b'BEGIN IONS', next_pos, end)
+
+
+def _iter_stream_spectrum_blocks(f, chunk_size=CHUNK_SIZE):
+    """
+    Yield (buffer, offset, length, position) of each spectrum in a binary
+    stream, with `position` the offset of the spectrum in the stream. The stream
+    is read in chunks; spectra are only yielded once they are complete.
+    """
+    pending = b''
+    position = 0
+    while True:
+        chunk = f.read(chunk_size)
+        buf = pending + chunk if pending else chunk
+        consumed = 0
+        for offset, length in iter_spectrum_blocks(buf):
+            if chunk and offset + length >= len(buf):
+                # Possibly incomplete, wait for the next chunk
+                break
+            yield buf, offset, length, position + offset
+            consumed = offset + length
+        if not chunk:
+            return
+        next_start = buf.find(b'BEGIN IONS', consumed)
+        if next_start == -1:
+            # Keep a possibly partial `BEGIN IONS` at the end of the buffer
+            next_start = max(consumed, len(buf) - len(b'BEGIN IONS'))
+        pending = buf[next_start:]
+        position += next_start
+
+
+def iter_spectrum_buffers(mgf_path, start=0, end=None, threads=1):
+    """
+    Yield (buffer, offset, length, position) of each spectrum in an MGF file,
+    with `buffer[offset:offset + length]` the spectrum and `position` its offset
+    in the (decompressed) file.
+
+    Plain MGF files are memory-mapped; only spectra that start in byte range
+    `start:end` are yielded. Compressed MGF files are decompressed as a stream
+    (with `threads` compression threads, see `compression.open_file`) and
+    always read completely.
+    """
+    if is_compressed(mgf_path):
+        with open_file(mgf_path, 'rb', threads=threads) as f:
+            for block in _iter_stream_spectrum_blocks(f):
+                yield block
+        return
+    with open(mgf_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for offset, length in iter_spectrum_blocks(buf, start, end):
+                yield buf, offset, length, offset
+        finally:
+            buf.close()
+
+
+def read_block_header(buf, offset, length):
+    """
+    Read the `KEY=value` header lines of one spectrum block into a dict, stopping
+    at the first peak line.
+    """
+    header = {}
+    block_end = offset + length
+    pos = buf.find(b'\n', offset, block_end) + 1
+    while 0 < pos < block_end:
+        line_end = buf.find(b'\n', pos, block_end)
+        if line_end == -1:
+            line_end = block_end
+        line = buf[pos:line_end]
+        if line[:1].isdigit() or line.startswith(b'END IONS'):
+            break
+        if b'=' in line:
+            key, value = line.decode('utf-8').rstrip('\r').split('=', 1)
+            header[key] = value
+        pos = line_end + 1
+    return header
+
+
+def scan_mgf(mgf_path):
+    """
+    Read MGF file once and yield an IndexEntry for each spectrum.
+    """
+    for buf, offset, length, position in iter_spectrum_buffers(mgf_path):
+        header = read_block_header(buf, offset, length)
+        title = header.get('TITLE', '')
+        yield IndexEntry(
+            title=title,
+            scan=header.get('SCANS') or _parse_scan_from_title(title),
+            offset=position,
+            length=length,
+            rtinseconds=header.get('RTINSECONDS', ''),
+            pepmass=header.get('PEPMASS', '').split(' ')[0],
+            charge=header.get('CHARGE', ''),
+        )
+
+
+def write_index(mgf_path, entries, index_path=None):
+    """
+    Write index entries to the sidecar index file.
+    """
+    if not index_path:
+        index_path = get_index_path(mgf_path)
+    size, mtime_ns = _file_signature(mgf_path)
+    tmp_path = index_path + '.tmp'
+    with open(tmp_path, 'w') as out:
+        out.write('#mgf_index\t{}\t{}\t{}\n'.format(INDEX_VERSION, size, mtime_ns))
+        out.write('\t'.join(INDEX_COLUMNS) + '\n')
+        for entry in entries:
+            out.write('\t'.join(str(value) for value in entry) + '\n')
+    os.replace(tmp_path, index_path)
+
+
+def _read_index(mgf_path, index_path):
+    """
+    Read sidecar index file. Return None if the index is missing or does not
+    match the current state of the MGF file.
+    """
+    if not os.path.isfile(index_path):
+        return None
+    size, mtime_ns = _file_signature(mgf_path)
+    with open(index_path, 'r') as f:
+        signature = f.readline().rstrip('\n').split('\t')
+        if signature != ['#mgf_index', INDEX_VERSION, str(size), str(mtime_ns)]:
+            return None
+        if f.readline().rstrip('\n').split('\t') != INDEX_COLUMNS:
+            return None
+        entries = []
+        for line in f:
+            title, scan, offset, length, rt, pepmass, charge = line.rstrip('\n').split('\t')
+            entries.append(IndexEntry(
+                title, scan, int(offset), int(length), rt, pepmass, charge
+            ))
+    return entries
+
+
+def build_index(mgf_path, index_path=None):
+    """
+    Build index for MGF file and write it to the sidecar index file. Return
+    the list of index entries.
+    """
+    logging.info("Indexing MGF file %s", mgf_path)
+    entries = list(scan_mgf(mgf_path))
+    try:
+        write_index(mgf_path, entries, index_path=index_path)
+    except OSError as e:
+        logging.warning("Could not write MGF index for %s: %s", mgf_path, e)
+    return entries
+
+
+def load_index(mgf_path, index_path=None):
+    """
+    Load index for MGF file, (re)building it if it is missing or outdated.
+    """
+    if not index_path:
+        index_path = get_index_path(mgf_path)
+    entries = _read_index(mgf_path, index_path)
+    if entries is None:
+        entries = build_index(mgf_path, index_path=index_path)
+    return entries
+
+
+def split_byte_ranges(mgf_path, n_ranges):
+    """
+    Split MGF file into at most `n_ranges` byte ranges of roughly equal size,
+    each starting at a `BEGIN IONS` line. Return list of (start, end) tuples.
+    """
+    with open(mgf_path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return []
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            boundaries = [buf.find(b'BEGIN IONS')]
+            for i in range(1, n_ranges):
+                boundary = buf.find(b'BEGIN IONS', max(size * i // n_ranges, boundaries[-1] + 1))
+                if boundary == -1:
+                    break
+                boundaries.append(boundary)
+        finally:
+            buf.close()
+    if boundaries[0] == -1:
+        return []
+    boundaries.append(size)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def _read_retention_times_range(mgf_path, start=0, end=None, threads=1):
+    """
+    Read scan numbers and retention times (seconds) of all spectra that start in
+    byte range `start:end` of an MGF file (or of all spectra in a compressed
+    MGF file). Peak lists are skipped.
+    """
+    scans = []
+    retention_times = []
+    for buf, offset, length, _ in iter_spectrum_buffers(mgf_path, start, end, threads=threads):
+        header = read_block_header(buf, offset, length)
+        scans.append(header.get('SCANS') or _parse_scan_from_title(header.get('TITLE', '')))
+        retention_times.append(header.get('RTINSECONDS') or 'nan')
+    return np.array(scans, dtype=np.uint32), np.array(retention_times, dtype=np.float64)
+
+
+def read_retention_times(mgf_path, workers=1, use_index=True):
+    """
+    Read scan numbers and retention times (seconds) of all spectra in an MGF
+    file, without parsing peak lists. Return (scans, retention_times) NumPy
+    arrays, in file order.
+
+    If an up-to-date sidecar index exists, it is used instead of the MGF file.
+    Otherwise, files larger than MIN_RANGE_SIZE are split into byte ranges
+    aligned on `BEGIN IONS`, which are scanned in parallel by `workers`
+    processes. Compressed files are decompressed with `workers` threads and
+    scanned as a single stream.
+    """
+    entries = _read_index(mgf_path, get_index_path(mgf_path)) if use_index else None
+    if entries is not None:
+        return (
+            np.array([entry.scan for entry in entries], dtype=np.uint32),
+            np.array([entry.rtinseconds or 'nan' for entry in entries], dtype=np.float64),
+        )
+
+    if is_compressed(mgf_path):
+        return _read_retention_times_range(mgf_path, threads=workers)
+
+    n_ranges = max(1, min(workers, os.path.getsize(mgf_path) // MIN_RANGE_SIZE))
+    byte_ranges = split_byte_ranges(mgf_path, n_ranges)
+    if len(byte_ranges) <= 1:
+        results = [_read_retention_times_range(mgf_path, start, end) for start, end in byte_ranges]
+    else:
+        with ProcessPoolExecutor(max_workers=len(byte_ranges)) as executor:
+            futures = [
+                executor.submit(_read_retention_times_range, mgf_path, start, end)
+                for start, end in byte_ranges
+            ]
+            results = [future.result() for future in futures]
+    if not results:
+        return np.array([], dtype=np.uint32), np.array([], dtype=np.float64)
+    scans, retention_times = zip(*results)
+    return np.concatenate(scans), np.concatenate(retention_times)
+
+
+def main():
+    args = argument_parser()
+    for mgf_path in args.mgf_files:
+        if args.force:
+            build_index(mgf_path)
+        else:
+            load_index(mgf_path)
+
+
+if __name__ == '__main__':
+    main()
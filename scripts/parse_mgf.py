@@ -1,7 +1,9 @@
 # Standard library
 import os.path
 import logging
-import mmap
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 
 # Third party
 try:
@@ -11,13 +13,10 @@ except:
 else:
     TQDM_INSTALLED = True
 
-def get_num_lines(file_path):
-    fp = open(file_path, "r+")
-    buf = mmap.mmap(fp.fileno(), 0)
-    lines = 0
-    while buf.readline():
-        lines += 1
-    return lines
+# Project
+from compression import open_file, is_compressed, resolve_path, strip_suffix
+from mgf_index import load_index, iter_spectrum_buffers
+from peak_processing import process_peak_lines
 
 
 def title_parser(line, method='full'):
@@ -59,68 +58,273 @@ def title_parser(line, method='full'):
     return title
 
 
+def _iter_lines(text):
+    """
+    Split text into lines with universal newlines, keeping the line endings
+    (equivalent to iterating over a file opened in text mode).
+    """
+    text = text.replace('\r\n', '\n').replace('\r', '\n')
+    lines = text.split('\n')
+    for line in lines[:-1]:
+        yield line + '\n'
+    if lines[-1]:
+        yield lines[-1]
+
+
+def write_spectrum(out, spectrum_text, title, charge, peak_processing=None):
+    """
+    Write a single MGF spectrum to an open output file, replacing its title and
+    charge and removing peaks with zero intensity.
+
+    out: writable file object
+    spectrum_text: string, full MGF spectrum (`BEGIN IONS` up to `END IONS`)
+    title: string, title to write
+    charge: charge to write
+    peak_processing: `peak_processing.PeakProcessing` or None. Without peak
+      processing, peak lines are copied as-is, except those with intensity
+      `0.0`. Header lines are always copied as-is.
+    """
+    out.write("BEGIN IONS\n")
+    out.write("TITLE=" + title + "\n")
+    after_title = False
+    peak_lines = []
+    precursor_mz = None
+    for line in _iter_lines(spectrum_text):
+        if not after_title:
+            after_title = 'TITLE=' in line
+            continue
+        if line[:1].isdigit():
+            if peak_processing is not None:
+                peak_lines.append(line)
+            # Only print peak lines when intensity != 0
+            elif line[-5:] not in (' 0.0\n', '\t0.0\n'):
+                out.write(line)
+            continue
+        if 'END IONS' in line:
+            if peak_processing is not None:
+                out.write(process_peak_lines(peak_lines, precursor_mz, peak_processing))
+            out.write(line + '\n')
+            break
+        # Temporary fix: replace charges in MGF with ID'ed charges
+        # Until MS2PIP uses ID'ed charge instead of MGF charge
+        if 'CHARGE=' in line:
+            out.write("CHARGE=" + str(charge) + "+\n")
+            continue
+        if peak_processing is not None and line.startswith('PEPMASS='):
+            precursor_mz = float(line[8:].split()[0])
+        out.write(line)
+
+
+def extract_run(out, mgf_file, id_charges, new_titles=None,
+                title_parsing_method='full', show_progress_bar=True,
+                peak_processing=None):
+    """
+    Write the selected spectra of a single MGF file to an open output file.
+    Return the number of spectra written.
+
+    out: writable file object
+    mgf_file: string, path to MGF file
+    id_charges: dict, title -> identified charge, for all spectra to extract
+    new_titles: dict, title -> new title, or None to keep the parsed title
+    title_parsing_method: string, see `title_parser`
+    peak_processing: `peak_processing.PeakProcessing` or None, see
+      `write_spectrum`
+
+    Compressed MGF files cannot be read with seeks and are passed on to
+    `stream_extract_run`.
+    """
+    if is_compressed(mgf_file):
+        return stream_extract_run(
+            out, mgf_file, id_charges, new_titles=new_titles,
+            title_parsing_method=title_parsing_method,
+            show_progress_bar=show_progress_bar, peak_processing=peak_processing
+        )
+
+    # Look up selected spectra in index and read them in file order
+    index = {}
+    for entry in load_index(mgf_file):
+        title = title_parser('TITLE=' + entry.title, method=title_parsing_method)
+        index.setdefault(title, entry)
+    selected = sorted(
+        (index[title] for title in set(id_charges) if title in index),
+        key=lambda entry: entry.offset
+    )
+
+    count = 0
+    with open(mgf_file, 'rb') as f:
+        iterator = tqdm(selected) if show_progress_bar and TQDM_INSTALLED else selected
+        for entry in iterator:
+            title = title_parser('TITLE=' + entry.title, method=title_parsing_method)
+            f.seek(entry.offset)
+            spectrum_text = f.read(entry.length).decode('utf-8')
+            new_title = new_titles[title] if new_titles is not None else title
+            write_spectrum(out, spectrum_text, new_title, id_charges[title],
+                           peak_processing=peak_processing)
+            count += 1
+    return count
+
+
+def stream_extract_run(out, mgf_file, id_charges, new_titles=None,
+                       title_parsing_method='full', show_progress_bar=True,
+                       peak_processing=None):
+    """
+    Write the selected spectra of a single MGF file to an open output file,
+    without using the byte-offset index. Return the number of spectra written.
+
+    The memory-mapped (or, if compressed, decompressed) MGF file is scanned
+    spectrum by spectrum on the byte level; only the TITLE line of each
+    spectrum is decoded. Scanning stops as soon as all selected spectra have
+    been written. See `extract_run` for the arguments.
+    """
+    remaining = set(id_charges)
+    count = 0
+    if not remaining:
+        return count
+    progress = tqdm(total=len(remaining)) if show_progress_bar and TQDM_INSTALLED else None
+    blocks = iter_spectrum_buffers(mgf_file)
+    try:
+        for buf, offset, length, _ in blocks:
+            title_start = buf.find(b'TITLE=', offset, offset + length)
+            if title_start == -1:
+                continue
+            title_end = buf.find(b'\n', title_start, offset + length)
+            title_line = buf[title_start:title_end].decode('utf-8').rstrip('\r')
+            title = title_parser(title_line, method=title_parsing_method)
+            if title not in remaining:
+                continue
+            new_title = new_titles[title] if new_titles is not None else title
+            spectrum_text = buf[offset:offset + length].decode('utf-8')
+            write_spectrum(out, spectrum_text, new_title, id_charges[title],
+                           peak_processing=peak_processing)
+            remaining.discard(title)
+            count += 1
+            if progress is not None:
+                progress.update()
+            if not remaining:
+                break
+    finally:
+        blocks.close()
+        if progress is not None:
+            progress.close()
+    return count
+
+
+EXTRACTION_ENGINES = {
+    'index': extract_run,
+    'stream': stream_extract_run,
+}
+
+
+def _extract_run_to_shard(shard_file, mgf_file, id_charges, new_titles,
+                          title_parsing_method, engine, peak_processing):
+    """
+    Process pool worker: write the selected spectra of one MGF file to a
+    temporary shard file. Return the number of spectra written.
+    """
+    with open(shard_file, 'w') as out:
+        return EXTRACTION_ENGINES[engine](
+            out, mgf_file, id_charges, new_titles=new_titles,
+            title_parsing_method=title_parsing_method, show_progress_bar=False,
+            peak_processing=peak_processing
+        )
+
+
 def parse_mgf(df_in, mgf_folder, outname='scan_mgf_result.mgf',
               filename_col='mgf_filename', spec_title_col='spec_id',
               title_parsing_method='full', new_title_col=None,
-              show_progress_bar=True):
+              show_progress_bar=True, workers=1, engine='index',
+              peak_processing=None):
+    """
+    Write all spectra in `df_in` from their MGF files into a single MGF file.
+
+    Spectra are looked up in the byte-offset index of each MGF file (see
+    `mgf_index`), which is built on the fly if missing or outdated, and read
+    with a single seek each. Spectra are written run by run, in the order in
+    which they occur in the original MGF files.
+
+    With `workers` > 1, runs are extracted in parallel into temporary shard
+    files, which are then concatenated in run order. The resulting MGF file is
+    identical to the one written with a single worker.
+
+    engine: string, one of the following:
+    - 'index': seek to each spectrum using the byte-offset index (default).
+    - 'stream': scan each memory-mapped MGF file without index, until all
+      selected spectra of the run are found.
+
+    peak_processing: `peak_processing.PeakProcessing` or None, to reduce the
+      peak list of each written spectrum (see `peak_processing`).
+
+    MGF files can be gzip or zstd compressed (`<run>.mgf.gz`, `<run>.mgf.zst`),
+    in which case they are always streamed. The output is compressed if
+    `outname` ends in `.gz` or `.zst`, with `workers` compression threads.
+    """
+    if engine not in EXTRACTION_ENGINES:
+        raise ValueError("engine '{}' is not a valid MGF extraction engine".format(engine))
 
     df_in = df_in.copy()
-    
-    if df_in[filename_col].iloc[0][-4:] in ['.mgf', '.MGF']:
+
+    if strip_suffix(df_in[filename_col].iloc[0])[-4:] in ['.mgf', '.MGF']:
         file_suffix = ''
     else:
         file_suffix = '.mgf'
 
     df_in[spec_title_col] = df_in[spec_title_col].astype(str)
-        
+
     runs = df_in[filename_col].unique()
     logging.info("Parsing %i MGF files to single MGF containing all PSMs.", len(runs))
 
-    with open(outname, 'w') as out:
-        count = 0
-        for run in runs:
-            found = False
-            current_mgf_file = os.path.join(mgf_folder, run + file_suffix)
-            assert os.path.isfile(current_mgf_file), "MGF file {} could not be found.".format(current_mgf_file)
-
-            spec_set = set(df_in[(df_in[filename_col] == run)][spec_title_col].values)
-
-            # Temporary fix: replace charges in MGF with ID'ed charges
-            # Until MS2PIP uses ID'ed charge instead of MGF charge
-            id_charges = df_in[(df_in[filename_col] == run)].set_index(spec_title_col)['charge'].to_dict()
-            
-            if new_title_col:
-                new_titles = df_in[(df_in[filename_col] == run)].set_index(spec_title_col)[new_title_col].to_dict()
-                
-            with open(current_mgf_file, 'r') as f:
-                iterator = tqdm(f, total=get_num_lines(current_mgf_file)) if show_progress_bar and TQDM_INSTALLED else f
-                for line in iterator:
-                    if 'TITLE=' in line:
-                        title = title_parser(line, method=title_parsing_method)
-                        if title in spec_set:
-                            found = True
-                            if new_title_col:
-                                line = "TITLE=" + new_titles[title] + "\n"
-                            else:
-                                line = "TITLE=" + title + "\n"
-                            out.write("BEGIN IONS\n")
-                            out.write(line)
-                            count += 1
-                            continue
-                    if 'END IONS' in line:
-                        if found:
-                            out.write(line + '\n')
-                            found = False
-                            continue
-                    # Temporary fix (see above)
-                    if 'CHARGE=' in line:
-                        if found:
-                            charge = id_charges[title]
-                            out.write("CHARGE=" + str(charge) + "+\n")
-                            continue
-                    # Only print lines when spectrum is found and intensity != 0
-                    if found and line[-4:] != '0.0\n':
-                        out.write(line)
-
-    logging.info("%i/%i spectra found and written to new MGF file.", count, len(df_in))
-    assert count == len(df_in), "Not all PSMs could be found in the provided MGF files"
+    # Collect per-run lookups
+    groups = df_in.groupby(filename_col, sort=False, observed=True)
+    run_args = []
+    for run in runs:
+        current_mgf_file = resolve_path(os.path.join(mgf_folder, run + file_suffix))
+        assert os.path.isfile(current_mgf_file), "MGF file {} could not be found.".format(current_mgf_file)
+
+        df_run = groups.get_group(run).set_index(spec_title_col)
+        id_charges = df_run['charge'].to_dict()
+        new_titles = df_run[new_title_col].to_dict() if new_title_col else None
+        run_args.append((run, current_mgf_file, id_charges, new_titles, len(df_run)))
+
+    counts = {}
+    if workers > 1 and len(runs) > 1:
+        shard_dir = tempfile.mkdtemp(prefix='parse_mgf_', dir=os.path.dirname(os.path.abspath(outname)))
+        try:
+            shard_files = [os.path.join(shard_dir, '{}.mgf'.format(i)) for i in range(len(runs))]
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = [
+                    executor.submit(
+                        _extract_run_to_shard, shard_file, mgf_file, id_charges,
+                        new_titles, title_parsing_method, engine, peak_processing
+                    )
+                    for shard_file, (_, mgf_file, id_charges, new_titles, _) in zip(shard_files, run_args)
+                ]
+                for (run, _, _, _, _), future in zip(run_args, futures):
+                    counts[run] = future.result()
+
+            # Concatenate shards in run order
+            with open_file(outname, 'wb', threads=workers) as out:
+                for shard_file in shard_files:
+                    with open(shard_file, 'rb') as shard:
+                        shutil.copyfileobj(shard, out)
+        finally:
+            shutil.rmtree(shard_dir, ignore_errors=True)
+    else:
+        with open_file(outname, 'w', threads=workers) as out:
+            for run, mgf_file, id_charges, new_titles, _ in run_args:
+                counts[run] = EXTRACTION_ENGINES[engine](
+                    out, mgf_file, id_charges, new_titles=new_titles,
+                    title_parsing_method=title_parsing_method,
+                    show_progress_bar=show_progress_bar,
+                    peak_processing=peak_processing
+                )
+
+    incomplete = []
+    for run, _, _, _, expected in run_args:
+        logging.info("%s: %i/%i spectra found.", run, counts[run], expected)
+        if counts[run] != expected:
+            incomplete.append("{} ({}/{})".format(run, counts[run], expected))
+
+    logging.info("%i/%i spectra found and written to new MGF file.", sum(counts.values()), len(df_in))
+    assert not incomplete, "Not all PSMs could be found in the provided MGF files: {}".format(
+        ', '.join(incomplete)
+    )
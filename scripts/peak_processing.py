@@ -0,0 +1,151 @@
+"""
+Peak list processing for spectral library spectra
+
+Optionally reduce the peak lists of the spectra written to the spectral
+library: remove peaks with zero intensity and peaks in the precursor window,
+keep only the N most intense peaks, normalize intensities and round m/z and
+intensity values to a fixed number of decimals. The peaks of each spectrum are
+processed as NumPy arrays.
+
+All options are disabled by default, in which case spectra are copied as-is
+(apart from peaks with intensity `0.0`, see `parse_mgf.write_spectrum`).
+"""
+
+# Standard library
+from collections import namedtuple
+
+# Third party
+import numpy as np
+
+
+NORMALIZATION_METHODS = ['max', 'sum']
+
+PeakProcessing = namedtuple(
+    'PeakProcessing',
+    ['top_n', 'precursor_tolerance', 'normalize', 'mz_decimals', 'intensity_decimals'],
+    defaults=[None, None, None, None, None]
+)
+PeakProcessing.__doc__ = """
+Peak processing options (None disables an option):
+- top_n: int, number of most intense peaks to keep
+- precursor_tolerance: float, remove peaks within this m/z distance of the
+  precursor m/z (PEPMASS)
+- normalize: 'max' (most intense peak is 1) or 'sum' (total intensity is 1)
+- mz_decimals, intensity_decimals: int, number of decimals to write
+"""
+
+
+def add_peak_processing_arguments(parser):
+    """
+    Add peak processing options to an argparse parser.
+    """
+    group = parser.add_argument_group('peak processing')
+    group.add_argument('--top-n', dest='top_n', action='store', default=None,
+                       type=int, help='Keep only the N most intense peaks per\
+                       spectrum.')
+    group.add_argument('--remove-precursor', dest='precursor_tolerance',
+                       action='store', default=None, type=float,
+                       help='Remove peaks within this m/z tolerance (Da) of the\
+                       precursor m/z.')
+    group.add_argument('--normalize', dest='normalize', action='store',
+                       default=None, choices=NORMALIZATION_METHODS,
+                       help='Normalize intensities to the most intense peak\
+                       (max) or to the total intensity (sum).')
+    group.add_argument('--mz-decimals', dest='mz_decimals', action='store',
+                       default=None, type=int,
+                       help='Number of decimals of m/z values.')
+    group.add_argument('--intensity-decimals', dest='intensity_decimals',
+                       action='store', default=None, type=int,
+                       help='Number of decimals of intensity values. Peaks that\
+                       round to zero are removed.')
+
+
+def get_peak_processing(options):
+    """
+    Return PeakProcessing from parsed arguments or a dict (e.g. from the
+    configuration file), or None if all options are disabled.
+    """
+    if not isinstance(options, dict):
+        options = vars(options)
+    peak_processing = PeakProcessing(**{
+        field: options.get(field) for field in PeakProcessing._fields
+    })
+    if peak_processing.normalize not in [None] + NORMALIZATION_METHODS:
+        raise ValueError("normalize should be one of {}, not '{}'".format(
+            NORMALIZATION_METHODS, peak_processing.normalize
+        ))
+    if all(value is None for value in peak_processing):
+        return None
+    return peak_processing
+
+
+def process_peaks(mz, intensity, precursor_mz, peak_processing):
+    """
+    Process the peaks of a single spectrum (m/z-sorted NumPy arrays). Return
+    the processed (mz, intensity) arrays, still sorted by m/z.
+    """
+    keep = intensity > 0
+    if peak_processing.precursor_tolerance is not None and precursor_mz is not None:
+        keep &= np.abs(mz - precursor_mz) > peak_processing.precursor_tolerance
+    mz, intensity = mz[keep], intensity[keep]
+
+    top_n = peak_processing.top_n
+    if top_n is not None and len(intensity) > top_n:
+        # Stable sort, so that ties are resolved in favour of lower m/z
+        selected = np.sort(np.argsort(-intensity, kind='mergesort')[:top_n])
+        mz, intensity = mz[selected], intensity[selected]
+
+    if len(intensity):
+        if peak_processing.normalize == 'max':
+            intensity = intensity / intensity.max()
+        elif peak_processing.normalize == 'sum':
+            intensity = intensity / intensity.sum()
+
+    if peak_processing.intensity_decimals is not None:
+        intensity = np.round(intensity, peak_processing.intensity_decimals)
+        keep = intensity > 0
+        mz, intensity = mz[keep], intensity[keep]
+    if peak_processing.mz_decimals is not None:
+        mz = np.round(mz, peak_processing.mz_decimals)
+    return mz, intensity
+
+
+def parse_peak_lines(peak_lines):
+    """
+    Parse MGF peak lines (`m/z intensity [charge]`) into m/z and intensity
+    arrays.
+    """
+    text = ''.join(peak_lines)
+    if len(peak_lines[0].split()) == 2:
+        values = np.array(text.split(), dtype=np.float64)
+        if len(values) == 2 * len(peak_lines):
+            return values[0::2], values[1::2]
+    peaks = np.array([line.split()[:2] for line in peak_lines], dtype=np.float64)
+    return peaks[:, 0], peaks[:, 1]
+
+
+def _format_values(values, decimals):
+    if decimals is None:
+        return [repr(value) for value in values.tolist()]
+    return np.char.mod('%.{}f'.format(decimals), values).tolist()
+
+
+def format_peaks(mz, intensity, peak_processing):
+    """
+    Format peaks as MGF peak lines.
+    """
+    mz = _format_values(mz, peak_processing.mz_decimals)
+    intensity = _format_values(intensity, peak_processing.intensity_decimals)
+    return ''.join([m + ' ' + i + '\n' for m, i in zip(mz, intensity)])
+
+
+def process_peak_lines(peak_lines, precursor_mz, peak_processing):
+    """
+    Process MGF peak lines of a single spectrum and return the processed peak
+    lines as a single string.
+    """
+    if not peak_lines:
+        return ''
+    mz, intensity = parse_peak_lines(peak_lines)
+    mz, intensity = process_peaks(mz, intensity, precursor_mz, peak_processing)
+    return format_peaks(mz, intensity, peak_processing)
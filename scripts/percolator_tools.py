@@ -1,6 +1,15 @@
+import io
 import re
+import logging
+
+import numpy as np
 import pandas as pd
 
+import instrumentation
+
+
+MOD_PATTERN = re.compile(r'(\[[^]]*\])')
+
 
 def psmid_to_usi(psmid, project_id):
     """
@@ -55,79 +64,258 @@ def psmid_to_scan(psmid):
     return scan
 
 
+def parse_psmids(psmids, project_id):
+    """
+    Parse a Series of Percolator PSMIds into typed columns in a single pass.
+
+    Returns a pandas.DataFrame with the same index as `psmids` and columns
+    `usi` (HUPO-PSI Universal Spectrum Identifier), `run` (categorical),
+    `scan_number` (uint32) and `charge` (uint8). See `psmid_to_usi` for the
+    expected PSMId format.
+    """
+    if psmids.empty:
+        parts = pd.DataFrame({i: pd.Series([], dtype=object) for i in range(7)}, index=psmids.index)
+    else:
+        parts = psmids.str.rsplit('_', n=6, expand=True)
+    run, scan = parts[0], parts[4]
+    return pd.DataFrame({
+        'usi': 'mzspec:' + project_id + ':' + run + ':scan:' + scan,
+        'run': run.astype('category'),
+        'scan_number': scan.astype(np.uint32),
+        'charge': parts[5].astype(np.uint8),
+    }, index=psmids.index)
+
+
+def _fix_protein_tabs(row, numcol, prot_sep):
+    """
+    Join the tab-separated protein columns at the end of a pin/pout row with
+    `prot_sep`, so that the row has `numcol` columns.
+    """
+    r = row.strip().split('\t', numcol - 1)
+    r[-1] = r[-1].replace('\t', prot_sep)
+    return '\t'.join(r) + '\n'
+
+
 def fix_pin_tabs(path, prot_sep='|||'):
     """
     Take a pin file and rewrite it, replacing the tabs that separate the
     Proteins column with a different separator
     """
-    f = open(path)
-    rows = f.readlines()
     outfile = path + '_fixed'
-    out = open(outfile, 'w+')
-
-    for i, row in enumerate(rows):
-        if i == 0 & row.startswith('SpecId'):
-            numcol = len(row.split('\t'))
-            out.write(row)
-        elif i == 1 & row.startswith('DefaultDirection'):
-            out.write(row)
-        else:
-            r = row.strip().split('\t')
-            r_cols = r[:numcol-1]
-            r_proteins = r[numcol-1:]
-            r_cols.append(prot_sep.join(r_proteins))
-            out.write('\t'.join(r_cols) + '\n')
-    f.close()
-    out.close()
+    with open(path) as f, open(outfile, 'w+') as out:
+        for i, row in enumerate(f):
+            if i == 0:
+                # The header gives the number of columns, whatever its first column
+                numcol = len(row.split('\t'))
+                out.write(row)
+            elif i == 1 and row.startswith('DefaultDirection'):
+                out.write(row)
+            else:
+                out.write(_fix_protein_tabs(row, numcol, prot_sep))
     return None
 
 
+def iter_pout(path, chunksize=100000, prot_sep='|||'):
+    """
+    Read a Percolator out (pout) file in chunks, without rewriting it to disk.
+
+    The tab-separated protein columns at the end of each row are joined with
+    `prot_sep` while reading. Yields a pandas.DataFrame for every `chunksize`
+    PSMs, and at least one (empty) DataFrame for a pout file without PSMs.
+    """
+    with open(path) as f:
+        header = f.readline()
+        numcol = len(header.split('\t'))
+        rows = []
+        num_chunks = 0
+        for row in f:
+            if not row.strip():
+                continue
+            rows.append(_fix_protein_tabs(row, numcol, prot_sep))
+            if len(rows) == chunksize:
+                yield pd.read_csv(io.StringIO(header + ''.join(rows)), sep='\t')
+                num_chunks += 1
+                rows = []
+        # Always yield at least one (possibly empty) chunk
+        if rows or not num_chunks:
+            yield pd.read_csv(io.StringIO(header + ''.join(rows)), sep='\t')
+
+
+def read_pout(path, chunksize=100000, prot_sep='|||'):
+    """
+    Read a full Percolator out (pout) file into a pandas.DataFrame. See
+    `iter_pout`.
+    """
+    chunks = iter_pout(path, chunksize=chunksize, prot_sep=prot_sep)
+    return pd.concat(chunks, axis=0, ignore_index=True)
+
+
+POUT_COLUMN_RENAME = {
+    'peptide': 'modified_peptide',
+    'proteinIds': 'proteins',
+    'PSMId': 'percolator_psmid',
+}
+
+
+def iter_psms(path, project_id, fdr_threshold=None, chunksize=100000):
+    """
+    Read a Percolator out (pout) file into PSM table chunks, with renamed
+    columns, parsed PSMIds (see `parse_psmids`) and, if `fdr_threshold` is
+    given, only the PSMs with a q-value below the threshold. Chunks are filtered
+    before the PSMIds are parsed.
+    """
+    chunks = iter_pout(path, chunksize=chunksize)
+    while True:
+        with instrumentation.stage('load_pout') as stage:
+            df = next(chunks, None)
+            if df is None:
+                return
+            stage.rows += len(df)
+        df = df.rename(columns=POUT_COLUMN_RENAME)
+        if fdr_threshold is not None:
+            with instrumentation.stage('fdr_filter', rows=len(df)):
+                df = df[df['q-value'] < fdr_threshold].copy()
+        with instrumentation.stage('parse_psmids', rows=len(df)):
+            psmid_cols = parse_psmids(df['percolator_psmid'].astype(str), project_id)
+            for col in psmid_cols.columns:
+                df[col] = psmid_cols[col]
+        yield df
+
+
+def load_psms(path, project_id, fdr_threshold=None, chunksize=100000):
+    """
+    Read a full Percolator out (pout) file into a PSM table. See `iter_psms`.
+    """
+    chunks = iter_psms(path, project_id, fdr_threshold=fdr_threshold, chunksize=chunksize)
+    psms = pd.concat(chunks, axis=0, ignore_index=True)
+    psms['run'] = psms['run'].astype('category')
+    return psms
+
+
+def select_best_psms(df):
+    """
+    Keep only the best PSM (lowest q-value) per unique peptide (modified
+    peptide and charge). Ties are resolved by keeping the first PSM. The order
+    of the remaining PSMs is preserved.
+    """
+    order = np.argsort(df['q-value'].to_numpy(), kind='mergesort')
+    keep = ~df.iloc[order].duplicated(['modified_peptide', 'charge'], keep='first').to_numpy()
+    return df.iloc[np.sort(order[keep])]
+
+
+def reduce_best_psms(psm_chunks):
+    """
+    Select the best PSM per unique peptide (see `select_best_psms`) from an
+    iterable of PSM table chunks, keeping only a running table of the best
+    PSMs in memory. The result is identical to concatenating all chunks and
+    calling `select_best_psms`.
+    """
+    best = None
+    for chunk in psm_chunks:
+        with instrumentation.stage('dedup', rows=len(chunk)):
+            chunk = select_best_psms(chunk)
+            if best is not None:
+                chunk = select_best_psms(pd.concat([best, chunk], axis=0, ignore_index=True))
+            best = chunk.reset_index(drop=True)
+    if best is not None:
+        best['run'] = best['run'].astype('category')
+    return best
+
+
+class ModifiedPeptideParser:
+    """
+    Parse Percolator-style modified peptides (e.g. `K.M[UNIMOD:35]PEPTIDE.R`)
+    into a PEPREC-style sequence and modifications string.
+
+    Results are cached per unique modified peptide, so a parser can be shared
+    across runs and each modified peptide is only parsed once.
+
+    mod_mapping: dict, modification label (e.g. `UNIMOD:35`) -> modification
+      name (e.g. `Oxidation`). If None, the labels themselves are used as
+      names. Phosphorylation (`UNIMOD:21`) names get the modified residue
+      appended (e.g. `PhosphoS`).
+    """
+    def __init__(self, mod_mapping=None):
+        self.mod_mapping = mod_mapping
+        self._cache = {}
+
+    def __call__(self, modified_peptide):
+        """Return (sequence, modifications) for a modified peptide."""
+        try:
+            return self._cache[modified_peptide]
+        except KeyError:
+            result = self._parse(modified_peptide)
+            self._cache[modified_peptide] = result
+            return result
+
+    def _parse(self, modified_peptide):
+        # Remove leading and trailing amino acids
+        pep = modified_peptide
+        if len(pep) > 4 and pep[1] == '.' and pep[-2] == '.':
+            pep = pep[2:-2]
+
+        sequence = []
+        modifications = []
+        position = 0
+        residue = ''
+        for part in MOD_PATTERN.split(pep):
+            if part.startswith('['):
+                label = part[1:-1]
+                if self.mod_mapping is None:
+                    name = label
+                elif label in self.mod_mapping:
+                    name = self.mod_mapping[label]
+                    if label == 'UNIMOD:21':
+                        name += residue
+                else:
+                    logging.warning('Modification not expected: %s', part)
+                    continue
+                modifications.append('{}|{}'.format(position, name))
+            elif part:
+                sequence.append(part)
+                position += len(part)
+                residue = part[-1]
+        return ''.join(sequence), '|'.join(modifications)
+
+    def parse_series(self, modified_peptides):
+        """
+        Parse a Series of modified peptides. Returns a pandas.DataFrame with
+        `peptide` and `modifications` columns and the same index.
+        """
+        codes, uniques = pd.factorize(modified_peptides)
+        parsed = [self(modified_peptide) for modified_peptide in uniques]
+        peptides = np.array([p[0] for p in parsed] + [''], dtype=object)
+        modifications = np.array([p[1] for p in parsed] + [''], dtype=object)
+        return pd.DataFrame({
+            'peptide': peptides[codes],
+            'modifications': modifications[codes],
+        }, index=modified_peptides.index)
+
+
+_MODIFIED_PEPTIDE_PARSERS = {}
+
+
+def get_modified_peptide_parser(mod_mapping=None):
+    """
+    Return a shared ModifiedPeptideParser for the given modification mapping.
+    """
+    key = tuple(sorted(mod_mapping.items())) if mod_mapping is not None else None
+    if key not in _MODIFIED_PEPTIDE_PARSERS:
+        _MODIFIED_PEPTIDE_PARSERS[key] = ModifiedPeptideParser(mod_mapping)
+    return _MODIFIED_PEPTIDE_PARSERS[key]
+
+
 def extract_seq_mods(df, mods):
     """
     Extract PEPREC-style modifications and sequence from Percolator-
     style peptide notation.
     """
 
-    # Add modifications column to PEPREC file
+    # Map modification labels to the names of the modifications
     # the keys correspond to the UNIMOD keys for each modification
-    modifications = {}
+    mod_mapping = {}
     for mod in mods:
-        modifications[str(mod["unimod_accession"])] = mod["name"]
-
-    modlist = []
-    # TODO get rid of iterrows!
-    for _, row in df.iterrows():
-        if 'UNIMOD' in row['modified_peptide']:
-            pep = row['modified_peptide'].split('.')[1]
-            mods = re.findall(r'\[([^]]*)\]', pep)
-            modstring = ''
-            for mod in mods:
-                mod = '[' + mod + ']'
-                key = mod.split(':')[1].rstrip(']')
-                try:
-                    if key == '21':
-                        phospholoc = pep[pep.find(mod)-1]
-                        modstring += str(pep.find(mod)) + '|' + modifications[key] + phospholoc + '|'
-                        pep = pep.replace(mod, '', 1)
-                    else:
-                        modstring += str(pep.find(mod)) + '|' + modifications[key] + '|'
-                        pep = pep.replace(mod, '', 1)
-                except:
-                    print('Modification not expected: {}'.format(mod))
-            modlist.append(modstring.rstrip('|'))
-        else:
-            modlist.append('')
-    
-    # Rewrite peptide sequences without the UNIMOD modification ids
-    peplist = []
-    for _, row in df.iterrows():
-        pep = row['modified_peptide']
-        pep = pep.split('.')[1]
-        if 'UNIMOD' in pep:
-            mods = re.findall(r'\[([^]]*)\]', pep)
-            for mod in mods:
-                pep = pep.replace('[' + mod + ']', '', 1)
-        peplist.append(pep)
-
-    df_out = pd.DataFrame({'peptide': peplist, 'modifications': modlist})
-    return df_out
+        mod_mapping['UNIMOD:' + str(mod["unimod_accession"])] = mod["name"]
+
+    parser = get_modified_peptide_parser(mod_mapping)
+    return parser.parse_series(df['modified_peptide'])
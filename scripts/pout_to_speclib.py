@@ -26,8 +26,11 @@ from glob import glob
 import pandas as pd
 
 # Project
+import instrumentation
 import percolator_tools
-from parse_mgf import parse_mgf
+from speclib_builder import write_speclib, build_cached_shards, merge_shards
+from peak_processing import add_peak_processing_arguments, get_peak_processing
+from compression import COMPRESSION_SUFFIXES
 
 
 def argument_parser():
@@ -56,6 +59,30 @@ def argument_parser():
     parser.add_argument('-a', dest='all_spectra', action='store_true',
                         help='Do not filter for unique peptides (sequence,\
                         charge, modifications): include all spectra.')
+    parser.add_argument('-j', dest='workers', action='store',
+                        default=1, type=int,
+                        help='Number of processes to use for extracting\
+                        spectra from MGF files (default: 1).')
+    parser.add_argument('-b', dest='binary', action='store_true',
+                        help='Also write the spectral library in the binary,\
+                        memory-mappable format (spectral_library.speclib).')
+    parser.add_argument('-s', dest='shard_dir', action='store', default=None,
+                        help='Build the library incrementally: cache filtered\
+                        PSMs and spectra per run in this directory and only\
+                        rebuild runs of which the pout or MGF file changed.')
+    parser.add_argument('-z', dest='compression', action='store',
+                        default=None, choices=list(COMPRESSION_SUFFIXES),
+                        help='Compress the spectral library MGF and PEPREC\
+                        files (default: no compression).')
+    parser.add_argument('--report', dest='report_file', action='store',
+                        default=None,
+                        help='Write timing and memory usage per stage to this\
+                        JSON lines file.')
+    parser.add_argument('--log-level', dest='log_level', action='store',
+                        default='INFO',
+                        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                        help='Logging level (default: INFO).')
+    add_peak_processing_arguments(parser)
     args = parser.parse_args()
 
     return args
@@ -63,60 +90,52 @@ def argument_parser():
 
 def main():
     args = argument_parser()
+    instrumentation.configure_logging(args.log_level)
 
     # Read JSON file with modifications:
     with open(args.mods_config_file) as json_file:  
         mods = json.load(json_file)['modifications']
     
-    # Fix protein column in pout files
-    for f in glob(os.path.join(args.pout_path, '*.pout')):
-        percolator_tools.fix_pin_tabs(f)
-
-    # Load all pout_fixed files
-    all_pout_f = glob(os.path.join(args.pout_path, '*.pout_fixed'))
-    to_concat = []
-    for f in all_pout_f:
-        df = pd.read_csv(f, sep='\t')
-        #df['run'] = os.path.basename(f).split('.')[0]
-        to_concat.append(df)
-    all_pout = pd.concat(to_concat, axis=0)
-
-    col_rename = {'peptide': 'modified_peptide', 'proteinIds': 'proteins', 'PSMId': 'percolator_psmid'}
-    all_pout = all_pout.rename(columns=col_rename)
-
-    # Parse required columns
-    all_pout['usi'] = all_pout['percolator_psmid'].apply(lambda x: percolator_tools.psmid_to_usi(x, args.project_id))
-    all_pout['run'] = all_pout['percolator_psmid'].apply(percolator_tools.psmid_to_run)
-    all_pout['scan_number'] = all_pout['percolator_psmid'].apply(percolator_tools.psmid_to_scan)
-    all_pout['charge'] = all_pout['percolator_psmid'].apply(percolator_tools.psmid_to_charge)
-
-    # Filter on FDR threshold
-    all_pout = all_pout[all_pout['q-value'] < args.fdr_threshold].copy()
-
-    # Filter for best spectrum per peptide
-    if not args.all_spectra:
-        all_pout = all_pout.sort_values('q-value', ascending=True)
-        all_pout = all_pout[~all_pout.duplicated(['modified_peptide', 'charge'], keep='first')].copy()
-        all_pout = all_pout.sort_index().reset_index(drop=True)
-
-    # Extract peptide and modifications out of modified_peptide column
-    peprec_cols = percolator_tools.extract_seq_mods(all_pout, mods)
-    all_pout = pd.concat([all_pout, peprec_cols], axis=1)
-
-    # Parse all MGF files into one MGF with selected spectra
-    parse_mgf(all_pout, args.mgf_path, outname=os.path.join(args.output_path + '/spectral_library.mgf'),
-              filename_col='run', spec_title_col='scan_number',
-              title_parsing_method='scan=', new_title_col='usi',
-              show_progress_bar=False)
-
-    # Create MS2PIP PEPREC (peptide record)
-    peprec_cols = [
-        'usi', 'modifications', 'peptide', 'charge',
-        'proteins', 'score', 'q-value',
-        'posterior_error_prob', 'run', 'scan_number'
-    ] 
-    peprec = all_pout[peprec_cols].rename(columns={'usi': 'spec_id'}).sort_values('scan_number')
-    peprec.to_csv(os.path.join(args.output_path + '/spectral_library.peprec'), sep=' ', index=False)
+    all_pout_f = sorted(glob(os.path.join(args.pout_path, '*.pout')))
+    peak_processing = get_peak_processing(args)
+
+    # Incremental build: per-run shards, merged into the final library
+    if args.shard_dir:
+        shard_prefixes = build_cached_shards(
+            all_pout_f, args.mgf_path, args.shard_dir, args.project_id,
+            fdr_threshold=args.fdr_threshold, all_spectra=args.all_spectra,
+            workers=args.workers, peak_processing=peak_processing
+        )
+        merge_shards(
+            shard_prefixes, mods, args.output_path,
+            all_spectra=args.all_spectra, workers=args.workers, binary=args.binary,
+            compression=args.compression
+        )
+        instrumentation.write_report(args.report_file, job='pout_to_speclib')
+        return
+
+    # Stream all pout files and filter on FDR threshold
+    psm_chunks = (
+        chunk for f in all_pout_f
+        for chunk in percolator_tools.iter_psms(f, args.project_id, fdr_threshold=args.fdr_threshold)
+    )
+
+    # Filter for best spectrum per peptide, keeping only the running best PSMs
+    # in memory
+    if args.all_spectra:
+        all_pout = pd.concat(psm_chunks, axis=0, ignore_index=True)
+        all_pout['run'] = all_pout['run'].astype('category')
+    else:
+        all_pout = percolator_tools.reduce_best_psms(psm_chunks)
+
+    write_speclib(
+        all_pout, mods, args.output_path, args.mgf_path,
+        workers=args.workers, binary=args.binary, compression=args.compression,
+        filename_col='run', spec_title_col='scan_number',
+        title_parsing_method='scan=', new_title_col='usi',
+        peak_processing=peak_processing
+    )
+    instrumentation.write_report(args.report_file, job='pout_to_speclib')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,283 @@
+"""
+Precursor m/z index
+
+Sidecar index for a (spectral library) MGF file that holds the precursor m/z,
+charge and byte offset of each spectrum, sorted by charge and precursor m/z.
+All spectra within a precursor tolerance window are found with a binary search,
+after which only the matching spectra are read from the memory-mapped MGF
+file.
+
+The index is written next to the MGF file as `<mgf_file>.pidx`:
+```
+magic (8 bytes) | header length (uint64, little endian) | JSON header | entries
+```
+The JSON header holds the size and modification time of the MGF file (to detect
+outdated indices) and, per charge state, the range of entries with that charge.
+Entries are a NumPy structured array (`ENTRY_DTYPE`), starting at a 64-byte
+aligned offset, so the index is used as a zero-copy view on the memory-mapped
+file. Spectra without (known) charge are stored with charge 0.
+
+Example:
+```
+with PrecursorIndex('speclib/spectral_library.mgf') as index:
+    for spectrum in index.query(652.8421, 10, charge=2):
+        print(spectrum.title, len(spectrum.mz))
+```
+
+Usage:
+```
+python3 scripts/precursor_index.py speclib/spectral_library.mgf
+```
+"""
+
+# Standard library
+import os
+import json
+import mmap
+import struct
+import logging
+import argparse
+from collections import namedtuple
+
+# Third party
+import numpy as np
+
+# Project
+import instrumentation
+from compression import is_compressed
+from mgf_index import scan_mgf, read_block_header
+from peak_processing import parse_peak_lines
+
+
+INDEX_SUFFIX = '.pidx'
+INDEX_VERSION = 1
+MAGIC = b'PXDPIDX1'
+ALIGNMENT = 64
+
+ENTRY_DTYPE = np.dtype([
+    ('precursor_mz', '<f8'),
+    ('offset', '<i8'),
+    ('length', '<i8'),
+])
+
+Spectrum = namedtuple(
+    'Spectrum', ['title', 'precursor_mz', 'charge', 'header', 'mz', 'intensity']
+)
+
+
+def argument_parser():
+    parser = argparse.ArgumentParser(description='Build precursor m/z index\
+        for (spectral library) MGF files.')
+    parser.add_argument('mgf_files', action='store', nargs='+',
+                        help='MGF files to index.')
+    args = parser.parse_args()
+    return args
+
+
+def get_index_path(mgf_path):
+    """
+    Return path of precursor index file for a given MGF file.
+    """
+    return mgf_path + INDEX_SUFFIX
+
+
+def _file_signature(mgf_path):
+    stat = os.stat(mgf_path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def _parse_charge(charge):
+    """
+    Parse MGF CHARGE value (e.g. `2+`, or `2+ and 3+`, of which the first is
+    used) into an int, or 0 if unknown.
+    """
+    charge = charge.split(' ')[0].strip().rstrip('+-')
+    return int(charge) if charge.isdigit() else 0
+
+
+def write_precursor_index(mgf_path, index_path=None):
+    """
+    Scan MGF file and write its precursor index. Return the number of spectra
+    indexed.
+    """
+    if is_compressed(mgf_path):
+        raise ValueError("Cannot index compressed MGF file {}: spectra can not \
+be read by offset".format(mgf_path))
+    if not index_path:
+        index_path = get_index_path(mgf_path)
+
+    precursor_mz = []
+    charges = []
+    offsets = []
+    lengths = []
+    for entry in scan_mgf(mgf_path):
+        precursor_mz.append(float(entry.pepmass) if entry.pepmass else np.nan)
+        charges.append(_parse_charge(entry.charge))
+        offsets.append(entry.offset)
+        lengths.append(entry.length)
+
+    entries = np.zeros(len(offsets), dtype=ENTRY_DTYPE)
+    entries['precursor_mz'] = precursor_mz
+    entries['offset'] = offsets
+    entries['length'] = lengths
+
+    # Sort by charge, then precursor m/z (spectra without PEPMASS last)
+    charges = np.array(charges, dtype=np.int64)
+    order = np.lexsort((entries['precursor_mz'], charges))
+    entries = entries[order]
+    charges = charges[order]
+    charge_values, starts = np.unique(charges, return_index=True)
+    stops = list(starts[1:]) + [len(charges)]
+    charge_ranges = {
+        str(charge): [int(start), int(stop)]
+        for charge, start, stop in zip(charge_values, starts, stops)
+    }
+
+    header = json.dumps({
+        'version': INDEX_VERSION,
+        'mgf_signature': _file_signature(mgf_path),
+        'n_spectra': len(entries),
+        'charges': charge_ranges,
+    }).encode('utf-8')
+
+    tmp_path = index_path + '.tmp'
+    with open(tmp_path, 'wb') as out:
+        out.write(MAGIC)
+        out.write(struct.pack('<Q', len(header)))
+        out.write(header)
+        out.write(b'\x00' * (-out.tell() % ALIGNMENT))
+        out.write(entries.tobytes())
+    os.replace(tmp_path, index_path)
+    return len(entries)
+
+
+class PrecursorIndex:
+    """
+    Read-only precursor m/z index of an MGF file, with the index and the MGF
+    file memory-mapped.
+    """
+    def __init__(self, mgf_path, index_path=None):
+        self.mgf_path = mgf_path
+        self.index_path = index_path or get_index_path(mgf_path)
+        with open(self.index_path, 'rb') as f:
+            magic = f.read(len(MAGIC))
+            if magic != MAGIC:
+                raise ValueError("{} is not a precursor index".format(self.index_path))
+            header_length, = struct.unpack('<Q', f.read(8))
+            self.header = json.loads(f.read(header_length).decode('utf-8'))
+        if self.header['mgf_signature'] != _file_signature(mgf_path):
+            raise ValueError("Precursor index {} is outdated for {}".format(
+                self.index_path, mgf_path
+            ))
+        data_start = len(MAGIC) + 8 + header_length
+        data_start += -data_start % ALIGNMENT
+
+        if self.header['n_spectra']:
+            self.entries = np.memmap(
+                self.index_path, dtype=ENTRY_DTYPE, mode='r', offset=data_start,
+                shape=(self.header['n_spectra'],)
+            )
+        else:
+            self.entries = np.zeros(0, dtype=ENTRY_DTYPE)
+        self._precursor_mz = self.entries['precursor_mz']
+        self.charge_ranges = {
+            int(charge): tuple(bounds) for charge, bounds in self.header['charges'].items()
+        }
+
+        self._mgf_file = open(mgf_path, 'rb')
+        self._buffer = None
+        if os.fstat(self._mgf_file.fileno()).st_size > 0:
+            self._buffer = mmap.mmap(self._mgf_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return self.header['n_spectra']
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Release the memory-mapped files."""
+        self.entries = None
+        self._precursor_mz = None
+        if self._buffer is not None:
+            self._buffer.close()
+            self._buffer = None
+        self._mgf_file.close()
+
+    @property
+    def charges(self):
+        """Charge states in the index (0: unknown charge)."""
+        return sorted(self.charge_ranges)
+
+    def charge_of(self, i):
+        """Return charge of index entry `i`."""
+        for charge, (start, stop) in self.charge_ranges.items():
+            if start <= i < stop:
+                return charge
+        raise IndexError(i)
+
+    def search(self, mz, tol_ppm, charge=None):
+        """
+        Return positions (NumPy int64 array) of all index entries with a
+        precursor m/z within `tol_ppm` of `mz`, sorted by charge and precursor
+        m/z. With `charge` None, all charge states are searched.
+        """
+        tolerance = mz * tol_ppm * 1e-6
+        charges = self.charges if charge is None else [charge]
+        hits = []
+        for c in charges:
+            if c not in self.charge_ranges:
+                continue
+            start, stop = self.charge_ranges[c]
+            precursor_mz = self._precursor_mz[start:stop]
+            low = np.searchsorted(precursor_mz, mz - tolerance, side='left')
+            high = np.searchsorted(precursor_mz, mz + tolerance, side='right')
+            if high > low:
+                hits.append(np.arange(start + low, start + high, dtype=np.int64))
+        if not hits:
+            return np.array([], dtype=np.int64)
+        return np.concatenate(hits) if len(hits) > 1 else hits[0]
+
+    def read_spectrum(self, i):
+        """Read spectrum of index entry `i` from the MGF file."""
+        entry = self.entries[i]
+        offset, length = int(entry['offset']), int(entry['length'])
+        header = read_block_header(self._buffer, offset, length)
+        lines = self._buffer[offset:offset + length].decode('utf-8').splitlines(True)
+        peak_lines = [line for line in lines if line[:1].isdigit()]
+        if peak_lines:
+            mz, intensity = parse_peak_lines(peak_lines)
+        else:
+            mz, intensity = np.array([], dtype=np.float64), np.array([], dtype=np.float64)
+        return Spectrum(
+            title=header.get('TITLE', ''),
+            precursor_mz=float(entry['precursor_mz']),
+            charge=self.charge_of(i),
+            header=header,
+            mz=mz,
+            intensity=intensity,
+        )
+
+    def query(self, mz, tol_ppm, charge=None):
+        """
+        Yield all spectra (Spectrum namedtuples) with a precursor m/z within
+        `tol_ppm` of `mz` and, unless None, the given `charge`. Spectra are
+        only read from the MGF file as the generator is consumed.
+        """
+        for i in self.search(mz, tol_ppm, charge=charge):
+            yield self.read_spectrum(i)
+
+
+def main():
+    instrumentation.configure_logging()
+    args = argument_parser()
+    for mgf_path in args.mgf_files:
+        n_spectra = write_precursor_index(mgf_path)
+        logging.info("%i spectra indexed in %s", n_spectra, get_index_path(mgf_path))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+"""
+PRIDE Archive file listings
+
+Retrieve the list of files of a PRIDE Archive project, cached on disk per PXD
+identifier. Only the standard library is used, so this module can be imported
+at Snakemake parse time without pulling in pandas or requests.
+
+The cached listing is used as long as it is younger than the given time to live
+(TTL), and as a fallback when the PRIDE Archive API cannot be reached.
+"""
+
+import os
+import re
+import json
+import time
+import logging
+from urllib.request import urlopen
+from collections import OrderedDict
+
+
+PROJECT_URL = "https://www.ebi.ac.uk:443/pride/ws/archive/project/{}"
+FILES_URL = "https://www.ebi.ac.uk:443/pride/ws/archive/file/list/project/{}"
+CACHE_DIR = ".pride_cache"
+DEFAULT_TTL = 24 * 3600
+
+_RUNS = {}
+
+
+def _get_json(url, timeout=60):
+    with urlopen(url, timeout=timeout) as response:
+        return json.loads(response.read().decode('utf-8'))
+
+
+def get_cache_path(pxd_identifier, cache_dir=CACHE_DIR):
+    """Return path of cached file listing for a PXD identifier."""
+    return os.path.join(cache_dir, "{}.files.json".format(pxd_identifier))
+
+
+def fetch_file_list(pxd_identifier):
+    """
+    Get file listing for a PXD identifier from the PRIDE Archive API. Raise
+    ValueError if the project cannot be accessed.
+    """
+    project = _get_json(PROJECT_URL.format(pxd_identifier))
+    if "accession" not in project:
+        raise ValueError("Could not access data for PXD ID '{}'".format(pxd_identifier))
+    return _get_json(FILES_URL.format(pxd_identifier))['list']
+
+
+def get_file_list(pxd_identifier, cache_dir=CACHE_DIR, ttl=DEFAULT_TTL, refresh=False):
+    """
+    Get file listing (list of dicts, as returned by the PRIDE Archive API) for a
+    PXD identifier, using the on-disk cache if it is younger than `ttl` seconds.
+    With `refresh`, the listing is always fetched again. If the API cannot be
+    reached, an outdated cached listing is used instead.
+    """
+    cache_path = get_cache_path(pxd_identifier, cache_dir=cache_dir)
+    cached = None
+    if os.path.isfile(cache_path):
+        with open(cache_path, 'rt') as f:
+            cached = json.load(f)
+        if not refresh and time.time() - cached['fetched'] < ttl:
+            return cached['list']
+
+    try:
+        file_list = fetch_file_list(pxd_identifier)
+    except (OSError, ValueError) as e:
+        if cached is None:
+            raise
+        logging.warning(
+            "Could not retrieve file list for %s (%s), using cached file list from %s",
+            pxd_identifier, e, time.ctime(cached['fetched'])
+        )
+        return cached['list']
+
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(cache_path + '.tmp', 'wt') as f:
+        json.dump({'fetched': time.time(), 'list': file_list}, f)
+    os.replace(cache_path + '.tmp', cache_path)
+    return file_list
+
+
+def filter_file_list(file_list, filetypes=None, pattern=None):
+    """
+    Filter file listing by file extension (case insensitive) and filename regex
+    pattern.
+    """
+    if pattern:
+        regex = re.compile(pattern)
+        file_list = [f for f in file_list if regex.search(f['fileName'])]
+    if filetypes:
+        filetypes = {ext.lower() for ext in filetypes}
+        file_list = [
+            f for f in file_list if f['fileName'].split('.')[-1].lower() in filetypes
+        ]
+    return file_list
+
+
+def get_run_files(pxd_identifier, extensions, file_pattern, cache_dir=CACHE_DIR,
+                  ttl=DEFAULT_TTL, refresh=False):
+    """
+    Get dict of run name (filename without extension) to file listing entry for
+    all files with the given extensions that match the filename pattern, in
+    the order of the PRIDE file listing. Resolved only once per process.
+    """
+    key = (pxd_identifier, tuple(extensions), file_pattern, cache_dir)
+    if key not in _RUNS:
+        file_list = filter_file_list(
+            get_file_list(pxd_identifier, cache_dir=cache_dir, ttl=ttl, refresh=refresh),
+            extensions, file_pattern
+        )
+        extension_regex = re.compile(
+            r'\.(' + '|'.join(map(re.escape, extensions)) + r')$', flags=re.IGNORECASE
+        )
+        _RUNS[key] = OrderedDict(
+            (extension_regex.sub('', f['fileName']), f) for f in file_list
+        )
+    return _RUNS[key]
+
+
+def get_runs(pxd_identifier, extensions, file_pattern, cache_dir=CACHE_DIR,
+             ttl=DEFAULT_TTL, refresh=False):
+    """
+    Get run names (filenames without extension) for all files with the given
+    extensions that match the filename pattern.
+    """
+    return list(get_run_files(
+        pxd_identifier, extensions, file_pattern, cache_dir=cache_dir, ttl=ttl,
+        refresh=refresh
+    ))
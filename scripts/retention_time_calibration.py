@@ -1,26 +1,118 @@
 from glob import glob
-from typing import Dict, Tuple, Union, List
+from typing import Dict, Set, Union, List
+from collections.abc import MutableMapping
+from concurrent.futures import ProcessPoolExecutor
 import argparse
-import csv
 import logging
-import operator
 import os
-import re
 import json
 
-from pyteomics import mgf
 import numpy as np
 import pandas as pd
+from pandas.api.types import union_categoricals
 import spectrum_utils.spectrum as sus
 
+import instrumentation
+from compression import COMPRESSION_SUFFIXES, resolve_path, strip_suffix
+from mgf_index import read_retention_times
+from percolator_tools import get_modified_peptide_parser, read_pout
+from rt_alignment import CALIBRATION_MODELS, align_runs, calibrate_runs
+
+
+PSM_COLUMNS = ["scan", "sequence", "modifications", "retention_time", "q_value", "score"]
+PSM_DTYPES = {
+    "scan": np.uint32,
+    "sequence": "category",
+    "modifications": "category",
+    "retention_time": np.float32,
+    "q_value": np.float32,
+    "score": np.float32,
+}
+CATEGORICAL_COLUMNS = ["sequence", "modifications"]
+ALIGNMENT_METHODS = ["shared", "tree"]
+
+
+def read_pout_table(
+    pout_filename: str,
+    search_engine: str = "msgfplus",
+    mod_mapping: Union[Dict, None] = None,
+) -> pd.DataFrame:
+    """
+    Read PSMs from pout file into a pandas.DataFrame with typed columns.
+
+    Columns: `scan` (uint32), `sequence` and `modifications` (categorical),
+    `q_value` and `score` (float32). PSMs are identified by scan number: only
+    the last PSM for each scan is kept.
+    """
+    if search_engine != "msgfplus":
+        raise ValueError("Unsupported search engine (supported: msgfplus)")
+
+    pout = read_pout(pout_filename)
+    parsed = get_modified_peptide_parser(mod_mapping).parse_series(pout["peptide"])
+    psms = pd.DataFrame(
+        {
+            "scan": pout["PSMId"].str.rsplit("_", n=3).str[1].astype(np.uint32),
+            "sequence": parsed["peptide"].astype("category"),
+            "modifications": parsed["modifications"].astype("category"),
+            "q_value": pout["q-value"].astype(np.float32),
+            "score": pout["score"].astype(np.float32),
+        }
+    )
+    return psms.drop_duplicates("scan", keep="last").reset_index(drop=True)
+
+
+def merge_retention_times(
+    psms: pd.DataFrame, scans: np.ndarray, retention_times: np.ndarray
+) -> pd.DataFrame:
+    """
+    Add `retention_time` column (float32) to PSMs, joined on scan number. PSMs
+    without spectrum in `scans` get a missing retention time.
+    """
+    spectra = pd.DataFrame(
+        {
+            "scan": scans.astype(np.uint32),
+            "retention_time": retention_times.astype(np.float32),
+        }
+    ).drop_duplicates("scan", keep="last")
+    psms = psms.merge(spectra, on="scan", how="left")
+    return psms[PSM_COLUMNS]
+
+
+def _read_run_psms(
+    pout_filename: str,
+    mgf_filename: str,
+    mod_mapping: Union[Dict, None] = None,
+    search_engine: str = "msgfplus",
+    workers: int = 1,
+) -> pd.DataFrame:
+    """Read PSMs of one run with retention times from its pout and MGF file."""
+    with instrumentation.stage("load_pout") as stage:
+        psms = read_pout_table(
+            pout_filename, search_engine=search_engine, mod_mapping=mod_mapping
+        )
+        stage.rows += len(psms)
+    with instrumentation.stage("read_retention_times") as stage:
+        scans, retention_times = read_retention_times(mgf_filename, workers=workers)
+        stage.rows += len(scans)
+    return merge_retention_times(psms, scans, retention_times)
+
 
 class PeptideSpectrumMatch:
-    """Peptide spectrum match (PSM)."""
+    """
+    Peptide spectrum match (PSM).
+
+    Lightweight record of one PSM. PSMs obtained by iterating over or indexing
+    a PSMTable are copies; PSMs obtained through `Run.peptide_spectrum_matches`
+    write changes back to the run's table.
+    """
+
+    __slots__ = ("scan", "sequence", "modifications", "retention_time", "q_value", "score")
+
     def __init__(
         self,
         scan: Union[int, None] = None,
         sequence: Union[str, None] = None,
-        modifications: Dict = dict(),
+        modifications: Union[str, None] = None,
         retention_time: Union[float, None] = None,
         q_value: Union[float, None] = None,
         score: Union[float, None] = None,
@@ -41,36 +133,186 @@ score={self.score})"
     def add_pout_modified_sequence(
         self, modified_sequence: str, mod_mapping: Union[Dict, None] = None
     ):
-        # Remove leading and trailing amino acids
-        if "." in modified_sequence:
-            modified_sequence = modified_sequence.split(".")[1]
-
-        # Get all mod labels, locations in original string and label lengths
-        mod_pattern = r"\[([^]]*)\]"
-        mod_strings = re.findall(mod_pattern, modified_sequence)
-        if mod_strings:
-            mod_label_locations, mod_label_lengths = zip(
-                *[
-                    (m.start(0), m.end(0) - m.start(0))
-                    for m in re.finditer(mod_pattern, modified_sequence)
-                ]
-            )
-
-            # Substract length of modification labels to get actual mod locations
-            mod_locations = np.array(mod_label_locations) - np.cumsum(
-                [0] + list(mod_label_lengths)[:-1]
-            )
+        """Set sequence and modifications from a Percolator-style modified peptide."""
+        parser = get_modified_peptide_parser(mod_mapping)
+        self.sequence, self.modifications = parser(modified_sequence)
+
+
+class _TablePeptideSpectrumMatch(PeptideSpectrumMatch):
+    """
+    PeptideSpectrumMatch of a row in a PSMTable (see PSMMapping). Changes to
+    its attributes are written to the table; the scan number is read-only.
+    """
+
+    __slots__ = ("_table",)
+
+    def __init__(self, table: "PSMTable", *values):
+        object.__setattr__(self, "_table", None)
+        super().__init__(*values)
+        object.__setattr__(self, "_table", table)
+
+    def __setattr__(self, name, value):
+        if self._table is not None:
+            if name == "scan":
+                raise AttributeError("scan of a PSM in a PSMTable can not be changed")
+            self._table.set_value(self.scan, name, value)
+        object.__setattr__(self, name, value)
+
+
+class PSMTable:
+    """
+    Column-wise store of the PSMs of one run, with at most one PSM per scan.
+
+    Each attribute of PeptideSpectrumMatch is one typed column (see
+    PSM_DTYPES) of the underlying pandas.DataFrame, `data`.
+    """
+
+    def __init__(self, data: Union[pd.DataFrame, None] = None):
+        if data is None:
+            data = pd.DataFrame(columns=PSM_COLUMNS)
+        self.data = self._typed(data)
+
+    @property
+    def data(self) -> pd.DataFrame:
+        return self._data
+
+    @data.setter
+    def data(self, data: pd.DataFrame):
+        self._data = data
+        self._scan_index = None
+
+    def position(self, scan: int) -> int:
+        """Return row position of the PSM with scan number `scan` (KeyError if absent)."""
+        if self._scan_index is None:
+            self._scan_index = pd.Index(self._data["scan"])
+        return self._scan_index.get_loc(scan)
+
+    def set_value(self, scan: int, column: str, value):
+        """Set value of `column` for the PSM with scan number `scan`."""
+        position = self.position(scan)
+        values = self._data[column]
+        if column in CATEGORICAL_COLUMNS and pd.notna(value) and value not in values.cat.categories:
+            self._data[column] = values.cat.add_categories([value])
+        self._data.iloc[position, self._data.columns.get_loc(column)] = value
+
+    @staticmethod
+    def _typed(data: pd.DataFrame) -> pd.DataFrame:
+        """Return DataFrame with all PSM columns, in order and with PSM_DTYPES."""
+        data = data.reindex(columns=PSM_COLUMNS).reset_index(drop=True)
+        return data.astype(PSM_DTYPES)
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def __iter__(self):
+        for row in self.data.itertuples(index=False, name=None):
+            yield PeptideSpectrumMatch(*row)
+
+    def __getitem__(self, i: int) -> PeptideSpectrumMatch:
+        return PeptideSpectrumMatch(*self.data.iloc[i])
+
+    def update(self, psms: pd.DataFrame, add_new: bool = True):
+        """
+        Set values of PSMs by scan number from a DataFrame with a `scan` column
+        and any other PSM columns. For duplicate scans, the last row is used.
+        PSMs for scans that are not yet in the table are appended if `add_new`.
+        """
+        psms = psms.drop_duplicates("scan", keep="last")
+        if not len(self):
+            if add_new:
+                self.data = self._typed(psms)
+            return
+
+        positions = pd.Index(self.data["scan"]).get_indexer(psms["scan"])
+        found = positions >= 0
+        data = self.data.copy()
+        for column in psms.columns.drop("scan"):
+            values = data[column].astype(object) if column in CATEGORICAL_COLUMNS else data[column]
+            values = values.to_numpy(copy=True)
+            values[positions[found]] = psms[column].to_numpy()[found]
+            data[column] = values
+        if add_new and not found.all():
+            data = pd.concat([data, psms[~found]], ignore_index=True)
+        self.data = self._typed(data)
+
+    def remove(self, scan: int):
+        """Remove the PSM with scan number `scan`."""
+        self.data = self._data.drop(index=self._data.index[self.position(scan)]).reset_index(drop=True)
+
+    def fraction_missing(self, column: str) -> float:
+        """Return fraction of PSMs without (or with a zero) value in `column`."""
+        values = self.data[column]
+        return float((values.isna() | (values == 0)).sum() / len(values))
+
+    def best_psms(self) -> "PSMTable":
+        """
+        Return table with the PSM with the lowest q-value for each unique
+        peptide-modification combination. For ties, the first PSM is kept.
+        """
+        order = np.argsort(self.data["q_value"].to_numpy(), kind="mergesort")
+        best = (
+            self.data.iloc[order]
+            .drop_duplicates(["sequence", "modifications"], keep="first")
+            .sort_index()
+        )
+        return PSMTable(best)
 
-            if mod_mapping:
-                mod_strings = [mod_mapping[ms] for ms in mod_strings]
-        else:
-            mod_locations, mod_strings = [], []
+    def to_dataframe(self) -> pd.DataFrame:
+        """Return copy of all PSMs as a pandas.DataFrame."""
+        return self.data.copy()
 
-        # Construct PEPREC modifications string
-        self.modifications = "|".join(
-            ["|".join([str(ml), ms]) for ml, ms in zip(mod_locations, mod_strings)]
+    @staticmethod
+    def concat(tables: List["PSMTable"], run_names: List[str]) -> pd.DataFrame:
+        """
+        Concatenate PSM tables of multiple runs into one DataFrame, with an
+        added categorical `run` column. Categorical columns remain categorical.
+        """
+        if not tables:
+            return pd.DataFrame(columns=PSM_COLUMNS + ["run"]).astype(PSM_DTYPES)
+        df = pd.concat([table.data for table in tables], axis=0, ignore_index=True)
+        for column in CATEGORICAL_COLUMNS:
+            df[column] = union_categoricals([table.data[column] for table in tables])
+        df["run"] = pd.Categorical.from_codes(
+            np.repeat(np.arange(len(tables)), [len(table) for table in tables]),
+            categories=run_names,
         )
-        self.sequence = re.sub(mod_pattern, "", modified_sequence)
+        return df
+
+
+class PSMMapping(MutableMapping):
+    """
+    Dict-like view of a PSMTable: PeptideSpectrumMatch objects by scan number.
+    Setting or deleting items, and setting attributes of the returned PSMs,
+    changes the table.
+    """
+
+    def __init__(self, table: PSMTable):
+        self.table = table
+
+    def __getitem__(self, scan: int) -> PeptideSpectrumMatch:
+        row = self.table.data.iloc[self.table.position(scan)]
+        return _TablePeptideSpectrumMatch(self.table, *row)
+
+    def __setitem__(self, scan: int, psm: PeptideSpectrumMatch):
+        values = {column: [getattr(psm, column)] for column in PSM_COLUMNS}
+        values["scan"] = [scan]
+        self.table.update(PSMTable._typed(pd.DataFrame(values)))
+
+    def __delitem__(self, scan: int):
+        self.table.remove(scan)
+
+    def __iter__(self):
+        return iter(self.table.data["scan"].tolist())
+
+    def __len__(self) -> int:
+        return len(self.table)
+
+    def __contains__(self, scan) -> bool:
+        try:
+            self.table.position(scan)
+        except KeyError:
+            return False
+        return True
 
 
 class Run:
@@ -81,38 +323,75 @@ class Run:
         self.run_name = run_name
         self.mgf_dir = mgf_dir
         self.pout_dir = pout_dir
-        self.peptide_spectrum_matches = dict()
+        self.psms = PSMTable()
+
+    @property
+    def peptide_spectrum_matches(self) -> PSMMapping:
+        """PSMs by scan number, as a mutable mapping backed by `psms`."""
+        return PSMMapping(self.psms)
+
+    @peptide_spectrum_matches.setter
+    def peptide_spectrum_matches(self, psms: Dict[int, PeptideSpectrumMatch]):
+        self.psms = PSMTable()
+        mapping = PSMMapping(self.psms)
+        for scan, psm in psms.items():
+            mapping[scan] = psm
 
     def get_pout_filename(self) -> str:
         """Return pout filename based on pout_dir and run_name."""
         return os.path.join(self.pout_dir, self.run_name + ".pout")
 
     def get_mgf_filename(self) -> str:
-        """Return mgf filename based on mgf_dir and run_name."""
-        return os.path.join(self.mgf_dir, self.run_name + ".mgf")
+        """
+        Return mgf filename based on mgf_dir and run_name (the gzip or zstd
+        compressed file if only that exists).
+        """
+        return resolve_path(os.path.join(self.mgf_dir, self.run_name + ".mgf"))
 
     def num_psms(self) -> int:
         """Get number of PSMs in run."""
-        return len(self.peptide_spectrum_matches)
+        return len(self.psms)
+
+    def read_psms(
+        self,
+        search_engine: str = "msgfplus",
+        mod_mapping: Union[Dict, None] = None,
+        workers: int = 1,
+    ) -> pd.DataFrame:
+        """
+        Read PSMs from pout file and their retention times from MGF file
+        (see `read_pout_table` and `merge_retention_times`).
+        """
+        self.psms = PSMTable(
+            _read_run_psms(
+                self.get_pout_filename(),
+                self.get_mgf_filename(),
+                mod_mapping=mod_mapping,
+                search_engine=search_engine,
+                workers=workers,
+            )
+        )
+        return self.psms.data
 
     def read_mgf(
-        self, mgf_filename: Union[str, None] = None, no_new_psms: bool = False
+        self,
+        mgf_filename: Union[str, None] = None,
+        no_new_psms: bool = False,
+        workers: int = 1,
     ):
-        """Read retention times from MGF file."""
+        """
+        Read retention times from MGF file.
+
+        Only spectrum headers are parsed; large files are scanned in parallel by
+        `workers` processes (see `mgf_index.read_retention_times`).
+        """
         if not mgf_filename:
             mgf_filename = self.get_mgf_filename()
-        with mgf.MGF(mgf_filename) as reader:
-            for spectrum in reader:
-                scan = int(spectrum["params"]["scans"])
-                retention_time = float(spectrum["params"]["rtinseconds"])
-                if scan not in self.peptide_spectrum_matches:
-                    if not no_new_psms:
-                        psm = PeptideSpectrumMatch(
-                            scan=scan, retention_time=retention_time
-                        )
-                        self.peptide_spectrum_matches[scan] = psm
-                else:
-                    self.peptide_spectrum_matches[scan].retention_time = retention_time
+        scans, retention_times = read_retention_times(mgf_filename, workers=workers)
+        self.psms.update(
+            pd.DataFrame({"scan": scans, "retention_time": retention_times}),
+            add_new=not no_new_psms,
+        )
 
     def read_pout(
         self,
@@ -124,90 +403,26 @@ class Run:
         """Read PSMs from pout file."""
         if not pout_filename:
             pout_filename = self.get_pout_filename()
-
-        with open(pout_filename, "rt") as csv_file:
-            reader = csv.DictReader(csv_file, delimiter="\t")
-            for line in reader:
-                psmid = line["PSMId"]
-                if search_engine == "msgfplus":
-                    scan = int(psmid.split("_")[-3])
-                else:
-                    raise ValueError("Unsupported search engine (supported: msgfplus)")
-
-                score = line["score"]
-                q_value = line["q-value"]
-                modified_sequence = line["peptide"]
-
-                if scan not in self.peptide_spectrum_matches:
-                    if not no_new_psms:
-                        psm = PeptideSpectrumMatch(
-                            scan=scan, score=score, q_value=q_value
-                        )
-                        psm.add_pout_modified_sequence(modified_sequence, mod_mapping)
-                        self.peptide_spectrum_matches[scan] = psm
-                else:
-                    self.peptide_spectrum_matches[scan].score = score
-                    self.peptide_spectrum_matches[scan].q_value = q_value
-                    self.peptide_spectrum_matches[scan].add_pout_modified_sequence(
-                        modified_sequence, mod_mapping
-                    )
+        psms = read_pout_table(
+            pout_filename, search_engine=search_engine, mod_mapping=mod_mapping
+        )
+        self.psms.update(psms, add_new=not no_new_psms)
 
     def get_fraction_missing_rt(self) -> float:
-        missing_rt = 0
-        total_psms = 0
-        for _, psm in self.peptide_spectrum_matches.items():
-            if not psm.retention_time:
-                missing_rt += 1
-            total_psms += 1
-
-        return missing_rt / total_psms
+        return self.psms.fraction_missing("retention_time")
 
-    def _min_val_key(self, dict_) -> str:
-        """Return key with min value in dict."""
-        return min(dict_.items(), key=operator.itemgetter(1))[0]
-
-    def get_best_psms(self) -> Dict[Tuple[str, str], int]:
+    def get_best_psms(self) -> Set[PeptideSpectrumMatch]:
         """Get best PSM for each unique peptide-modification combination."""
-        psm_dict = dict()
-        for _, psm in self.peptide_spectrum_matches.items():
-            if (psm.sequence, psm.modifications) not in psm_dict:
-                psm_dict[(psm.sequence, psm.modifications)] = {psm.scan: psm.q_value}
-            else:
-                psm_dict[(psm.sequence, psm.modifications)][psm.scan] = psm.q_value
-
-        best_psms = {
-            self.peptide_spectrum_matches[self._min_val_key(scans)]
-            for _, scans in psm_dict.items()
-        }
+        mapping = self.peptide_spectrum_matches
+        return {mapping[scan] for scan in self.psms.best_psms().data["scan"].tolist()}
 
-        return best_psms
+    def get_best_psm_table(self) -> PSMTable:
+        """Get table with the best PSM for each unique peptide-modification combination."""
+        return self.psms.best_psms()
 
-    # TODO: Needs optimization to read PSMs and immediatly go to dataframe, skipping
-    # PeptideSpectrumMatch objects
     def to_dataframe(self) -> pd.DataFrame:
         """Dump all PSMs into a pandas.DataFrame."""
-
-        idx = range(self.num_psms())
-        scans = pd.Series(name="scan", index=idx, dtype=np.uint32)
-        sequences = pd.Series(name="sequence", index=idx, dtype=object)
-        modifications = pd.Series(name="modifications", index=idx, dtype=object)
-        q_values = pd.Series(name="q_value", index=idx, dtype=np.float32)
-        scores = pd.Series(name="score", index=idx, dtype=np.float32)
-        retention_times = pd.Series(name="retention_time", index=idx, dtype=np.float32)
-
-        for idx, (_, psm) in enumerate(self.peptide_spectrum_matches.items()):
-            scans[idx] = psm.scan
-            sequences[idx] = psm.sequence
-            modifications[idx] = psm.modifications
-            retention_times[idx] = psm.retention_time
-            q_values[idx] = psm.q_value
-            scores[idx] = psm.score
-
-        df = pd.concat(
-            [scans, sequences, modifications, retention_times, q_values, scores], axis=1
-        )
-
-        return df
+        return self.psms.to_dataframe()
 
 
 class RunCollection:
@@ -230,50 +445,73 @@ class RunCollection:
         run_list: List[str],
         read_psms: bool,
         mod_mapping: Union[Dict, None] = None,
+        workers: int = 1,
     ):
-        """Add runs from list of run names."""
+        """
+        Add runs from list of run names. With `workers` > 1, the PSMs of multiple
+        runs are read in parallel processes, which return them column-wise.
+        """
         for run in run_list:
             self.runs[run] = Run(
                 run_name=run,
                 mgf_dir=os.path.join(self.root_dir, self.mgf_subdir),
                 pout_dir=os.path.join(self.root_dir, self.pout_subdir),
             )
-            if read_psms:
+        if not read_psms:
+            return
+
+        if workers > 1 and len(run_list) > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = {
+                    run: executor.submit(
+                        _read_run_psms,
+                        self.runs[run].get_pout_filename(),
+                        self.runs[run].get_mgf_filename(),
+                        mod_mapping,
+                    )
+                    for run in run_list
+                }
+                for run, future in futures.items():
+                    logging.debug("Reading PSMs for %s", run)
+                    self.runs[run].psms = PSMTable(future.result())
+        else:
+            for run in run_list:
                 logging.debug("Reading PSMs for %s", run)
-                self.runs[run].read_pout(mod_mapping=mod_mapping)
-                self.runs[run].read_mgf(no_new_psms=True)
+                self.runs[run].read_psms(mod_mapping=mod_mapping, workers=workers)
 
     def add_runs_by_glob(
         self,
         name_pattern: str = "*",
         read_psms: bool = True,
         mod_mapping: Union[Dict, None] = None,
+        workers: int = 1,
     ):
-        """Add runs by using glob to find all mgf files."""
+        """Add runs by using glob to find all (compressed) mgf files."""
         mgf_pattern = os.path.join(
             self.root_dir, self.mgf_subdir, name_pattern + ".mgf"
         )
-        run_list = glob(mgf_pattern)
-        run_list = [os.path.splitext(os.path.basename(run))[0] for run in run_list]
-        self._add_runs(run_list, read_psms, mod_mapping=mod_mapping)
+        run_list = set()
+        for suffix in [""] + list(COMPRESSION_SUFFIXES.values()):
+            for run in glob(mgf_pattern + suffix):
+                run_list.add(os.path.splitext(os.path.basename(strip_suffix(run)))[0])
+        run_list = sorted(run_list)
+        self._add_runs(run_list, read_psms, mod_mapping=mod_mapping, workers=workers)
 
     def add_runs_by_list(
         self,
         run_list: List[str],
         read_psms: bool = True,
         mod_mapping: Union[Dict, None] = None,
+        workers: int = 1,
     ):
         """Add runs from a list of run names."""
-        self._add_runs(run_list, read_psms, mod_mapping=mod_mapping)
+        self._add_runs(run_list, read_psms, mod_mapping=mod_mapping, workers=workers)
 
     def to_dataframe(self) -> pd.DataFrame:
         """Dump all PSMs into a pandas.DataFrame."""
-        dfs = []
-        for run_name, run in self.runs.items():
-            run_df = run.to_dataframe()
-            run_df["run"] = run_name
-            dfs.append(run_df)
-        df = pd.concat(dfs, axis=0)
+        df = PSMTable.concat(
+            [run.psms for run in self.runs.values()], list(self.runs)
+        )
         df["collection"] = self.name
         return df
 
@@ -282,39 +520,23 @@ class RunCollection:
         original: List[float],
         original_shared: List[float],
         reference_shared: List[float],
-    ) -> List[float]:
+        model: str = "stepwise",
+    ) -> np.ndarray:
         """
         Calibrate retention times to a reference.
-        
+
         Given a list of shared retention times between the orignal set and a reference
-        set, calibrate a full list of retention times.
+        set, calibrate a full list of retention times (see `rt_alignment`).
         """
-        original = np.array(original, dtype=np.float64)
-        original_shared = np.array(original_shared, dtype=np.float64)
-        reference_shared = np.array(reference_shared, dtype=np.float64)
-
-        # Insert zero at beginning of set and medians
-        original_shared = np.insert(original_shared, 0, 0)
-        reference_shared = np.insert(reference_shared, 0, 0)
-
-        # Hard copy all, to apply calibration to
-        original_calibrated = original.copy()
-
-        # Calculate differences
-        diff = original_shared - reference_shared
-
-        # Loop over all median differences to apply to all
-        for i in range(1, len(reference_shared)):
-            original_calibrated[
-                np.logical_and(
-                    original > original_shared[i - 1], original <= original_shared[i]
-                )
-            ] += diff[i]
-
-        # Also apply last difference to elements higher than the last shared rt
-        original_calibrated[original > original_shared[-1]] += diff[-1]
-
-        return original_calibrated
+        original = np.asarray(original, dtype=np.float64)
+        return calibrate_runs(
+            np.zeros(len(original), dtype=np.int64),
+            original,
+            np.zeros(len(original_shared), dtype=np.int64),
+            original_shared,
+            reference_shared,
+            model=model,
+        )
 
     def calibrate_collection(
         self,
@@ -322,27 +544,53 @@ class RunCollection:
         top_n: Union[float, None] = None,
         q_value_threshold: float = 0.01,
         plot: bool = False,
+        model: str = "stepwise",
+        alignment: str = "shared",
+        min_anchors: int = 10,
     ) -> pd.DataFrame:
-        """Calibrate retention times in a collection to one run in the collection."""
+        """
+        Calibrate retention times in a collection to one run in the collection.
+
+        `model` is one of `rt_alignment.CALIBRATION_MODELS`. With `alignment`
+        "shared", only peptidoforms identified in all runs are used as anchors.
+        With "tree", runs are calibrated pairwise along a spanning tree of runs
+        with the most shared peptidoforms, so that no peptidoform has to be
+        identified in all runs. Runs are only connected in the tree if they share
+        at least `min_anchors` peptidoforms.
+        """
+        if alignment not in ALIGNMENT_METHODS:
+            raise ValueError(f"Unknown alignment: {alignment} (supported: {ALIGNMENT_METHODS})")
         if psms is None:
             psms = self.to_dataframe()
 
-        psms["modifications"].fillna("", inplace=True)
+        if psms["modifications"].isna().any():
+            psms["modifications"] = psms["modifications"].astype(object).fillna("")
         psms = psms[psms["q_value"] <= q_value_threshold]
 
-        print("calibrating ", self.name)
-        print("#PSMs @0.01FDR: ", len(psms))
+        logging.info("Calibrating %s", self.name)
+        logging.info("#PSMs @%s FDR: %i", q_value_threshold, len(psms))
 
         # Collapse PSMs to unique sequence/modifications per run with median rt
-        gb_object = psms.groupby(["sequence", "modifications", "run", "collection"])
+        gb_object = psms.groupby(
+            ["sequence", "modifications", "run", "collection"], observed=True
+        )
         rt = gb_object["retention_time"].median().rename("retention_time_median")
         q_value = gb_object["q_value"].mean().rename("q_value_mean")
         psms_medians = pd.concat([rt, q_value], axis=1).reset_index()
 
-        print("#Peptidoforms: ", len(psms_medians))
+        logging.info("#Peptidoforms: %i", len(psms_medians))
+
+        if alignment == "tree":
+            psms_calibrated = self._align_to_tree(psms_medians, model, min_anchors)
+            if plot:
+                self._plot_calibration(psms_calibrated)
+            return self._median_calibrated_retention_times(psms_calibrated)
+
         # Get number of runs in which a peptide-mod is
         run_counts = (
-            psms_medians.groupby(["sequence", "modifications", "collection"])
+            psms_medians.groupby(
+                ["sequence", "modifications", "collection"], observed=True
+            )
             .size()
             .rename("run_counts")
             .reset_index()
@@ -358,7 +606,7 @@ class RunCollection:
 
         if len(psms_medians_shared) > 0:
             ref_run = psms_medians_shared["run"].iloc[0]
-            print("Reference run: ", ref_run)
+            logging.info("Reference run: %s", ref_run)
 
             if top_n:
                 psms_medians_shared = psms_medians_shared.sort_values(
@@ -373,46 +621,24 @@ class RunCollection:
             )
             psms_medians = psms_medians.merge(psms_medians_shared, how="left")
 
-            print("#Shared peptidoforms: ", len(psms_medians_shared))
-
-            calibrated = []
-
-            for run in psms_medians["run"].unique():
-                psms_run = psms_medians[psms_medians["run"] == run].copy()
-
-                # Get arrays with original, original_shared, and reference_shared
-                psms_run_shared = psms_run[
-                    ~psms_run["retention_time_reference"].isna()
-                ].sort_values("retention_time_median")
-                original_shared = psms_run_shared["retention_time_median"]
-                reference_shared = psms_run_shared["retention_time_reference"]
-                original = psms_run["retention_time_median"].sort_values()
-
-                # Sort by retention_time_median, before adding calibrated rt's!!!
-                psms_run = psms_run.sort_values("retention_time_median")
-
-                # calibrate
-                psms_run["retention_time_calibrated"] = self._calibrate_retention_times(
-                    original, original_shared, reference_shared
-                )
-
-                calibrated.append(psms_run)
-
-            psms_calibrated = pd.concat(calibrated, axis=0)
+            logging.info("#Shared peptidoforms: %i", len(psms_medians_shared))
+
+            # Calibrate all runs at once, with the shared peptidoforms as anchors
+            run_codes, _ = pd.factorize(psms_medians["run"])
+            shared = ~psms_medians["retention_time_reference"].isna().to_numpy()
+            retention_times = psms_medians["retention_time_median"].to_numpy()
+            psms_calibrated = psms_medians.copy()
+            psms_calibrated["retention_time_calibrated"] = calibrate_runs(
+                run_codes,
+                retention_times,
+                run_codes[shared],
+                retention_times[shared],
+                psms_medians["retention_time_reference"].to_numpy()[shared],
+                model=model,
+            )
 
             if plot:
-                import matplotlib.pyplot as plt
-                import seaborn as sns
-                plt.figure()
-                sns.lmplot(
-                    data=psms_calibrated,
-                    x="retention_time_calibrated",
-                    y="retention_time_reference",
-                    hue="run",
-                    scatter_kws={"s": 4},
-                    fit_reg=False,
-                )
-                plt.savefig(self.name + ".png")
+                self._plot_calibration(psms_calibrated)
 
         else:
             psms_calibrated = psms_medians
@@ -420,17 +646,63 @@ class RunCollection:
                 "retention_time_median"
             ]
 
-        # Calculate medians of calibrated retention times
-        psms_calibrated_medians = (
-            psms_calibrated.groupby(["sequence", "modifications"])[
+        return self._median_calibrated_retention_times(psms_calibrated)
+
+    def _align_to_tree(
+        self, psms_medians: pd.DataFrame, model: str, min_anchors: int
+    ) -> pd.DataFrame:
+        """
+        Calibrate median retention times of all runs to one reference run, through
+        a spanning tree of runs with shared peptidoforms (see `rt_alignment.align_runs`).
+        """
+        run_codes, run_names = pd.factorize(psms_medians["run"])
+        peptide_codes = psms_medians.groupby(
+            ["sequence", "modifications"], observed=True
+        ).ngroup()
+        calibrated, root, parent = align_runs(
+            run_codes,
+            peptide_codes.to_numpy(),
+            psms_medians["retention_time_median"].to_numpy(),
+            model=model,
+            min_anchors=min_anchors,
+        )
+        ref_run = run_names[root]
+        logging.info("Reference run: %s", ref_run)
+        logging.info("#Runs not aligned: %i", int((parent < 0).sum()) - 1)
+
+        psms_calibrated = psms_medians.copy()
+        psms_calibrated["retention_time_calibrated"] = calibrated
+        reference = psms_medians[psms_medians["run"] == ref_run][
+            ["sequence", "modifications", "retention_time_median"]
+        ].rename(columns={"retention_time_median": "retention_time_reference"})
+        return psms_calibrated.merge(reference, how="left")
+
+    def _plot_calibration(self, psms_calibrated: pd.DataFrame):
+        """Plot calibrated versus reference retention times."""
+        import matplotlib.pyplot as plt
+        import seaborn as sns
+        plt.figure()
+        sns.lmplot(
+            data=psms_calibrated,
+            x="retention_time_calibrated",
+            y="retention_time_reference",
+            hue="run",
+            scatter_kws={"s": 4},
+            fit_reg=False,
+        )
+        plt.savefig(self.name + ".png")
+
+    @staticmethod
+    def _median_calibrated_retention_times(psms_calibrated: pd.DataFrame) -> pd.DataFrame:
+        """Calculate medians of calibrated retention times."""
+        return (
+            psms_calibrated.groupby(["sequence", "modifications"], observed=True)[
                 "retention_time_calibrated"
             ]
             .median()
             .reset_index()
         )
 
-        return psms_calibrated_medians
-
 
 def argument_parser():
     parser = argparse.ArgumentParser()
@@ -462,20 +734,68 @@ def argument_parser():
         dest="modifications_mapping",
         help="Path to JSON with modifications key, containing `name` -> `unimod_accession` mapping"
     )
+    parser.add_argument(
+        "--threads",
+        action="store",
+        default=1,
+        type=int,
+        dest="threads",
+        help="Number of processes used to read runs (default: 1)"
+    )
+    parser.add_argument(
+        "--model",
+        action="store",
+        default="stepwise",
+        choices=CALIBRATION_MODELS,
+        dest="model",
+        help="Retention time calibration model (default: stepwise)"
+    )
+    parser.add_argument(
+        "--alignment",
+        action="store",
+        default="shared",
+        choices=ALIGNMENT_METHODS,
+        dest="alignment",
+        help="Align runs with peptides shared by all runs (shared) or pairwise along \
+a spanning tree of runs (tree, for large projects) (default: shared)"
+    )
+    parser.add_argument(
+        "--report",
+        action="store",
+        default=None,
+        dest="report_file",
+        help="Write timing and memory usage per stage to this JSON lines file"
+    )
+    parser.add_argument(
+        "--log-level",
+        action="store",
+        default="INFO",
+        choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+        dest="log_level",
+        help="Logging level (default: INFO)"
+    )
     args = parser.parse_args()
     return args
 
 
 def main():
     args = argument_parser()
+    instrumentation.configure_logging(args.log_level)
     with open(args.modifications_mapping, 'rt') as f:
         mod_config = json.load(f)['modifications']
     mod_mapping = {f"UNIMOD:{mod['unimod_accession']}": mod["name"] for mod in mod_config}
 
     collection = RunCollection('dataset', mgf_subdir='mgf', pout_subdir='mzid')
-    collection.add_runs_by_glob(mod_mapping=mod_mapping)
-    psms_calibrated = collection.calibrate_collection(q_value_threshold=0.01)
-    psms_calibrated.to_csv(args.output_file, sep=' ', index=False)
+    with instrumentation.stage("read_runs") as stage:
+        collection.add_runs_by_glob(mod_mapping=mod_mapping, workers=args.threads)
+        stage.rows += sum(len(run.psms) for run in collection.runs.values())
+    with instrumentation.stage("calibration", rows=stage.rows):
+        psms_calibrated = collection.calibrate_collection(
+            q_value_threshold=0.01, model=args.model, alignment=args.alignment
+        )
+    with instrumentation.stage("write_output", rows=len(psms_calibrated)):
+        psms_calibrated.to_csv(args.output_file, sep=' ', index=False)
+    instrumentation.write_report(args.report_file, job="retention_time_calibration")
 
 
 if __name__ == "__main__":
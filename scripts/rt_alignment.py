@@ -0,0 +1,307 @@
+"""
+Retention time alignment
+
+Calibrate retention times of one or more runs to a reference, based on anchor
+peptides: peptides identified in both a run and the reference, with their
+retention time in the run (`anchor_x`) and in the reference (`anchor_ref`).
+
+Available models:
+- `stepwise`: a retention time between two consecutive anchors is shifted by
+  the offset of the higher anchor
+- `linear`: piecewise-linear interpolation of the offsets between anchors
+- `monotone`: the offsets are smoothed with a running mean, after which an
+  isotonic (monotone) regression of the resulting reference retention times on
+  the run retention times is interpolated as in `linear`. A constant offset is
+  kept exactly.
+
+Each run gets an extra anchor at (0, 0), as in the previous per-run loop, so
+retention times up to 0 are not changed. In the `stepwise` model, retention
+times in (0, first anchor] are therefore shifted by the offset of the first
+anchor; in the `linear` and `monotone` models, the offset is interpolated from
+0 at 0 to the offset of the first anchor. In all models, retention times after
+the last anchor are shifted by the offset of the last anchor.
+
+All runs are calibrated in one batched call: the retention times of run `k`
+are moved to the interval `[k * span, (k + 1) * span)`, so that one sorted
+anchor array and a single `np.searchsorted` or `np.interp` call cover all
+runs.
+"""
+
+from typing import Tuple, Union
+
+import numpy as np
+
+
+CALIBRATION_MODELS = ["stepwise", "linear", "monotone"]
+
+
+def isotonic_regression(y: np.ndarray, weights: Union[np.ndarray, None] = None) -> np.ndarray:
+    """Non-decreasing least squares fit to `y`, using pool adjacent violators."""
+    y = np.asarray(y, dtype=np.float64)
+    if weights is None:
+        weights = np.ones_like(y)
+    values = []
+    block_weights = []
+    block_sizes = []
+    for value, weight in zip(y.tolist(), np.asarray(weights, dtype=np.float64).tolist()):
+        values.append(value)
+        block_weights.append(weight)
+        block_sizes.append(1)
+        while len(values) > 1 and values[-2] > values[-1]:
+            weight = block_weights[-2] + block_weights[-1]
+            value = (values[-2] * block_weights[-2] + values[-1] * block_weights[-1]) / weight
+            size = block_sizes[-2] + block_sizes[-1]
+            del values[-1], block_weights[-1], block_sizes[-1]
+            values[-1], block_weights[-1], block_sizes[-1] = value, weight, size
+    return np.repeat(values, block_sizes)
+
+
+def running_mean(y: np.ndarray, window: int) -> np.ndarray:
+    """
+    Centered running mean over `window` values (rounded down to an odd number).
+    Near the edges, the window shrinks symmetrically, down to the edge value
+    itself, so that linear trends are kept up to the edges.
+    """
+    y = np.asarray(y, dtype=np.float64)
+    half = np.minimum(np.arange(len(y)), np.arange(len(y))[::-1])
+    half = np.minimum(half, max(window - 1, 0) // 2)
+    cumsum = np.concatenate([[0.0], np.cumsum(y)])
+    i = np.arange(len(y))
+    return (cumsum[i + half + 1] - cumsum[i - half]) / (2 * half + 1)
+
+
+def _average_duplicates(
+    runs: np.ndarray, x: np.ndarray, ref: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Average reference retention times of anchors with the same run and x."""
+    keys = np.stack([runs, x], axis=1)
+    unique, inverse = np.unique(keys, axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    ref_mean = np.bincount(inverse, weights=ref) / np.bincount(inverse)
+    return unique[:, 0].astype(np.int64), unique[:, 1], ref_mean
+
+
+def calibrate_runs(
+    runs: np.ndarray,
+    x: np.ndarray,
+    anchor_runs: np.ndarray,
+    anchor_x: np.ndarray,
+    anchor_ref: np.ndarray,
+    model: str = "stepwise",
+    smoothing: int = 5,
+) -> np.ndarray:
+    """
+    Calibrate retention times of multiple runs to a reference.
+
+    runs: int array, run index (0 to number of runs - 1) of each retention time
+    x: retention times to calibrate
+    anchor_runs, anchor_x, anchor_ref: run index, retention time in the run and
+      in the reference of each anchor
+    model: one of CALIBRATION_MODELS
+    smoothing: running mean window over the offsets in the `monotone` model
+
+    The offset of an anchor is its run retention time minus its reference
+    retention time, and is subtracted. With `stepwise`, a retention time in
+    (previous anchor, anchor] gets the offset of that anchor, where the
+    previous anchor of the first anchor of a run is (0, 0).
+
+    Returns the calibrated retention times, in the order of `x`.
+    """
+    if model not in CALIBRATION_MODELS:
+        raise ValueError(f"Unknown calibration model: {model} (supported: {CALIBRATION_MODELS})")
+
+    runs = np.asarray(runs, dtype=np.int64)
+    x = np.asarray(x, dtype=np.float64)
+    anchor_runs = np.asarray(anchor_runs, dtype=np.int64)
+    anchor_x = np.asarray(anchor_x, dtype=np.float64)
+    anchor_ref = np.asarray(anchor_ref, dtype=np.float64)
+    if len(x) == 0:
+        return x.copy()
+    valid = ~(np.isnan(anchor_x) | np.isnan(anchor_ref))
+    anchor_runs, anchor_x, anchor_ref = anchor_runs[valid], anchor_x[valid], anchor_ref[valid]
+
+    n_runs = int(max(runs.max(), anchor_runs.max() if len(anchor_runs) else 0)) + 1
+    span = np.nanmax(np.concatenate([x, anchor_x, [0.0]])) + 2
+
+    # Every run starts with an anchor at (0, 0)
+    anchor_runs = np.concatenate([np.arange(n_runs), anchor_runs])
+    anchor_x = np.concatenate([np.zeros(n_runs), anchor_x])
+    anchor_ref = np.concatenate([np.zeros(n_runs), anchor_ref])
+    order = np.lexsort((anchor_x, anchor_runs))
+    anchor_runs, anchor_x, anchor_ref = anchor_runs[order], anchor_x[order], anchor_ref[order]
+    # Retention times up to 0 are looked up at 0, so they stay in their run's
+    # interval and get the offset of the (0, 0) anchor
+    x_shifted = np.maximum(x, 0) + runs * span
+
+    if model == "stepwise":
+        offsets = anchor_x - anchor_ref
+        last_anchor = np.searchsorted(anchor_runs, np.arange(n_runs), side="right") - 1
+        i = np.searchsorted(anchor_x + anchor_runs * span, x_shifted, side="left")
+        i = np.minimum(i, last_anchor[runs])
+        return x - offsets[i]
+
+    anchor_runs, anchor_x, anchor_ref = _average_duplicates(anchor_runs, anchor_x, anchor_ref)
+    if model == "monotone":
+        starts = np.searchsorted(anchor_runs, np.arange(n_runs + 1), side="left")
+        anchor_ref = anchor_ref.copy()
+        # Fit the real anchors only: the (0, 0) anchor of each run stays in place
+        for start, end in zip(starts[:-1] + 1, starts[1:]):
+            x_run = anchor_x[start:end]
+            offsets = running_mean(x_run - anchor_ref[start:end], smoothing)
+            anchor_ref[start:end] = isotonic_regression(x_run - offsets)
+
+    # Add an anchor at the end of each run's interval, for a constant offset
+    # after the last anchor
+    offsets = anchor_x - anchor_ref
+    last_anchor = np.searchsorted(anchor_runs, np.arange(n_runs), side="right") - 1
+    xp = np.concatenate([anchor_x + anchor_runs * span, np.arange(n_runs) * span + span - 1])
+    fp = np.concatenate([offsets, offsets[last_anchor]])
+    order = np.argsort(xp, kind="mergesort")
+    return x - np.interp(x_shifted, xp[order], fp[order])
+
+
+def anchor_overlap(
+    runs: np.ndarray, peptides: np.ndarray, n_runs: int, chunk_size: int = 10000
+) -> np.ndarray:
+    """
+    Count the peptides shared by each pair of runs.
+
+    runs, peptides: int arrays with run and peptide index of each (unique)
+      identified peptide per run
+
+    Returns a (n_runs, n_runs) array. Peptides are processed in chunks of
+    `chunk_size`, so memory usage is bounded by `n_runs * chunk_size`.
+    """
+    runs = np.asarray(runs, dtype=np.int64)
+    peptides = np.asarray(peptides, dtype=np.int64)
+    overlap = np.zeros((n_runs, n_runs), dtype=np.float64)
+    if len(peptides) == 0:
+        return overlap.astype(np.int64)
+
+    order = np.argsort(peptides, kind="mergesort")
+    runs, peptides = runs[order], peptides[order]
+    for start in range(0, int(peptides[-1]) + 1, chunk_size):
+        lo, hi = np.searchsorted(peptides, [start, start + chunk_size])
+        if lo == hi:
+            continue
+        incidence = np.zeros((n_runs, chunk_size), dtype=np.float32)
+        incidence[runs[lo:hi], peptides[lo:hi] - start] = 1
+        overlap += incidence @ incidence.T
+    return np.rint(overlap).astype(np.int64)
+
+
+def maximum_spanning_tree(
+    overlap: np.ndarray, root: Union[int, None] = None, min_anchors: int = 10
+) -> Tuple[int, np.ndarray, np.ndarray]:
+    """
+    Build a maximum spanning tree on run overlaps (Prim's algorithm), only using
+    edges with at least `min_anchors` shared peptides. By default, the run with
+    the largest total overlap with all other runs is the root.
+
+    Returns root, parent of each run (-1 for the root and unconnected runs),
+    and the runs in the order they were added to the tree.
+    """
+    n_runs = len(overlap)
+    overlap = overlap.astype(np.int64, copy=True)
+    np.fill_diagonal(overlap, 0)
+    if root is None:
+        root = int(np.argmax(overlap.sum(axis=1)))
+
+    parent = np.full(n_runs, -1, dtype=np.int64)
+    in_tree = np.zeros(n_runs, dtype=bool)
+    in_tree[root] = True
+    best = overlap[root].copy()
+    best_from = np.full(n_runs, root, dtype=np.int64)
+    order = [root]
+    for _ in range(n_runs - 1):
+        candidates = np.where(in_tree, -1, best)
+        run = int(np.argmax(candidates))
+        if candidates[run] < min_anchors:
+            break
+        in_tree[run] = True
+        parent[run] = best_from[run]
+        order.append(run)
+        better = ~in_tree & (overlap[run] > best)
+        best[better] = overlap[run][better]
+        best_from[better] = run
+    return root, parent, np.array(order, dtype=np.int64)
+
+
+def align_runs(
+    runs: np.ndarray,
+    peptides: np.ndarray,
+    x: np.ndarray,
+    model: str = "stepwise",
+    min_anchors: int = 10,
+    root: Union[int, None] = None,
+    chunk_size: int = 10000,
+) -> Tuple[np.ndarray, int, np.ndarray]:
+    """
+    Align retention times of all runs to a reference run, without requiring
+    peptides that are shared by all runs.
+
+    runs, peptides: int arrays with run and peptide index of each (unique)
+      identified peptide per run
+    x: retention time of each identified peptide per run
+
+    Runs are connected in a maximum spanning tree on the number of shared
+    peptides (see `maximum_spanning_tree`). Each run is calibrated to its
+    parent in the tree, with the peptides they share as anchors; all pairwise
+    fits are done in one batched `calibrate_runs` call. The transforms are
+    then composed level by level, down from the root: a run's retention times,
+    calibrated to its parent, are mapped to the root by linear interpolation
+    over the parent's retention times already mapped to the root.
+
+    Runs that are not connected to the tree (no run with at least
+    `min_anchors` shared peptides) are not calibrated.
+
+    Returns calibrated retention times, root run and parent of each run.
+    """
+    runs = np.asarray(runs, dtype=np.int64)
+    peptides = np.asarray(peptides, dtype=np.int64)
+    x = np.asarray(x, dtype=np.float64)
+    calibrated = x.copy()
+    if len(x) == 0:
+        return calibrated, -1, np.array([], dtype=np.int64)
+
+    n_runs = int(runs.max()) + 1
+    overlap = anchor_overlap(runs, peptides, n_runs, chunk_size=chunk_size)
+    root, parent, order = maximum_spanning_tree(overlap, root=root, min_anchors=min_anchors)
+
+    # Anchors of each run with its parent: peptides identified in both
+    n_peptides = int(peptides.max()) + 1
+    child = parent[runs] >= 0
+    row_keys = runs * n_peptides + peptides
+    sorted_rows = np.argsort(row_keys, kind="mergesort")
+    sorted_keys = row_keys[sorted_rows]
+    child_keys = parent[runs[child]] * n_peptides + peptides[child]
+    positions = np.minimum(np.searchsorted(sorted_keys, child_keys), len(sorted_keys) - 1)
+    matched = sorted_keys[positions] == child_keys
+    child_rows = np.flatnonzero(child)
+    anchor_rows = child_rows[matched]
+    anchor_ref = x[sorted_rows[positions[matched]]]
+
+    # Pairwise fits: each run to its parent, all in one call
+    to_parent = calibrate_runs(
+        runs[child], x[child], runs[anchor_rows], x[anchor_rows], anchor_ref, model=model
+    )
+
+    # Compose transforms down the tree, one level at a time
+    depth = np.zeros(n_runs, dtype=np.int64)
+    for run in order[1:]:
+        depth[run] = depth[parent[run]] + 1
+    row_depth = np.where(child, depth[runs], 0)
+    to_parent_rows = np.full(len(x), np.nan)
+    to_parent_rows[child_rows] = to_parent
+    for level in range(1, int(depth.max()) + 1):
+        level_rows = np.flatnonzero(child & (row_depth == level))
+        parent_rows = np.flatnonzero(np.isin(runs, parent[runs[level_rows]]))
+        calibrated[level_rows] = calibrate_runs(
+            parent[runs[level_rows]],
+            to_parent_rows[level_rows],
+            runs[parent_rows],
+            x[parent_rows],
+            calibrated[parent_rows],
+            model="linear",
+        )
+    return calibrated, root, parent
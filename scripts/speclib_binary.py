@@ -0,0 +1,233 @@
+"""
+Binary spectral library
+
+Compact, memory-mappable storage format for spectral libraries. Peaks of all
+spectra are stored as contiguous float32 m/z and intensity arrays, with an
+int64 offsets array marking where each spectrum starts. Per-spectrum metadata
+is stored column-wise: numeric columns as plain arrays, string columns as UTF-8
+bytes with an int64 offsets array.
+
+File layout:
+```
+magic (8 bytes) | header length (uint64, little endian) | JSON header | arrays
+```
+The JSON header lists dtype, byte offset and length of each array. Each array
+starts at a 64-byte aligned offset, so it can be used as a zero-copy NumPy view
+on the memory-mapped file.
+
+Example:
+```
+with SpectralLibrary('speclib/spectral_library.speclib') as lib:
+    mz, intensity = lib.peaks(0)
+    print(lib.metadata(0))
+```
+"""
+
+# Standard library
+import json
+import shutil
+import struct
+import tempfile
+
+# Third party
+import numpy as np
+
+# Project
+from mgf_index import iter_spectrum_buffers, read_block_header
+
+
+MAGIC = b'PXDSLIB1'
+ALIGNMENT = 64
+
+STRING_COLUMNS = ['usi', 'peptide', 'modifications', 'run']
+NUMERIC_COLUMNS = {
+    'charge': np.uint8,
+    'q-value': np.float64,
+    'scan_number': np.uint32,
+    'precursor_mz': np.float64,
+}
+
+
+def _parse_peaks(spectrum_text):
+    """
+    Parse peak lines of an MGF spectrum into float32 m/z and intensity arrays.
+    """
+    mz = []
+    intensity = []
+    for line in spectrum_text.splitlines():
+        if line[:1].isdigit():
+            fields = line.split()
+            mz.append(fields[0])
+            intensity.append(fields[1])
+    return np.array(mz, dtype=np.float32), np.array(intensity, dtype=np.float32)
+
+
+def _pad(f):
+    """
+    Write zero bytes until the file position is a multiple of ALIGNMENT.
+    """
+    padding = -f.tell() % ALIGNMENT
+    f.write(b'\x00' * padding)
+
+
+def _encode_strings(values):
+    """
+    Encode strings to a UTF-8 data array and an int64 offsets array.
+    """
+    encoded = [str(value).encode('utf-8') for value in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(value) for value in encoded], out=offsets[1:])
+    data = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+    return data, offsets
+
+
+def write_binary_library(outname, mgf_file, metadata, title_col='usi'):
+    """
+    Write binary spectral library from an MGF file and a metadata table.
+
+    outname: string, path to binary library file to write
+    mgf_file: string, MGF file with library spectra (e.g. from `parse_mgf`),
+      optionally gzip or zstd compressed
+    metadata: pandas.DataFrame with one row per spectrum, containing
+      `title_col` and the columns listed in STRING_COLUMNS and NUMERIC_COLUMNS
+      (`precursor_mz` is taken from the MGF PEPMASS)
+    title_col: column in `metadata` matching the spectrum titles in the MGF file
+
+    Spectra are stored in the order in which they occur in the MGF file.
+    """
+    metadata = metadata.set_index(title_col, drop=False)
+    rows = []
+    precursor_mz = []
+    peak_offsets = [0]
+
+    # Stream peaks to temporary files, to keep memory usage bounded
+    with tempfile.TemporaryFile() as mz_tmp, tempfile.TemporaryFile() as int_tmp:
+        for buf, offset, length, _ in iter_spectrum_buffers(mgf_file):
+            header = read_block_header(buf, offset, length)
+            mz, intensity = _parse_peaks(buf[offset:offset + length].decode('utf-8'))
+            mz_tmp.write(mz.tobytes())
+            int_tmp.write(intensity.tobytes())
+            peak_offsets.append(peak_offsets[-1] + len(mz))
+            rows.append(header['TITLE'])
+            pepmass = header.get('PEPMASS', '').split(' ')[0]
+            precursor_mz.append(float(pepmass) if pepmass else np.nan)
+
+        metadata = metadata.loc[rows]
+        metadata = metadata.assign(precursor_mz=precursor_mz)
+
+        arrays = [
+            ('peaks.offsets', np.array(peak_offsets, dtype=np.int64)),
+            ('peaks.mz', mz_tmp),
+            ('peaks.intensity', int_tmp),
+        ]
+        for column in STRING_COLUMNS:
+            data, offsets = _encode_strings(metadata[column].astype(object).fillna(''))
+            arrays.append((column + '.data', data))
+            arrays.append((column + '.offsets', offsets))
+        for column, dtype in NUMERIC_COLUMNS.items():
+            arrays.append((column, metadata[column].to_numpy().astype(dtype)))
+
+        # Compute array layout relative to start of data section
+        layout = {}
+        position = 0
+        for name, array in arrays:
+            if isinstance(array, np.ndarray):
+                dtype, nbytes = array.dtype.str, array.nbytes
+            else:
+                dtype, nbytes = np.dtype(np.float32).str, array.tell()
+            position += -position % ALIGNMENT
+            layout[name] = {'dtype': dtype, 'offset': position, 'nbytes': nbytes}
+            position += nbytes
+
+        header = json.dumps({
+            'version': 1,
+            'n_spectra': len(rows),
+            'string_columns': STRING_COLUMNS,
+            'numeric_columns': list(NUMERIC_COLUMNS),
+            'arrays': layout,
+        }).encode('utf-8')
+
+        with open(outname, 'wb') as out:
+            out.write(MAGIC)
+            out.write(struct.pack('<Q', len(header)))
+            out.write(header)
+            _pad(out)
+            data_start = out.tell()
+            for name, array in arrays:
+                _pad(out)
+                assert out.tell() - data_start == layout[name]['offset']
+                if isinstance(array, np.ndarray):
+                    out.write(array.tobytes())
+                else:
+                    array.seek(0)
+                    shutil.copyfileobj(array, out)
+
+
+class SpectralLibrary:
+    """
+    Read-only, memory-mapped binary spectral library.
+
+    Peaks and metadata are returned as zero-copy NumPy views on the mapped
+    file; nothing is loaded into memory until it is accessed.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            magic = f.read(len(MAGIC))
+            if magic != MAGIC:
+                raise ValueError("{} is not a binary spectral library".format(path))
+            header_length, = struct.unpack('<Q', f.read(8))
+            self.header = json.loads(f.read(header_length).decode('utf-8'))
+        data_start = len(MAGIC) + 8 + header_length
+        data_start += -data_start % ALIGNMENT
+
+        self._buffer = np.memmap(path, dtype=np.uint8, mode='r')
+        self._arrays = {}
+        for name, spec in self.header['arrays'].items():
+            start = data_start + spec['offset']
+            self._arrays[name] = self._buffer[start:start + spec['nbytes']].view(np.dtype(spec['dtype']))
+
+    def __len__(self):
+        return self.header['n_spectra']
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Release the memory-mapped file."""
+        self._arrays = {}
+        self._buffer = None
+
+    @property
+    def columns(self):
+        return self.header['string_columns'] + self.header['numeric_columns']
+
+    def peaks(self, i):
+        """Return (mz, intensity) arrays of spectrum `i`."""
+        offsets = self._arrays['peaks.offsets']
+        start, end = offsets[i], offsets[i + 1]
+        return self._arrays['peaks.mz'][start:end], self._arrays['peaks.intensity'][start:end]
+
+    def get_value(self, column, i):
+        """Return value of metadata `column` for spectrum `i`."""
+        if column in self.header['string_columns']:
+            offsets = self._arrays[column + '.offsets']
+            data = self._arrays[column + '.data'][offsets[i]:offsets[i + 1]]
+            return data.tobytes().decode('utf-8')
+        return self._arrays[column][i]
+
+    def get_column(self, column):
+        """
+        Return full metadata column: a NumPy view for numeric columns, a list
+        of strings for string columns.
+        """
+        if column in self.header['string_columns']:
+            return [self.get_value(column, i) for i in range(len(self))]
+        return self._arrays[column]
+
+    def metadata(self, i):
+        """Return all metadata of spectrum `i` as a dict."""
+        return {column: self.get_value(column, i) for column in self.columns}
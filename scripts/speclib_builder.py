@@ -0,0 +1,413 @@
+"""
+Spectral library builder
+
+Write a spectral library (MGF with precursor m/z index, PEPREC and optionally
+the binary format) from a PSM table, either directly from the original MGF
+files or incrementally from per-run shards.
+
+A shard holds the PSMs of one run that pass the FDR threshold (only the best
+PSM per peptide, unless all spectra are kept), together with their spectra:
+```
+<shard_dir>/<run>.<key>.psms.tsv
+<shard_dir>/<run>.<key>.mgf
+```
+The key is a content hash of the run's pout and MGF file and of the shard
+parameters. Shards are only rebuilt when their inputs change, so adding or
+re-searching a few runs only requires processing those runs. The final library
+is obtained by merging all shards and selecting the best PSM per peptide
+across runs.
+
+Shards can also be built and merged as separate steps (e.g. one job per run,
+as in the Snakemake workflow):
+```
+python3 scripts/speclib_builder.py shard -i PXD000000 -m mgf -o speclib/run_shards/run_1 mzid/run_1.pout
+python3 scripts/speclib_builder.py merge -c conf/snakemake_config.json -o speclib speclib/run_shards/run_1 ...
+```
+These shards are written to the given prefix, without key, and are not cached
+by content hash: deciding when to rebuild them is left to the caller (Snakemake
+compares modification times). Keyed and unkeyed shards can not share a
+directory.
+"""
+
+# Standard library
+import os
+import re
+import json
+import logging
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+# Third party
+import numpy as np
+import pandas as pd
+
+# Project
+import instrumentation
+import percolator_tools
+from parse_mgf import parse_mgf
+from peak_processing import add_peak_processing_arguments, get_peak_processing
+from speclib_binary import write_binary_library
+from precursor_index import write_precursor_index
+from compression import COMPRESSION_SUFFIXES, get_suffix, open_file, resolve_path
+
+
+SHARD_VERSION = 1
+SHARD_KEY_LENGTH = 16
+DIGEST_CACHE_FILENAME = 'digests.json'
+
+PEPREC_COLUMNS = [
+    'usi', 'modifications', 'peptide', 'charge',
+    'proteins', 'score', 'q-value',
+    'posterior_error_prob', 'run', 'scan_number'
+]
+PSM_DTYPES = {
+    'run': 'category',
+    'scan_number': np.uint32,
+    'charge': np.uint8,
+}
+
+
+def write_speclib(psms, mods, output_path, mgf_folder, workers=1, binary=False,
+                  compression=None, **parse_mgf_kwargs):
+    """
+    Write spectral library MGF and PEPREC (and optionally binary library) for
+    a table of selected PSMs. For an uncompressed MGF, a precursor m/z index
+    (see `precursor_index`) is written as well.
+
+    psms: pandas.DataFrame with PSMs (see `percolator_tools.load_psms`)
+    mods: list of modification dicts (`name`, `unimod_accession`)
+    output_path: string, directory to write output files to
+    mgf_folder: string, directory with the MGF files containing the spectra
+    compression: None, 'gzip' or 'zstd', compression of the MGF and PEPREC files
+    parse_mgf_kwargs: keyword arguments passed to `parse_mgf`, defining how
+      spectra are looked up in the MGF files
+    """
+    # Extract peptide and modifications out of modified_peptide column
+    with instrumentation.stage('mod_extraction', rows=len(psms)):
+        peprec_cols = percolator_tools.extract_seq_mods(psms, mods)
+        psms = pd.concat([psms, peprec_cols], axis=1)
+
+    # Parse all MGF files into one MGF with selected spectra
+    suffix = get_suffix(compression)
+    mgf_outname = os.path.join(output_path, 'spectral_library.mgf' + suffix)
+    with instrumentation.stage('mgf_extraction', rows=len(psms)):
+        if len(psms) > 0:
+            parse_mgf(psms, mgf_folder, outname=mgf_outname,
+                      show_progress_bar=False, workers=workers, **parse_mgf_kwargs)
+        else:
+            open_file(mgf_outname, 'w').close()
+
+    # Index spectra by charge and precursor m/z (only possible for a plain MGF,
+    # as spectra are read by byte offset)
+    if compression is None:
+        with instrumentation.stage('write_precursor_index', rows=len(psms)):
+            write_precursor_index(mgf_outname)
+    else:
+        logging.info("Not writing precursor index for compressed %s", mgf_outname)
+
+    # Create MS2PIP PEPREC (peptide record)
+    with instrumentation.stage('write_peprec', rows=len(psms)):
+        peprec = psms[PEPREC_COLUMNS].rename(columns={'usi': 'spec_id'})
+        peprec = peprec.sort_values('scan_number', kind='mergesort')
+        peprec_outname = os.path.join(output_path, 'spectral_library.peprec' + suffix)
+        with open_file(peprec_outname, 'w', threads=workers) as f:
+            peprec.to_csv(f, sep=' ', index=False)
+
+    # Write binary spectral library
+    if binary:
+        with instrumentation.stage('write_binary_library', rows=len(psms)):
+            write_binary_library(
+                os.path.join(output_path, 'spectral_library.speclib'),
+                mgf_outname,
+                psms
+            )
+
+
+def get_run_name(pout_file):
+    """Return run name for a pout file."""
+    return os.path.basename(pout_file)[:-len('.pout')]
+
+
+def write_shard(psms, shard_prefix, mgf_folder, peak_processing=None):
+    """
+    Write the PSMs of a single run and their spectra to a shard. Peaks are
+    processed (see `peak_processing`) when the spectra are written to the
+    shard, not when shards are merged.
+    """
+    os.makedirs(os.path.dirname(shard_prefix) or '.', exist_ok=True)
+    with instrumentation.stage('mgf_extraction', rows=len(psms)):
+        if len(psms) > 0:
+            parse_mgf(psms, mgf_folder, outname=shard_prefix + '.mgf.tmp',
+                      filename_col='run', spec_title_col='scan_number',
+                      title_parsing_method='scan=', new_title_col='usi',
+                      show_progress_bar=False, peak_processing=peak_processing)
+        else:
+            open(shard_prefix + '.mgf.tmp', 'w').close()
+    with instrumentation.stage('write_shard_psms', rows=len(psms)):
+        psms.to_csv(shard_prefix + '.psms.tsv.tmp', sep='\t', index=False)
+
+    # Move into place only when complete
+    os.replace(shard_prefix + '.mgf.tmp', shard_prefix + '.mgf')
+    os.replace(shard_prefix + '.psms.tsv.tmp', shard_prefix + '.psms.tsv')
+
+
+def build_shard(pout_file, mgf_folder, shard_prefix, project_id,
+                fdr_threshold=0.01, all_spectra=False, peak_processing=None):
+    """
+    Filter the PSMs of a single run and write them, together with their spectra,
+    to a shard. Return the number of PSMs in the shard.
+    """
+    if all_spectra:
+        psms = percolator_tools.load_psms(pout_file, project_id, fdr_threshold=fdr_threshold)
+    else:
+        psms = percolator_tools.reduce_best_psms(
+            percolator_tools.iter_psms(pout_file, project_id, fdr_threshold=fdr_threshold)
+        )
+    write_shard(psms, shard_prefix, mgf_folder, peak_processing=peak_processing)
+    return len(psms)
+
+
+def read_shard_psms(shard_prefix):
+    """
+    Read the PSMs of a shard, restoring the column types.
+    """
+    psms = pd.read_csv(
+        shard_prefix + '.psms.tsv', sep='\t', float_precision='round_trip',
+        dtype={'run': str, 'modified_peptide': str, 'proteins': str}
+    )
+    return psms.astype(PSM_DTYPES)
+
+
+def merge_shards(shard_prefixes, mods, output_path, all_spectra=False,
+                 workers=1, binary=False, compression=None):
+    """
+    Merge shards into the final spectral library, keeping only the best PSM per
+    peptide across all shards (unless `all_spectra`). Spectra are written shard
+    by shard, in the given order.
+    """
+    with instrumentation.stage('read_shards') as stage:
+        to_concat = []
+        for shard_prefix in shard_prefixes:
+            psms = read_shard_psms(shard_prefix)
+            psms['shard'] = os.path.basename(shard_prefix)
+            to_concat.append(psms)
+        psms = pd.concat(to_concat, axis=0, ignore_index=True)
+        psms = psms.astype(PSM_DTYPES)
+        stage.rows += len(psms)
+
+    if not all_spectra:
+        with instrumentation.stage('dedup', rows=len(psms)):
+            psms = percolator_tools.select_best_psms(psms)
+
+    shard_folders = {os.path.dirname(shard_prefix) for shard_prefix in shard_prefixes}
+    assert len(shard_folders) <= 1, "All shards should be in the same directory."
+    write_speclib(
+        psms, mods, output_path, shard_folders.pop() if shard_folders else '',
+        workers=workers, binary=binary, compression=compression,
+        filename_col='shard', spec_title_col='usi', title_parsing_method='full'
+    )
+
+
+def _file_digest(path):
+    """Return SHA-1 hex digest of a file's content."""
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+class DigestCache:
+    """
+    Content digests of input files, stored in the shard directory and only
+    recomputed when the size or modification time of a file changes.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.digests = {}
+        if os.path.isfile(path):
+            with open(path) as f:
+                self.digests = json.load(f)
+
+    def get(self, file_path):
+        stat = os.stat(file_path)
+        key = os.path.abspath(file_path)
+        signature = [stat.st_size, stat.st_mtime_ns]
+        if key not in self.digests or self.digests[key][:2] != signature:
+            self.digests[key] = signature + [_file_digest(file_path)]
+        return self.digests[key][2]
+
+    def save(self):
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(self.digests, f)
+        os.replace(self.path + '.tmp', self.path)
+
+
+def get_shard_key(pout_digest, mgf_digest, params):
+    """
+    Return shard key for the given input digests and shard parameters.
+    """
+    key = hashlib.sha1()
+    key.update(json.dumps(
+        [SHARD_VERSION, pout_digest, mgf_digest, params], sort_keys=True
+    ).encode('utf-8'))
+    return key.hexdigest()[:SHARD_KEY_LENGTH]
+
+
+def _remove_stale_shards(shard_dir, run, keep_prefix):
+    """
+    Remove all shard files of `run` that do not belong to `keep_prefix`.
+    """
+    pattern = re.compile(re.escape(run) + r'\.[0-9a-f]{' + str(SHARD_KEY_LENGTH) + r'}\.')
+    keep_name = os.path.basename(keep_prefix) + '.'
+    for name in os.listdir(shard_dir):
+        if pattern.match(name) and not name.startswith(keep_name):
+            os.remove(os.path.join(shard_dir, name))
+
+
+def build_cached_shards(pout_files, mgf_folder, shard_dir, project_id,
+                        fdr_threshold=0.01, all_spectra=False, workers=1,
+                        peak_processing=None):
+    """
+    Build a shard for each pout file, reusing existing shards whose inputs and
+    parameters did not change. Return the list of shard prefixes, in the order
+    of `pout_files`.
+    """
+    os.makedirs(shard_dir, exist_ok=True)
+    digests = DigestCache(os.path.join(shard_dir, DIGEST_CACHE_FILENAME))
+    params = {
+        'project_id': project_id,
+        'fdr_threshold': fdr_threshold,
+        'all_spectra': all_spectra,
+    }
+    if peak_processing is not None:
+        params['peak_processing'] = peak_processing._asdict()
+
+    shard_prefixes = []
+    to_build = []
+    for pout_file in pout_files:
+        run = get_run_name(pout_file)
+        mgf_file = resolve_path(os.path.join(mgf_folder, run + '.mgf'))
+        assert os.path.isfile(mgf_file), "MGF file {} could not be found.".format(mgf_file)
+        key = get_shard_key(digests.get(pout_file), digests.get(mgf_file), params)
+        shard_prefix = os.path.join(shard_dir, '{}.{}'.format(run, key))
+        shard_prefixes.append(shard_prefix)
+        if os.path.isfile(shard_prefix + '.mgf') and os.path.isfile(shard_prefix + '.psms.tsv'):
+            logging.info("%s: reusing shard %s", run, shard_prefix)
+        else:
+            to_build.append((pout_file, shard_prefix))
+        _remove_stale_shards(shard_dir, run, shard_prefix)
+    digests.save()
+
+    logging.info("Building %i/%i shards.", len(to_build), len(pout_files))
+    with ProcessPoolExecutor(max_workers=max(workers, 1)) as executor:
+        futures = [
+            executor.submit(
+                build_shard, pout_file, mgf_folder, shard_prefix, project_id,
+                fdr_threshold=fdr_threshold, all_spectra=all_spectra,
+                peak_processing=peak_processing
+            )
+            for pout_file, shard_prefix in to_build
+        ]
+        for (pout_file, _), future in zip(to_build, futures):
+            logging.info("%s: %i PSMs in shard", get_run_name(pout_file), future.result())
+
+    return shard_prefixes
+
+
+def argument_parser():
+    parser = argparse.ArgumentParser(description='Build spectral library shards\
+        per run and merge them into a spectral library.')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    common_parser = argparse.ArgumentParser(add_help=False)
+    common_parser.add_argument('--report', dest='report_file', action='store',
+                               default=None,
+                               help='Write timing and memory usage per stage\
+                               to this JSON lines file.')
+    common_parser.add_argument('--log-level', dest='log_level', action='store',
+                               default='INFO',
+                               choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                               help='Logging level (default: INFO).')
+
+    shard_parser = subparsers.add_parser('shard', help='Build shard for one run.',
+                                         parents=[common_parser])
+    shard_parser.add_argument('pout_file', action='store',
+                              help='Path to pout file of run.')
+    shard_parser.add_argument('-i', dest='project_id', action='store',
+                              help='Project identifier (e.g. PXD). Required for\
+                              Universal Spectrum Identifier.',
+                              required=True)
+    shard_parser.add_argument('-m', dest='mgf_path', action='store',
+                              help='Path to directory with MGF files.',
+                              required=True)
+    shard_parser.add_argument('-o', dest='shard_prefix', action='store',
+                              help='Output shard prefix (without extension).',
+                              required=True)
+    shard_parser.add_argument('-t', dest='fdr_threshold', action='store',
+                              default=0.01, type=float,
+                              help='FDR treshold. PSMs with a q-value higher than\
+                              the threshold are excluded.')
+    shard_parser.add_argument('-a', dest='all_spectra', action='store_true',
+                              help='Do not filter for unique peptides: include\
+                              all spectra.')
+    add_peak_processing_arguments(shard_parser)
+
+    merge_parser = subparsers.add_parser('merge', help='Merge shards into spectral library.',
+                                         parents=[common_parser])
+    merge_parser.add_argument('shard_prefixes', action='store', nargs='+',
+                              help='Shard prefixes (without extension).')
+    merge_parser.add_argument('-c', dest='mods_config_file', action='store',
+                              help='Path to JSON file with modifications info.',
+                              required=True)
+    merge_parser.add_argument('-o', dest='output_path', action='store',
+                              help='Path to directory to write output files.',
+                              required=True)
+    merge_parser.add_argument('-a', dest='all_spectra', action='store_true',
+                              help='Do not filter for unique peptides: include\
+                              all spectra.')
+    merge_parser.add_argument('-j', dest='workers', action='store',
+                              default=1, type=int,
+                              help='Number of processes to use for copying\
+                              spectra (default: 1).')
+    merge_parser.add_argument('-b', dest='binary', action='store_true',
+                              help='Also write the spectral library in the\
+                              binary, memory-mappable format.')
+    merge_parser.add_argument('-z', dest='compression', action='store',
+                              default=None, choices=list(COMPRESSION_SUFFIXES),
+                              help='Compress the spectral library MGF and\
+                              PEPREC files (default: no compression).')
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = argument_parser()
+    instrumentation.configure_logging(args.log_level)
+    if args.command == 'shard':
+        shard_dir = os.path.dirname(args.shard_prefix)
+        if os.path.isfile(os.path.join(shard_dir, DIGEST_CACHE_FILENAME)):
+            raise ValueError("{} holds keyed shards (see `build_cached_shards`); \
+use a separate directory".format(shard_dir or '.'))
+        num_psms = build_shard(
+            args.pout_file, args.mgf_path, args.shard_prefix, args.project_id,
+            fdr_threshold=args.fdr_threshold, all_spectra=args.all_spectra,
+            peak_processing=get_peak_processing(args)
+        )
+        logging.info("%i PSMs written to shard %s", num_psms, args.shard_prefix)
+    elif args.command == 'merge':
+        with open(args.mods_config_file) as json_file:
+            mods = json.load(json_file)['modifications']
+        merge_shards(
+            args.shard_prefixes, mods, args.output_path,
+            all_spectra=args.all_spectra, workers=args.workers, binary=args.binary,
+            compression=args.compression
+        )
+    job = 'shard ' + args.shard_prefix if args.command == 'shard' else 'merge ' + args.output_path
+    instrumentation.write_report(args.report_file, job=job)
+
+
+if __name__ == '__main__':
+    main()
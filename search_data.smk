@@ -3,7 +3,12 @@ configfile: "conf/snakemake_config.json"
 
 
 #RUNS, = glob_wildcards("mgf/{run}.mgf")
-RUNS = get_runs(config["download"]["pxd_identifier"], ['raw'], config["download"]["file_pattern"])
+
+
+# Split each run into at most SEARCH_CHUNKS chunks that are searched as separate
+# jobs; their pin files are merged per run (see scripts/mgf_chunks.py)
+SEARCH_CHUNKS = config["search"].get("chunks", 1)
+MIN_CHUNK_SPECTRA = config["search"].get("min_chunk_spectra", 0)
 
 
 rule search_targets:
@@ -18,9 +23,11 @@ rule run_msgfplus:
 		msgfplus_conf=config["search"]["msgfplus_conf"],
 		fasta=config["search"]["fasta"]
 	output:
-		"mzid/{run}.mzid"
+		intermediate("mzid/{run}.mzid")
 	log:
 		"logs/msgfplus/{run}.log"
+	benchmark:
+		BENCHMARK_DIR + "/run_msgfplus/{run}.tsv"
 	threads: config['search']['threads_per_search']
 	shell:
 		"""
@@ -34,9 +41,11 @@ rule create_pin:
 	input:
 		"mzid/{run}.mzid"
 	output:
-		"mzid/{run}.pin"
+		intermediate("mzid/{run}.pin")
 	log:
 		"logs/msgf2pin/{run}.log"
+	benchmark:
+		BENCHMARK_DIR + "/create_pin/{run}.tsv"
 	shell:
 		"msgf2pin -P XXX '{input}' > '{output}'"
 
@@ -49,5 +58,69 @@ rule run_percolator:
 		pout_dec="mzid/{run}.pout_dec"
 	log:
 		"logs/percolator/{run}.log"
+	benchmark:
+		BENCHMARK_DIR + "/run_percolator/{run}.tsv"
 	shell:
 		"percolator --post-processing-tdc -U -m '{output.pout}' -M '{output.pout_dec}' '{input}'"
+
+
+if SEARCH_CHUNKS > 1:
+	ruleorder: merge_chunk_pins > create_pin
+
+	checkpoint split_mgf:
+		input:
+			mgf=MGF,
+			mgf_index=MGF + ".idx"
+		output:
+			intermediate(directory("mgf/chunks/{run}"))
+		benchmark:
+			BENCHMARK_DIR + "/split_mgf/{run}.tsv"
+		shell:
+			"python3 scripts/mgf_chunks.py split -n {SEARCH_CHUNKS} -s {MIN_CHUNK_SPECTRA} -o '{output}' --report '{REPORT_DIR}/split_mgf/{wildcards.run}.jsonl' '{input.mgf}'"
+
+	rule run_msgfplus_chunk:
+		input:
+			spectrum_file="mgf/chunks/{run}/{chunk}.mgf",
+			msgfplus_conf=config["search"]["msgfplus_conf"],
+			fasta=config["search"]["fasta"]
+		output:
+			intermediate("mzid/chunks/{run}/{chunk}.mzid")
+		log:
+			"logs/msgfplus/{run}/{chunk}.log"
+		benchmark:
+			BENCHMARK_DIR + "/run_msgfplus/{run}/{chunk}.tsv"
+		threads: config['search']['threads_per_search']
+		shell:
+			"""
+			mkdir -p 'mzid/chunks/{wildcards.run}'
+			{config[search][msgfplus_exec]} -thread '{config[search][threads_per_search]}' -conf '{input.msgfplus_conf}' -d '{input.fasta}' -s '{input.spectrum_file}' -o '{output}' -addFeatures 1
+			"""
+
+	rule create_pin_chunk:
+		input:
+			"mzid/chunks/{run}/{chunk}.mzid"
+		output:
+			intermediate("mzid/chunks/{run}/{chunk}.pin")
+		log:
+			"logs/msgf2pin/{run}/{chunk}.log"
+		benchmark:
+			BENCHMARK_DIR + "/create_pin/{run}/{chunk}.tsv"
+		shell:
+			"msgf2pin -P XXX '{input}' > '{output}'"
+
+	def get_chunk_pins(wildcards):
+		chunk_dir = checkpoints.split_mgf.get(run=wildcards.run).output[0]
+		chunks = glob_wildcards(chunk_dir + "/{chunk}.mgf").chunk
+		return expand("mzid/chunks/{run}/{chunk}.pin", run=wildcards.run, chunk=sorted(chunks))
+
+	# PSMIds are renamed from the chunk to the run, keeping their scan numbers
+	rule merge_chunk_pins:
+		input:
+			pins=get_chunk_pins,
+			chunk_dir="mgf/chunks/{run}"
+		output:
+			intermediate("mzid/{run}.pin")
+		benchmark:
+			BENCHMARK_DIR + "/merge_chunk_pins/{run}.tsv"
+		shell:
+			"python3 scripts/mgf_chunks.py merge -m '{input.chunk_dir}/chunks.tsv' -o '{output}' --report '{REPORT_DIR}/merge_chunk_pins/{wildcards.run}.jsonl' {input.pins}"
@@ -0,0 +1,6 @@
+# Scripts use flat imports (`from mgf_index import ...`), as they are run from
+# the scripts directory
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'scripts'))
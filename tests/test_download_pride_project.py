@@ -0,0 +1,119 @@
+"""
+Tests for the download engine, against a local HTTP server.
+"""
+
+# Standard library
+import hashlib
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+# Third party
+import pytest
+
+# Project
+import download_pride_project
+from download_pride_project import download_file
+
+
+DATA = bytes(range(256)) * 400
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """
+    Serves DATA, with support for Range requests. The responses of the first
+    requests can be replaced by `server.faults` (popped per request):
+    - 'truncate': send the first half of the requested range and close the
+      connection, without Content-Length, so the client sees no error
+    - 'corrupt': send the requested range with every byte flipped
+    """
+    def do_GET(self):
+        self.server.requests.append(self.headers.get('Range'))
+        fault = self.server.faults.pop(0) if self.server.faults else None
+        start = 0
+        range_header = self.headers.get('Range')
+        if range_header:
+            start = int(range_header.split('=')[1].rstrip('-'))
+            if start >= len(DATA):
+                self.send_response(416)
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, len(DATA) - 1, len(DATA)))
+        else:
+            self.send_response(200)
+        body = DATA[start:]
+        if fault == 'truncate':
+            body = body[:len(body) // 2]
+        else:
+            if fault == 'corrupt':
+                body = bytes(255 - b for b in body)
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = HTTPServer(('127.0.0.1', 0), StandInHandler)
+    httpd.requests = []
+    httpd.faults = []
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    httpd.url = 'http://127.0.0.1:{}/file.raw'.format(httpd.server_address[1])
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(download_pride_project.time, 'sleep', lambda seconds: None)
+
+
+def test_resume_after_truncated_response(server, tmp_path):
+    server.faults = ['truncate']
+    target = str(tmp_path / 'file.raw')
+    stats = download_file(
+        server.url, target, expected_size=len(DATA),
+        checksum=hashlib.md5(DATA).hexdigest()
+    )
+    with open(target, 'rb') as f:
+        assert f.read() == DATA
+    assert stats['attempts'] == 2
+    assert server.requests == [None, 'bytes={}-'.format(len(DATA) // 2)]
+
+
+def test_restart_on_checksum_mismatch(server, tmp_path):
+    server.faults = ['corrupt']
+    target = str(tmp_path / 'file.raw')
+    stats = download_file(
+        server.url, target, expected_size=len(DATA),
+        checksum=hashlib.sha1(DATA).hexdigest()
+    )
+    with open(target, 'rb') as f:
+        assert f.read() == DATA
+    assert stats['attempts'] == 2
+    assert server.requests == [None, None]
+    assert not (tmp_path / 'file.raw.part').exists()
+
+
+def test_skip_complete_file(server, tmp_path):
+    target = tmp_path / 'file.raw'
+    target.write_bytes(DATA)
+    stats = download_file(server.url, str(target), expected_size=len(DATA))
+    assert stats['skipped']
+    assert server.requests == []
+
+
+def test_failure_keeps_no_target(server, tmp_path):
+    server.faults = ['corrupt'] * 3
+    target = tmp_path / 'file.raw'
+    with pytest.raises(download_pride_project.DownloadError):
+        download_file(
+            server.url, str(target), expected_size=len(DATA),
+            checksum=hashlib.md5(DATA).hexdigest(), retries=2
+        )
+    assert not target.exists()
@@ -0,0 +1,86 @@
+"""
+Tests for MGF chunking and merging of the chunk pin files.
+"""
+
+# Standard library
+import os
+
+# Third party
+import pytest
+
+# Project
+from mgf_chunks import get_chunk_sizes, merge_pins, rename_psmid, split_mgf
+
+
+PIN_HEADER = 'SpecId\tLabel\tScanNr\tPeptide\tProteins\n'
+
+
+def test_rename_psmid():
+    assert rename_psmid('chunk_001_SII_3_1_17_2_1', 'run_1', 100) == 'run_1_SII_103_1_17_2_1'
+
+
+def test_rename_psmid_run_with_underscores():
+    psmid = 'my_run_2_SII_0_1_5_3_1'
+    assert rename_psmid(psmid, 'other_run', 10) == 'other_run_SII_10_1_5_3_1'
+
+
+@pytest.mark.parametrize('psmid', ['run_1_3_1_17_2_1', 'run_XII_3_1_17_2_1', 'SII_3_1_17'])
+def test_rename_psmid_unexpected_format(psmid):
+    with pytest.raises(ValueError):
+        rename_psmid(psmid, 'run_1', 0)
+
+
+def test_get_chunk_sizes():
+    assert get_chunk_sizes(10, 3) == [3, 3, 4]
+    assert get_chunk_sizes(2, 8) == [1, 1]
+    assert get_chunk_sizes(10, 8, min_chunk_spectra=4) == [5, 5]
+    assert get_chunk_sizes(0, 4) == [0]
+
+
+def test_split_and_merge(tmp_path):
+    mgf_file = str(tmp_path / 'run_1.mgf')
+    with open(mgf_file, 'w') as f:
+        for scan in range(7):
+            f.write('BEGIN IONS\nTITLE=run_1.{0}.{0}.2\nPEPMASS=500.0\nCHARGE=2+\n'
+                    '100.0 1.0\nEND IONS\n\n'.format(scan))
+    chunk_dir = str(tmp_path / 'chunks')
+    manifest = split_mgf(mgf_file, chunk_dir, 3)
+    assert [row['first_spectrum'] for row in manifest] == [0, 2, 4]
+
+    pin_files = []
+    for row in manifest:
+        with open(os.path.join(chunk_dir, row['chunk'] + '.mgf')) as f:
+            titles = [line.strip() for line in f if line.startswith('TITLE=')]
+        assert len(titles) == row['n_spectra']
+        pin_file = os.path.join(chunk_dir, row['chunk'] + '.pin')
+        with open(pin_file, 'w') as f:
+            f.write(PIN_HEADER)
+            for i, title in enumerate(titles):
+                scan = title.split('.')[1]
+                f.write('{}_SII_{}_1_{}_2_1\t1\t{}\tK.PEPTIDE.K\tprotein\n'.format(
+                    row['chunk'], i, scan, scan
+                ))
+        pin_files.append(pin_file)
+
+    output_file = str(tmp_path / 'run_1.pin')
+    merged = merge_pins(pin_files[::-1], os.path.join(chunk_dir, 'chunks.tsv'), output_file)
+    assert merged == 7
+    with open(output_file) as f:
+        lines = f.readlines()
+    assert lines[0] == PIN_HEADER
+    assert [line.split('\t')[0] for line in lines[1:]] == [
+        'run_1_SII_{0}_1_{0}_2_1'.format(i) for i in range(7)
+    ]
+
+
+def test_merge_missing_chunk(tmp_path):
+    mgf_file = str(tmp_path / 'run_1.mgf')
+    with open(mgf_file, 'w') as f:
+        for scan in range(4):
+            f.write('BEGIN IONS\nTITLE={}\nEND IONS\n'.format(scan))
+    split_mgf(mgf_file, str(tmp_path), 2)
+    pin_file = str(tmp_path / 'chunk_000.pin')
+    with open(pin_file, 'w') as f:
+        f.write(PIN_HEADER)
+    with pytest.raises(ValueError):
+        merge_pins([pin_file], str(tmp_path / 'chunks.tsv'), str(tmp_path / 'merged.pin'))
@@ -0,0 +1,40 @@
+"""
+Tests for rewriting the protein columns of Percolator files.
+"""
+
+# Project
+from percolator_tools import fix_pin_tabs
+
+
+def fix(tmp_path, content):
+    path = str(tmp_path / 'run_1.pin')
+    with open(path, 'w') as f:
+        f.write(content)
+    fix_pin_tabs(path)
+    with open(path + '_fixed') as f:
+        return f.read()
+
+
+def test_fix_pin_tabs(tmp_path):
+    content = (
+        'SpecId\tLabel\tPeptide\tProteins\n'
+        'DefaultDirection\t-\t\t\n'
+        'run_1_SII_1_1_5_2_1\t1\tK.PEPTIDE.K\tprot_A\tprot_B\n'
+    )
+    assert fix(tmp_path, content) == (
+        'SpecId\tLabel\tPeptide\tProteins\n'
+        'DefaultDirection\t-\t\t\n'
+        'run_1_SII_1_1_5_2_1\t1\tK.PEPTIDE.K\tprot_A|||prot_B\n'
+    )
+
+
+def test_fix_pin_tabs_other_header(tmp_path):
+    # The number of columns is taken from the first row, whatever its first column
+    content = (
+        'PSMId\tscore\tq-value\tpeptide\tproteinIds\n'
+        'run_1_SII_1_1_5_2_1\t2.5\t0.001\tK.PEPTIDE.K\tprot_A\tprot_B\tprot_C\n'
+    )
+    assert fix(tmp_path, content) == (
+        'PSMId\tscore\tq-value\tpeptide\tproteinIds\n'
+        'run_1_SII_1_1_5_2_1\t2.5\t0.001\tK.PEPTIDE.K\tprot_A|||prot_B|||prot_C\n'
+    )
@@ -0,0 +1,92 @@
+"""
+Tests for the precursor m/z index.
+"""
+
+# Standard library
+import os
+
+# Third party
+import numpy as np
+import pytest
+
+# Project
+from precursor_index import PrecursorIndex, write_precursor_index
+
+
+def write_mgf(path, spectra):
+    with open(path, 'w') as f:
+        for title, precursor_mz, charge in spectra:
+            f.write('BEGIN IONS\nTITLE={}\nPEPMASS={}\n'.format(title, precursor_mz))
+            if charge:
+                f.write('CHARGE={}+\n'.format(charge))
+            f.write('100.0 1.0\n{:.4f} 2.0\nEND IONS\n\n'.format(precursor_mz))
+
+
+@pytest.fixture
+def spectra():
+    rng = np.random.default_rng(0)
+    return [
+        ('spectrum_{}'.format(i), round(float(mz), 4), int(charge))
+        for i, (mz, charge) in enumerate(zip(
+            rng.uniform(400, 1200, 500), rng.integers(0, 5, 500)
+        ))
+    ]
+
+
+@pytest.fixture
+def mgf_file(tmp_path, spectra):
+    path = str(tmp_path / 'spectral_library.mgf')
+    write_mgf(path, spectra)
+    return path
+
+
+def test_search_matches_brute_force(mgf_file, spectra):
+    assert write_precursor_index(mgf_file) == len(spectra)
+    with PrecursorIndex(mgf_file) as index:
+        assert len(index) == len(spectra)
+        for _, query_mz, _ in spectra[:50]:
+            for charge in [None, 0, 2]:
+                tolerance = query_mz * 2000 * 1e-6
+                expected = sorted(
+                    title for title, mz, c in spectra
+                    if abs(mz - query_mz) <= tolerance and charge in (None, c)
+                )
+                hits = index.search(query_mz, 2000, charge=charge)
+                titles = sorted(index.read_spectrum(i).title for i in hits)
+                assert titles == expected
+
+
+def test_query_reads_spectra(mgf_file, spectra):
+    write_precursor_index(mgf_file)
+    title, precursor_mz, charge = spectra[0]
+    with PrecursorIndex(mgf_file) as index:
+        spectrum, = [s for s in index.query(precursor_mz, 1, charge=charge) if s.title == title]
+    assert spectrum.charge == charge
+    assert spectrum.precursor_mz == precursor_mz
+    np.testing.assert_allclose(spectrum.mz, [100.0, precursor_mz])
+    np.testing.assert_allclose(spectrum.intensity, [1.0, 2.0])
+
+
+def test_empty_mgf(tmp_path):
+    path = str(tmp_path / 'empty.mgf')
+    open(path, 'w').close()
+    assert write_precursor_index(path) == 0
+    with PrecursorIndex(path) as index:
+        assert len(index) == 0
+        assert len(index.search(500.0, 10)) == 0
+
+
+def test_outdated_index(mgf_file, spectra):
+    write_precursor_index(mgf_file)
+    write_mgf(mgf_file, spectra[:10])
+    stat = os.stat(mgf_file)
+    os.utime(mgf_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    with pytest.raises(ValueError):
+        PrecursorIndex(mgf_file)
+
+
+def test_compressed_mgf(tmp_path):
+    path = str(tmp_path / 'spectral_library.mgf.gz')
+    open(path, 'wb').close()
+    with pytest.raises(ValueError):
+        write_precursor_index(path)
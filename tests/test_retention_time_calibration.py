@@ -0,0 +1,41 @@
+"""
+Tests for the calibration of run collections.
+"""
+
+# Third party
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip("spectrum_utils")
+
+# Project
+from retention_time_calibration import RunCollection
+
+
+def shared_psms(n_runs=4, n_peptides=60):
+    """PSMs of peptides identified in all runs, with a different offset per run."""
+    rng = np.random.default_rng(4)
+    base = rng.uniform(10, 100, n_peptides)
+    offsets = rng.normal(0, 3, n_runs)
+    rows = []
+    for run in range(n_runs):
+        for peptide in range(n_peptides):
+            rows.append({
+                'sequence': 'PEPTIDE{}K'.format(peptide),
+                'modifications': '',
+                'run': 'run_{}'.format(run),
+                'collection': 'collection',
+                'retention_time': base[peptide] + offsets[run] + rng.normal(0, 0.5),
+                'q_value': 0.001,
+            })
+    return pd.DataFrame(rows)
+
+
+@pytest.mark.parametrize('model', ['stepwise', 'linear', 'monotone'])
+def test_tree_alignment_equals_shared(model):
+    collection = RunCollection('collection')
+    psms = shared_psms()
+    shared = collection.calibrate_collection(psms=psms.copy(), model=model, alignment='shared')
+    tree = collection.calibrate_collection(psms=psms.copy(), model=model, alignment='tree')
+    pd.testing.assert_frame_equal(tree, shared)
@@ -0,0 +1,172 @@
+"""
+Tests for retention time alignment.
+"""
+
+# Third party
+import numpy as np
+import pytest
+
+# Project
+from rt_alignment import (
+    align_runs,
+    anchor_overlap,
+    calibrate_runs,
+    isotonic_regression,
+    maximum_spanning_tree,
+    running_mean,
+)
+
+
+def calibrate_loop(original, original_shared, reference_shared):
+    """
+    Per-run loop that `calibrate_runs` replaced, with the offset subtracted
+    instead of added.
+    """
+    original = np.array(original, dtype=np.float64)
+    original_shared = np.insert(np.array(original_shared, dtype=np.float64), 0, 0)
+    reference_shared = np.insert(np.array(reference_shared, dtype=np.float64), 0, 0)
+    original_calibrated = original.copy()
+    diff = original_shared - reference_shared
+    for i in range(1, len(reference_shared)):
+        original_calibrated[
+            np.logical_and(original > original_shared[i - 1], original <= original_shared[i])
+        ] -= diff[i]
+    original_calibrated[original > original_shared[-1]] -= diff[-1]
+    return original_calibrated
+
+
+def random_runs(rng, n_runs=4, n_anchors=20, n_rt=300):
+    runs, x, anchor_runs, anchor_x, anchor_ref = [], [], [], [], []
+    for run in range(n_runs):
+        run_anchors = np.sort(rng.choice(np.arange(1, 120), n_anchors, replace=False)).astype(float)
+        run_x = rng.uniform(-5, 130, n_rt)
+        # Include retention times at the anchors
+        run_x[:n_anchors] = run_anchors
+        runs.append(np.full(n_rt, run))
+        x.append(run_x)
+        anchor_runs.append(np.full(n_anchors, run))
+        anchor_x.append(run_anchors)
+        anchor_ref.append(run_anchors + rng.normal(0, 3, n_anchors))
+    return [np.concatenate(values) for values in (runs, x, anchor_runs, anchor_x, anchor_ref)]
+
+
+def test_stepwise_matches_loop():
+    rng = np.random.default_rng(0)
+    for _ in range(20):
+        runs, x, anchor_runs, anchor_x, anchor_ref = random_runs(rng)
+        calibrated = calibrate_runs(runs, x, anchor_runs, anchor_x, anchor_ref)
+        for run in np.unique(runs):
+            expected = calibrate_loop(
+                x[runs == run], anchor_x[anchor_runs == run], anchor_ref[anchor_runs == run]
+            )
+            np.testing.assert_allclose(calibrated[runs == run], expected)
+
+
+@pytest.mark.parametrize('model', ['stepwise', 'linear', 'monotone'])
+def test_constant_offset(model):
+    rng = np.random.default_rng(1)
+    runs, x, anchor_runs, anchor_x, _ = random_runs(rng)
+    calibrated = calibrate_runs(runs, x, anchor_runs, anchor_x, anchor_x + 2.0, model=model)
+    beyond_first = x > np.array([anchor_x[anchor_runs == run].min() for run in runs])
+    np.testing.assert_allclose(calibrated[beyond_first], x[beyond_first] + 2.0)
+    np.testing.assert_array_equal(calibrated[x <= 0], x[x <= 0])
+
+
+def test_monotone_is_non_decreasing():
+    rng = np.random.default_rng(2)
+    runs, x, anchor_runs, anchor_x, anchor_ref = random_runs(rng)
+    calibrated = calibrate_runs(
+        runs, x, anchor_runs, anchor_x, np.abs(anchor_ref), model='monotone'
+    )
+    for run in np.unique(runs):
+        order = np.argsort(x[runs == run])
+        assert np.all(np.diff(calibrated[runs == run][order]) >= -1e-9)
+
+
+def test_linear_interpolates_between_anchors():
+    calibrated = calibrate_runs(
+        [0, 0, 0, 0], [5.0, 10.0, 15.0, 30.0], [0, 0], [10.0, 20.0], [12.0, 20.0], model='linear'
+    )
+    np.testing.assert_allclose(calibrated, [6.0, 12.0, 16.0, 30.0])
+
+
+def test_unknown_model():
+    with pytest.raises(ValueError):
+        calibrate_runs([0], [1.0], [0], [1.0], [1.0], model='cubic')
+
+
+def test_isotonic_regression():
+    np.testing.assert_allclose(isotonic_regression([1.0, 3.0, 2.0, 4.0]), [1.0, 2.5, 2.5, 4.0])
+
+
+def test_running_mean_keeps_linear_trend():
+    y = np.arange(10, dtype=np.float64) * 3 + 1
+    np.testing.assert_allclose(running_mean(y, 5), y)
+    np.testing.assert_allclose(running_mean([1.0, 2.0, 3.0, 10.0, 5.0], 5), [1.0, 2.0, 4.2, 6.0, 5.0])
+
+
+def chain_of_runs(n_runs=4, offset=5.0):
+    """
+    Runs with a retention time offset of `offset` per run, where each run only
+    shares peptides with the previous and next run.
+    """
+    rng = np.random.default_rng(3)
+    base = rng.uniform(10, 100, 50 * (n_runs + 1))
+    runs, peptides = [], []
+    for run in range(n_runs):
+        runs.append(np.full(100, run))
+        peptides.append(np.arange(run * 50, run * 50 + 100))
+    runs, peptides = np.concatenate(runs), np.concatenate(peptides)
+    return runs, peptides, base[peptides] + offset * runs, base[peptides]
+
+
+def test_anchor_overlap():
+    runs, peptides, _, _ = chain_of_runs()
+    overlap = anchor_overlap(runs, peptides, 4, chunk_size=64)
+    expected = np.array([
+        [len(set(peptides[runs == i]) & set(peptides[runs == j])) for j in range(4)]
+        for i in range(4)
+    ])
+    np.testing.assert_array_equal(overlap, expected)
+
+
+def test_maximum_spanning_tree():
+    overlap = np.array([
+        [0, 30, 5, 0],
+        [30, 0, 20, 12],
+        [5, 20, 0, 40],
+        [0, 12, 40, 0],
+    ])
+    root, parent, order = maximum_spanning_tree(overlap, min_anchors=10)
+    assert root == 2
+    np.testing.assert_array_equal(parent, [1, 2, -1, 2])
+    np.testing.assert_array_equal(order, [2, 3, 1, 0])
+
+
+@pytest.mark.parametrize('model', ['stepwise', 'linear', 'monotone'])
+def test_align_chain(model):
+    runs, peptides, x, base = chain_of_runs()
+    calibrated, root, parent = align_runs(runs, peptides, x, model=model)
+    assert root == 1
+    np.testing.assert_array_equal(parent, [1, -1, 1, 2])
+    expected = base + 5.0 * root
+    if model == 'stepwise':
+        np.testing.assert_allclose(calibrated, expected)
+    else:
+        # Offsets are interpolated from 0 up to the first anchors of each run,
+        # all other retention times are composed exactly
+        beyond_first = base > 15
+        np.testing.assert_allclose(calibrated[beyond_first], expected[beyond_first])
+        assert np.abs(calibrated - expected).max() < 5.0
+
+
+def test_align_unconnected_runs():
+    runs, peptides, x, _ = chain_of_runs()
+    # Run 4 shares fewer than `min_anchors` peptides with run 3, run 5 none
+    extra_peptides = np.concatenate([peptides[runs == 3][-5:], np.arange(1000, 1100)])
+    runs = np.concatenate([runs, np.full(5, 4), np.full(95, 4), np.full(100, 5)])
+    peptides = np.concatenate([peptides, extra_peptides[:100], extra_peptides[5:105] + 500])
+    x = np.concatenate([x, np.linspace(5, 120, 200)])
+    calibrated, root, parent = align_runs(runs, peptides, x, min_anchors=10)
+    np.testing.assert_array_equal(parent[4:], [-1, -1])
+    np.testing.assert_array_equal(calibrated[runs >= 4], x[runs >= 4])
@@ -0,0 +1,86 @@
+"""
+Tests for the binary spectral library: write, then read back.
+"""
+
+# Third party
+import numpy as np
+import pandas as pd
+import pytest
+
+# Project
+from speclib_binary import SpectralLibrary, write_binary_library
+
+
+SPECTRA = [
+    ('mzspec:PXD000000:run_1:scan:2:PEPTIDEK/2', 'PEPTIDEK', '-', 'run_1', 2, 0.001, 2,
+     478.7342, [(100.5, 10.0), (200.25, 20.0), (300.125, 5.0)]),
+    ('mzspec:PXD000000:run_1:scan:7:ACDEFGHIK/3', 'ACDEFGHIK', '1|Carbamidomethyl', 'run_1',
+     3, 0.005, 7, 340.1567, [(150.0, 1.5)]),
+    ('mzspec:PXD000000:run_2:scan:3:LMNPQR/2', 'LMNPQR', '-', 'run_2', 2, 0.0, 3,
+     386.2, []),
+]
+
+
+def write_mgf(path, spectra):
+    with open(path, 'w') as f:
+        for usi, _, _, _, charge, _, _, precursor_mz, peaks in spectra:
+            f.write('BEGIN IONS\nTITLE={}\nPEPMASS={}\nCHARGE={}+\n'.format(
+                usi, precursor_mz, charge
+            ))
+            for mz, intensity in peaks:
+                f.write('{} {}\n'.format(mz, intensity))
+            f.write('END IONS\n\n')
+
+
+@pytest.fixture
+def library(tmp_path):
+    mgf_file = str(tmp_path / 'spectral_library.mgf')
+    write_mgf(mgf_file, SPECTRA)
+    # Metadata in another order than the MGF file
+    metadata = pd.DataFrame(
+        [spectrum[:7] for spectrum in reversed(SPECTRA)],
+        columns=['usi', 'peptide', 'modifications', 'run', 'charge', 'q-value', 'scan_number'],
+    )
+    outname = str(tmp_path / 'spectral_library.speclib')
+    write_binary_library(outname, mgf_file, metadata)
+    with SpectralLibrary(outname) as lib:
+        yield lib
+
+
+def test_peaks(library):
+    assert len(library) == len(SPECTRA)
+    for i, spectrum in enumerate(SPECTRA):
+        mz, intensity = library.peaks(i)
+        assert mz.dtype == np.float32
+        expected = np.array(spectrum[8], dtype=np.float32).reshape(-1, 2)
+        np.testing.assert_array_equal(mz, expected[:, 0])
+        np.testing.assert_array_equal(intensity, expected[:, 1])
+
+
+def test_metadata_in_mgf_order(library):
+    for i, (usi, peptide, modifications, run, charge, q_value, scan_number,
+            precursor_mz, _) in enumerate(SPECTRA):
+        assert library.metadata(i) == {
+            'usi': usi,
+            'peptide': peptide,
+            'modifications': modifications,
+            'run': run,
+            'charge': charge,
+            'q-value': q_value,
+            'scan_number': scan_number,
+            'precursor_mz': precursor_mz,
+        }
+
+
+def test_get_column(library):
+    assert library.get_column('peptide') == [spectrum[1] for spectrum in SPECTRA]
+    np.testing.assert_array_equal(
+        library.get_column('scan_number'), [spectrum[6] for spectrum in SPECTRA]
+    )
+
+
+def test_not_a_library(tmp_path):
+    path = tmp_path / 'spectral_library.mgf'
+    path.write_bytes(b'BEGIN IONS\n')
+    with pytest.raises(ValueError):
+        SpectralLibrary(str(path))